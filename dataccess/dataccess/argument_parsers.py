@@ -70,3 +70,12 @@ def addparser_eventframes(subparsers):
     eventframes.add_argument('detid', type = str, help = 'Detector ID.')
     eventframes.add_argument('label', help = 'Label of dataset to process.')
     eventframes.add_argument('--filter', '-f', action = 'store_true', help = 'If selected, logbook-specified event filtering will be applied.')
+
+
+def addparser_cache(subparsers):
+    cache = subparsers.add_parser('cache', help = 'List, size, verify or delete cached results in the directory cache/.')
+    cache.add_argument('action', choices = ['list', 'size', 'verify', 'prune', 'compact'], help = 'list: show cache files and the calls that produced them; size: total size per function; verify: report unreadable and stale cache files; prune: delete the selected cache files; compact: reclaim the space of overwritten values in persistent stores (no other mecana process may be running).')
+    cache.add_argument('--function', '-u', default = None, help = 'Only select cache files of this function (name or cache file prefix).')
+    cache.add_argument('--label', '-l', default = None, help = 'Only select cache files of calls with this dataset label as an argument.')
+    cache.add_argument('--run', '-r', type = int, default = None, help = 'Only select cache files of calls involving this run number.')
+    cache.add_argument('--stale', '-s', action = 'store_true', help = 'Only select cache files invalidated by changes to source code or config.py.')
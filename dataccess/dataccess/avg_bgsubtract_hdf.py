@@ -12,34 +12,234 @@ import argparse
 import os
 import random
 import ipdb
+import collections
+from collections import namedtuple
 import dill
 import sys
+import threading
+import Queue
 from time import time
 
 
 def idxgen(ds):
-    from mpi4py import MPI
-    comm = MPI.COMM_WORLD
+    comm = utils.get_comm()
     rank = comm.Get_rank()
     if rank==0: print 'idx mode'
     size = comm.Get_size()
     run = ds.runs().next()
     times = run.times()
-    mylength = len(times)//size
-    startevt = rank*mylength
-    mytimes= times[startevt:(rank+1)*mylength]
+    # slab boundaries chosen so that the remainder events are included
+    startevt = (rank * len(times)) // size
+    endevt = ((rank + 1) * len(times)) // size
+    mytimes= times[startevt:endevt]
     for nevent,t in enumerate(mytimes, startevt):
         yield nevent,run.event(t)
 
+# Number of consecutive events claimed by a rank per request in chunkgen
+EVENT_CHUNK_SIZE = 20
+
+class EventCounter(object):
+    """
+    Counter of events handed out so far, hosted in an MPI window on rank 0.
+    Ranks claim work with an atomic fetch-and-add, so no rank has to be
+    dedicated to serving requests.
+    """
+    def __init__(self, comm):
+        from mpi4py import MPI
+        self.MPI = MPI
+        if comm.Get_rank() == 0:
+            self.buf = np.zeros(1, dtype = 'i8')
+        else:
+            self.buf = None
+        self.win = MPI.Win.Create(self.buf, disp_unit = 8, comm = comm)
+        comm.Barrier()
+
+    def claim(self, n):
+        """
+        Advance the counter by n and return its previous value.
+        """
+        MPI = self.MPI
+        incr = np.array([n], dtype = 'i8')
+        result = np.empty(1, dtype = 'i8')
+        self.win.Lock(0)
+        self.win.Fetch_and_op([incr, MPI.INT64_T], [result, MPI.INT64_T], 0, 0, MPI.SUM)
+        self.win.Unlock(0)
+        return int(result[0])
+
+    def free(self):
+        self.win.Free()
+
+def chunkgen(ds, chunk_size = None, stats = None):
+    """
+    Dynamically scheduled alternative to idxgen. Ranks repeatedly claim the
+    next chunk_size event times of the run until all events have been handed
+    out, so that ranks that draw cheap events pick up more of them.
+
+    Once all events are processed this generator reports per-rank busy time
+    (time spent on claimed chunks, including the caller's processing of the
+    yielded events) and idle time (time spent waiting for the other ranks to
+    finish). If stats is a list, the per-rank dicts are also appended to it
+    (on rank 0 only). chunk_size defaults to EVENT_CHUNK_SIZE.
+
+    The closing collectives also run if the consumer stops early (e.g. by
+    raising), when the generator is closed or garbage collected, so that the
+    other ranks aren't left blocked in them.
+    """
+    comm = utils.get_comm()
+    rank = comm.Get_rank()
+    if chunk_size is None:
+        chunk_size = EVENT_CHUNK_SIZE
+    if rank==0: print 'chunk mode, chunk size: ', chunk_size
+    run = ds.runs().next()
+    times = run.times()
+    counter = EventCounter(comm)
+    busy = 0.
+    nevents = 0
+    nchunks = 0
+    try:
+        while True:
+            start = counter.claim(chunk_size)
+            if start >= len(times):
+                break
+            chunk_start = time()
+            for nevent in xrange(start, min(start + chunk_size, len(times))):
+                yield nevent, run.event(times[nevent])
+                nevents += 1
+            busy += time() - chunk_start
+            nchunks += 1
+    finally:
+        idle_start = time()
+        comm.Barrier()
+        idle = time() - idle_start
+        counter.free()
+        rank_stats = comm.gather({'rank': rank, 'busy': busy, 'idle': idle,
+            'events': nevents, 'chunks': nchunks}, root = 0)
+        if rank == 0:
+            for d in rank_stats:
+                print 'rank %(rank)d: busy %(busy).2f s, idle %(idle).2f s, %(events)d events in %(chunks)d chunks' % d
+        if stats is not None:
+            stats.extend(rank_stats or [])
+
 def smdgen(ds):
-    from mpi4py import MPI
-    comm = MPI.COMM_WORLD
+    comm = utils.get_comm()
     rank = comm.Get_rank()
     size = comm.Get_size()
     if rank==0: print 'smd mode'
     for nevent,evt in enumerate(ds.events()):
         if nevent%size == rank: yield nevent,evt
 
+# Default number of events read ahead by prefetchgen's reader thread in
+# get_partial_one_run_smd_area. 0 disables prefetching.
+PREFETCH_DEPTH = 0
+
+# Interval, in seconds, at which prefetchgen's reader thread checks whether
+# the consumer has stopped while it waits for room in the queue
+PREFETCH_POLL_INTERVAL = 0.1
+
+class ReaderError(object):
+    """
+    Wrapper for the exc_info of an exception raised in prefetchgen's reader
+    thread, which the consumer re-raises.
+    """
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+def prefetchgen(evtgen, read, depth, stats = None):
+    """
+    Iterate over evtgen and apply read to each (nevent, evt) pair in a
+    separate reader thread, which runs up to depth events ahead of the
+    consumer. Yields (nevent, read(nevent, evt)) in the order of evtgen.
+
+    Exceptions raised by evtgen or read are re-raised in the consumer's
+    thread. If the consumer stops early (e.g. by raising), the reader thread
+    stops, closes evtgen (so that chunkgen's closing collectives run) and is
+    joined before this generator exits. Once evtgen is exhausted this
+    generator reports the mean depth of the queue (sampled whenever the
+    consumer takes an event), the number of times the consumer found the
+    queue empty and the time each thread spent blocked on the other. If
+    stats is a list, a dict of these metrics is appended to it.
+
+    Since evtgen (e.g. chunkgen) may make MPI calls, which then happen on
+    the reader thread, prefetching requires MPI to be initialized with
+    thread support level THREAD_SERIALIZED or higher. Otherwise events are
+    read in the consumer's thread, without prefetching.
+    """
+    from mpi4py import MPI
+    if MPI.Query_thread() < MPI.THREAD_SERIALIZED:
+        print 'prefetch disabled: MPI thread support level is below THREAD_SERIALIZED'
+        for nevent, evt in evtgen:
+            yield nevent, read(nevent, evt)
+        return
+    queue = Queue.Queue(maxsize = depth)
+    done = object()
+    # Set by the consumer when it stops taking events
+    stop = threading.Event()
+    # time the reader thread spends waiting for room in the queue
+    reader_state = {'blocked': 0.}
+    def put(item):
+        """
+        Put item in the queue unless the consumer has stopped. Returns
+        False if it has.
+        """
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout = PREFETCH_POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def reader():
+        try:
+            for nevent, evt in evtgen:
+                item = (nevent, read(nevent, evt))
+                put_start = time()
+                if not put(item):
+                    break
+                reader_state['blocked'] += time() - put_start
+            put(done)
+        except Exception:
+            put(ReaderError(sys.exc_info()))
+        finally:
+            if hasattr(evtgen, 'close'):
+                evtgen.close()
+    thread = threading.Thread(target = reader)
+    thread.daemon = True
+    thread.start()
+    nevents = 0
+    depth_total = 0
+    empty_count = 0
+    waited = 0.
+    try:
+        while True:
+            qsize = queue.qsize()
+            depth_total += qsize
+            if qsize == 0:
+                empty_count += 1
+            get_start = time()
+            item = queue.get()
+            waited += time() - get_start
+            if item is done:
+                break
+            if isinstance(item, ReaderError):
+                raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+            nevents += 1
+            yield item
+    finally:
+        stop.set()
+        # Make room for a reader blocked on a full queue
+        while thread.is_alive():
+            try:
+                queue.get_nowait()
+            except Queue.Empty:
+                thread.join(PREFETCH_POLL_INTERVAL)
+    rank_stats = {'events': nevents, 'depth': depth,
+        'mean_depth': float(depth_total) / max(nevents, 1),
+        'empty': empty_count, 'consumer_wait': waited,
+        'reader_blocked': reader_state['blocked']}
+    print 'prefetch (depth %(depth)d): %(events)d events, mean queue depth %(mean_depth).2f, queue empty %(empty)d times, consumer waited %(consumer_wait).2f s, reader blocked %(reader_blocked).2f s' % rank_stats
+    if stats is not None:
+        stats.append(rank_stats)
+
 random.seed(os.getpid())
 
 import config
@@ -49,6 +249,10 @@ from psana import *
 from PSCalib.GeometryAccess import img_from_pixel_arrays
 from Detector.GlobalUtils import print_ndarr
 from dataccess import toscript
+from dataccess import calibcache
+from dataccess import pixelstats
+from dataccess import eventstore
+from dataccess import eventmask
 from functools import partial
 import config # config.py in local directory
 
@@ -72,8 +276,25 @@ from pathos.multiprocessing import ProcessingPool
 #XTC_DIR = '/reg/d/psdm/MEC/' + expname + '/xtc/'
 XTC_DIR = '/reg/d/psdm/' + config.exppath + '/xtc/'
 
+# Attributes of config that the values of this module's cached functions
+# depend on
+CACHE_CONFIG_FIELDS = ['exppath', 'expname', 'detinfo_map', 'nonarea',
+    'sigma_max', 'deferred_assembly']
+
+# Keyword arguments that change how values are computed but not the values
+# themselves, and are therefore left out of cache keys
+PERFORMANCE_KWARGS = ['run_groups', 'prefetch_depth']
+
+# Modules whose source code the cached values of this module's functions
+# depend on: this module (helpers such as get_area_detector_subregion, and
+# the per-run functions called by get_signal_many_parallel) and those
+# handling calibration, event masks and event data.
+CACHE_DEPENDENCIES = [sys.modules[__name__], calibcache, eventmask, eventstore]
+
 
-@utils.eager_persist_to_file("cache/get_signal_one_run/")
+@utils.eager_persist_to_file("cache/get_signal_one_run/",
+    config_fields = CACHE_CONFIG_FIELDS,
+    depends_on = CACHE_DEPENDENCIES)
 def get_signal_one_run(runNum, detid = 1, sigma_max = 1000.0,
 event_data_getter = None, event_mask = None, **kwargs):
     # TODO: remove sigma_max discrimination
@@ -152,48 +373,124 @@ def get_area_detector_subregion(quad, det, evt, detid):
     """
     if quad>3 : quad = 3
     if quad >= 0:
-        if 'Cspad' not in config.detinfo_map[detid].device_name:
-            raise ValueError("Can't take subregion of non-CSPAD detector")
-        rnum = evt.run()
-        geo = det.geometry(rnum)        # for >ana-0.17.5
-
-        # get pixel index array for quad, shape=(8, 185, 388)
-        iX, iY = geo.get_pixel_coord_indexes('QUAD:V1', quad)
-#        print_ndarr(iX, 'iX')
-#        print_ndarr(iY, 'iY')
-
-        t0_sec = time()
-
-        nda = det.raw(evt)
-        ped = det.pedestals(evt)
-
-        #print 'Consumed time = %7.3f sec' % (time()-t0_sec)
-        #print_ndarr(nda, 'raw')
-
-        # get intensity array for quad, shape=(8, 185, 388)
-        nda.shape = (4, 8, 185, 388)
-        ndaq = nda[quad,:]
-        
-        ped.shape = (4, 8, 185, 388)
-        pedq = ped[quad,:]
-        #print_ndarr(ndaq, 'nda[%d,:]'%quad)
-
-        # reconstruct image for quad
-        img = img_from_pixel_arrays(iX, iY, W=ndaq)
-        bg = img_from_pixel_arrays(iX, iY, W=pedq)
-        new = np.empty_like(img)
-        new[:] = (img - bg)
-        return new
+        ndaq = get_area_detector_subregion_raw(quad, det, evt, detid)
+        # pixel index arrays and pedestals for quad, shape=(8, 185, 388)
+        calib = calibcache.get_quad_calibration(det, evt.run(), detid, quad)
+        # reconstruct pedestal-subtracted image for quad
+        return calib.subtract_and_assemble(ndaq)
     else:
         if 'Cspad' in config.detinfo_map[detid].device_name:
             return det.image(evt)
         else:
             return det.raw(evt)
 
-@utils.eager_persist_to_file('cache/avg_bgsubtract_hdf/get_event_data_nonarea')
+def get_area_detector_subregion_raw(quad, det, evt, detid):
+    """
+    Extracts raw (neither pedestal-subtracted nor assembled) data from an
+    individual quad detector. The returned array has shape (8, 185, 388).
+
+    Since pedestal subtraction and image assembly are both linear, sums of
+    these arrays can be converted into an image once, after accumulation,
+    using assemble_area_detector_subregion.
+    """
+    if quad>3 : quad = 3
+    if 'Cspad' not in config.detinfo_map[detid].device_name:
+        raise ValueError("Can't take subregion of non-CSPAD detector")
+    nda = det.raw(evt)
+    nda.shape = (4, 8, 185, 388)
+    return nda[quad,:]
+
+def assemble_area_detector_subregion(quad, det, runNum, raw, detid):
+    """
+    Subtract pedestals from an array of raw quad data (as returned by
+    get_area_detector_subregion_raw, or a mean of such arrays) and assemble
+    the result into an image.
+    """
+    calib = calibcache.get_quad_calibration(det, runNum, detid, quad)
+    return calib.subtract_and_assemble(raw)
+
+def get_nonarea_value(evt, detid):
+    """
+    Return a non-area detector's reading for a single event, or None if the
+    event doesn't contain data from the detector.
+    """
+    dettype = config.nonarea[detid].type
+    if dettype == 'Lusi.IpmFexV1':
+        # LUSI detector reading
+        k = evt.get(Lusi.IpmFexV1, Source(config.nonarea[detid].src))
+        if k:
+            return k.channel()[0]
+    elif dettype == 'Bld.BldDataFEEGasDetEnergyV1':
+        # gas detector average reading
+        k = evt.get(Bld.BldDataFEEGasDetEnergyV1, Source(config.nonarea[detid].src))
+        if k:
+            return np.mean([k.f_11_ENRC(), k.f_12_ENRC(), k.f_21_ENRC(), k.f_22_ENRC()])
+    else:
+        raise ValueError("Not a valid non-area detector")
+    return None
+
+def make_detector_reader(ds, runNum, detid, subregion_index = None, comm = None):
+    """
+    Return a function that takes a psana event and returns the readout of
+    detector detid (an area detector frame or a non-area detector value), or
+    None if the event doesn't contain it.
+
+    subregion_index defaults to the value in config.detinfo_map. If comm is
+    provided, calibration constants are resolved collectively over it.
+    """
+    if detid in config.nonarea:
+        return lambda evt: get_nonarea_value(evt, detid)
+    if subregion_index is None:
+        subregion_index = config.detinfo_map[detid].subregion_index
+    det = Detector(config.detinfo_map[detid].device_name, ds.env())
+    if subregion_index >= 0:
+        calibcache.get_quad_calibration(det, runNum, detid, subregion_index, comm = comm)
+    def read(evt):
+        try:
+            return get_area_detector_subregion(subregion_index, det, evt, detid)
+        except AttributeError:
+            return None
+    return read
+
+def evaluate_event_data_getter(event_data_getter, detid, value, runNum, nevent):
+    """
+    Call an event data getter (or event filter) with the keyword arguments
+    used for detid's detector type.
+    """
+    if detid in config.nonarea:
+        return event_data_getter(value, run = runNum)
+    else:
+        return event_data_getter(value, run = runNum, nevent = nevent)
+
+def allreduce_sum(comm, arr):
+    """
+    Sum an array over all ranks of comm. arr may be None on ranks that
+    processed no events, in which case those ranks contribute zeros.
+
+    Returns None if arr is None on all ranks.
+    """
+    shapes = filter(lambda shape: shape is not None,
+        comm.allgather(None if arr is None else np.shape(arr)))
+    if not shapes:
+        return None
+    if arr is None:
+        arr = np.zeros(shapes[0], dtype = 'float')
+    # Flatten so that 0-d (non-area detector) sums can be used as buffers
+    arr = np.ascontiguousarray(arr, dtype = 'float').ravel()
+    total = np.empty_like(arr)
+    comm.Allreduce(arr, total)
+    return total.reshape(shapes[0])
+
+@utils.eager_persist_to_file('cache/avg_bgsubtract_hdf/get_event_data_nonarea',
+    excluded = ['event_data_allgather'], collective = True,
+    config_fields = CACHE_CONFIG_FIELDS,
+    depends_on = CACHE_DEPENDENCIES)
 def get_event_data_nonarea(runNum, detid, **kwargs):
-    from mpi4py import MPI
-    comm = MPI.COMM_WORLD
+    """
+    Return a dict mapping the event numbers of a run's events that contain
+    data from non-area detector detid to its readings, on all ranks.
+    """
+    comm = utils.get_comm()
     if config.smd:
         ds = DataSource('exp=%s:run=%d:idx' % (config.expname, runNum))
         #ds = DataSource('exp=%s:run=%d:smd' % (config.expname, runNum))
@@ -203,161 +500,451 @@ def get_event_data_nonarea(runNum, detid, **kwargs):
     print ''
     print "PROCESSING RUN: ", runNum
     print ''
-    evtgen = idxgen(ds)
+    evtgen = chunkgen(ds)
     #evtgen = smdgen(ds)
-    det_values = []
-    def eval_lusi(evt):
-        """LUSI detector reading"""
-        k = evt.get(Lusi.IpmFexV1, Source(config.nonarea[detid].src))
-        if k:
-            det_values.append(k.channel()[0])
-    def eval_bld(evt):
-        """gas detector average reading"""
-        k = evt.get(Bld.BldDataFEEGasDetEnergyV1, Source(config.nonarea[detid].src))
-        if k:
-            det_values.append(np.mean([k.f_11_ENRC(), k.f_12_ENRC(), k.f_21_ENRC(), k.f_22_ENRC()]))
-            #print "appending: ", str([k.f_11_ENRC(), k.f_12_ENRC(), k.f_21_ENRC(), k.f_22_ENRC()])
+    det_values = {}
     for nevent, evt in evtgen:
-        if config.nonarea[detid].type == 'Lusi.IpmFexV1':
-            eval_lusi(evt)
-        elif config.nonarea[detid].type == 'Bld.BldDataFEEGasDetEnergyV1':
-            eval_bld(evt)
-        else:
-            raise ValueError("Not a valid non-area detector")
-    return reduce(lambda x, y: x + y, comm.allgather(det_values))
+        value = get_nonarea_value(evt, detid)
+        if value is not None:
+            det_values[nevent] = value
+    return utils.gather_event_data(comm, det_values, allgather = True)
+
+# Partial result of processing a single run: the sum of the detector readout
+# over all processed events, the number of events, and the event data dict.
+# Partials of different runs are combined by merge_run_partials.
+RunPartial = namedtuple('RunPartial', ['signalsum', 'nevents', 'event_data'])
+
+def strip_event_data(result):
+    """
+    Return a copy of a RunPartial, or of an event data dict keyed by run
+    number, with empty event data. Tuples and lists (e.g. of RunPartials, or
+    (signal, event data) pairs) are stripped element by element.
+    """
+    if isinstance(result, RunPartial):
+        return result._replace(event_data = {})
+    if isinstance(result, collections.Mapping):
+        return {run: {} for run in result}
+    if isinstance(result, (list, tuple)):
+        return type(result)(map(strip_event_data, result))
+    return result
+
+def merge_run_partials(runList, partials):
+    """
+    Combine the RunPartials of the runs in runList into the mean detector
+    readout over all of their events and an event data dict keyed by run
+    number.
+
+    Runs are weighted by their numbers of events. The non-smd code path of
+    get_signal_many_parallel instead gives each run equal weight, since its
+    cached per-run values (from get_signal_one_run) are means without event
+    counts.
+    """
+    signalsum = reduce(lambda x, y: x + y, [p.signalsum for p in partials])
+    nevents = sum(p.nevents for p in partials)
+    event_data =\
+        {run: p.event_data
+        for run, p in zip(runList, partials)}
+    return signalsum / nevents, event_data
 
 #@utils.eager_persist_to_file('cache/avg_bgsubtract_hdf/get_signal_one_run_nonarea')
 def get_signal_one_run_nonarea(runNum, detid,
         event_data_getter = None, event_mask = None, **kwargs):
+    partial = get_partial_one_run_nonarea(runNum, detid,
+        event_data_getter = event_data_getter, event_mask = event_mask, **kwargs)
+    return partial.signalsum / partial.nevents, partial.event_data
+
+def get_partial_one_run_nonarea(runNum, detid,
+        event_data_getter = None, event_mask = None, **kwargs):
+    """
+    Return a RunPartial for a non-area detector. As for area detectors,
+    event data is keyed by event number.
+    """
+    run_mask = eventmask.get_run_mask(event_mask, runNum)
     def event_valid(nevent):
-        if event_mask:
-            run_mask = event_mask[runNum]
-            return run_mask[nevent]
-        else:
-            return True
+        return run_mask is None or run_mask[nevent]
 
     det_values = get_event_data_nonarea(runNum, detid, **kwargs)
-    det_values_filtered =\
-        [dat
-        for i, dat in enumerate(det_values)
-        if event_valid(i)]
-    event_mean = np.sum(det_values_filtered) / len(det_values_filtered)
+    valid_nevents =\
+        [nevent
+        for nevent in sorted(det_values)
+        if event_valid(nevent)]
+    det_values_filtered = [det_values[nevent] for nevent in valid_nevents]
 
     if event_data_getter:
-        event_data_list =\
-            [event_data_getter(dv, run = runNum)
-            for dv in det_values]
-        # filtered event data
         event_data =\
-            {i: dat
-            for i, dat in enumerate(event_data_list)
-            if event_valid(i)}
+            {nevent: event_data_getter(det_values[nevent], run = runNum)
+            for nevent in valid_nevents}
     else:
         event_data = {}
-    return event_mean, event_data
+    return RunPartial(np.sum(det_values_filtered), len(det_values_filtered), event_data)
 
 
-# TODO: more testing and refactor all of this!
-@utils.eager_persist_to_file("cache/get_signal_one_run_smd_area/")
 def get_signal_one_run_smd_area(runNum, detid, subregion_index = -1,
         event_data_getter = None, event_mask = None, **kwargs):
-    from mpi4py import MPI
-    comm = MPI.COMM_WORLD
+    """
+    Return the mean detector readout over all (valid) events in a run, along
+    with a dict mapping event numbers to the output of event_data_getter.
+
+    See get_partial_one_run_smd_area for additional keyword arguments.
+    """
+    partial = get_partial_one_run_smd_area(runNum, detid,
+        subregion_index = subregion_index, event_data_getter = event_data_getter,
+        event_mask = eventmask.restrict(event_mask, runNum), **kwargs)
+    return partial.signalsum / partial.nevents, partial.event_data
+
+# TODO: more testing and refactor all of this!
+@utils.eager_persist_to_file("cache/get_partial_one_run_smd_area/",
+    excluded = PERFORMANCE_KWARGS, collective = True, config_fields = CACHE_CONFIG_FIELDS,
+    depends_on = CACHE_DEPENDENCIES,
+    strip_event_data = strip_event_data)
+def get_partial_one_run_smd_area(runNum, detid, subregion_index = -1,
+        event_data_getter = None, event_mask = None, deferred_assembly = None,
+        event_data_allgather = False, sigma_max = None, prefetch_depth = None,
+        **kwargs):
+    """
+    Return a RunPartial containing the summed detector readout over all
+    (valid) events in a run, the number of events, and a dict mapping event
+    numbers to the output of event_data_getter. The latter is an
+    eventstore.RunEventData, which moves array-valued event data to disk
+    beyond eventstore.EVENT_DATA_BUDGET bytes.
+
+    deferred_assembly : bool
+        If True and subregion_index selects a single CSPAD quad, raw ASIC data
+        is summed in its native (8, 185, 388) shape and the Allreduce is done
+        on that array; pedestal subtraction and image assembly happen once, on
+        the mean. Frames are still assembled per event if (and only if)
+        event_data_getter is provided. Defaults to config.deferred_assembly.
+        Not compatible with sigma_max, which takes precedence.
+    event_data_allgather : bool
+        Event data is gathered to rank 0 only, and other ranks return an
+        empty dict, unless this is True.
+    sigma_max : float
+        If provided, events whose total counts differ from the run's mean
+        total counts by more than sigma_max standard deviations are excluded.
+        The total count statistics are computed in a first pass over the run
+        by get_pixel_stats_one_run_smd_area, so no frames are stored.
+        Defaults to config.sigma_max.
+    prefetch_depth : int
+        If nonzero, events are read and decoded by a separate thread that
+        stays up to this many events ahead of accumulation (and
+        event_data_getter). Defaults to config.prefetch_depth, or
+        PREFETCH_DEPTH if that isn't set. See prefetchgen.
+    """
+    if prefetch_depth is None:
+        prefetch_depth = getattr(config, 'prefetch_depth', PREFETCH_DEPTH)
+    if deferred_assembly is None:
+        deferred_assembly = getattr(config, 'deferred_assembly', False)
+    if sigma_max is None:
+        sigma_max = getattr(config, 'sigma_max', None)
+    if deferred_assembly and sigma_max is not None and utils.isroot():
+        print "WARNING: deferred_assembly is not supported with sigma_max; frames will be assembled per event."
+    if sigma_max is not None:
+        stats = get_pixel_stats_one_run_smd_area(runNum, detid,
+            subregion_index = subregion_index, event_mask = event_mask)
+        total_min, total_max = stats.clip_bounds(sigma_max)
+    if deferred_assembly and subregion_index is not None and subregion_index >= 0\
+            and sigma_max is None:
+        return get_partial_one_run_smd_area_deferred(runNum, detid,
+            subregion_index = subregion_index, event_data_getter = event_data_getter,
+            event_mask = event_mask, event_data_allgather = event_data_allgather,
+            **kwargs)
+    comm = utils.get_comm()
+    run_mask = eventmask.get_run_mask(event_mask, runNum)
     def event_valid(nevent):
-        if event_mask:
-            run_mask = event_mask[runNum]
-            if nevent in run_mask:
-                return run_mask[nevent]
-            else:
-                return False
-        else:
-            return True
+        return run_mask is None or run_mask[nevent]
     #DIVERTED_CODE = 162
     ds = DataSource('exp=%s:run=%d:idx' % (config.expname, runNum))
     #ds = DataSource('exp=%s:run=%d:smd' % (config.expname, runNum))
     #evtgen = smdgen(ds)
-    evtgen = idxgen(ds)
+    evtgen = chunkgen(ds)
     #ds = DataSource('exp=%s:run=%d:smd:dir=/reg/d/ffb/%s/xtc:live' % (config.expname, runNum, config.exppath))
     det = Detector(config.detinfo_map[detid].device_name, ds.env())
+    if subregion_index is not None and subregion_index >= 0:
+        # Resolve calibration constants once, on rank 0
+        calibcache.get_quad_calibration(det, runNum, detid, subregion_index, comm = comm)
     rank = comm.Get_rank()
     print "rank is", rank
     size = comm.Get_size()
-    event_data = {}
+    event_data = eventstore.RunEventData(runNum)
+    signalsum = None
     events_processed = 0
     last = time()
     last_nevent = 0
+    def read_increment(nevent, evt):
+        # Returns None for masked events and events without detector data
+        if event_valid(nevent):
+            try:
+                return get_area_detector_subregion(subregion_index, det, evt, detid)
+            except AttributeError:
+                return None
+    if prefetch_depth:
+        increments = prefetchgen(evtgen, read_increment, prefetch_depth)
+    else:
+        increments =\
+            ((nevent, read_increment(nevent, evt))
+            for nevent, evt in evtgen)
+    for nevent, increment in increments:
+        if sigma_max is not None and increment is not None:
+            if not (total_min <= np.sum(increment) <= total_max):
+                continue
+        if increment is not None:
+            if signalsum is None:
+                signalsum = np.zeros_like(increment).astype('float')
+            signalsum += increment
+            if event_data_getter:
+                #event_data.append(event_data_getter(increment))
+                event_data[nevent] = event_data_getter(increment, run = runNum, nevent = nevent)
+            events_processed += 1
+        if nevent % 100 == 0:
+            now = time()
+            deltat = now - last
+            deltan = nevent - last_nevent
+            print 'processed event: ', nevent, (deltan/deltat) * size, "rank is: ", rank, "size is: ", size
+            last = now
+            last_nevent = nevent
+    # Ranks that were handed no events (e.g. in runs with fewer than about
+    # EVENT_CHUNK_SIZE * size events) contribute zeros, and all ranks raise
+    # together if no rank found any events.
+    signalsum_final = allreduce_sum(comm, signalsum)
+    events_processed = comm.allreduce(events_processed)
+    if signalsum_final is None or events_processed == 0:
+        raise ValueError("No events found for det: " + str(detid) + ", run: " + str(runNum) + ": " + str(events_processed))
+    if event_data_getter:
+        event_data = utils.gather_event_data(comm, event_data,
+            allgather = event_data_allgather)
+    print "rank is: ", rank
+    if rank == 0:
+        print "processed ", events_processed, "events"
+    return RunPartial(signalsum_final, events_processed, event_data)
+
+
+def get_partial_one_run_smd_area_deferred(runNum, detid, subregion_index = 0,
+        event_data_getter = None, event_mask = None, event_data_allgather = False,
+        **kwargs):
+    """
+    Implementation of get_partial_one_run_smd_area for deferred_assembly = True.
+    """
+    comm = utils.get_comm()
+    run_mask = eventmask.get_run_mask(event_mask, runNum)
+    def event_valid(nevent):
+        return run_mask is None or run_mask[nevent]
+    ds = DataSource('exp=%s:run=%d:idx' % (config.expname, runNum))
+    evtgen = chunkgen(ds)
+    det = Detector(config.detinfo_map[detid].device_name, ds.env())
+    calibcache.get_quad_calibration(det, runNum, detid, subregion_index, comm = comm)
+    rank = comm.Get_rank()
+    event_data = eventstore.RunEventData(runNum)
+    events_processed = 0
+    # Allocated up front so that ranks that see no events can still
+    # participate in the Allreduce.
+    rawsum = np.zeros((8, 185, 388), dtype = 'float')
     for nevent, evt in evtgen:
         if event_valid(nevent):
-            evr = evt.get(EvrData.DataV4, Source('DetInfo(NoDetector.0:Evr.0)'))
             try:
-                increment = get_area_detector_subregion(subregion_index, det, evt, detid)
+                raw = get_area_detector_subregion_raw(subregion_index, det, evt, detid)
             except AttributeError:
                 continue
-            if increment is not None:
-                try:
-                    signalsum += increment
-                except UnboundLocalError:
-                    signalsum = np.zeros_like(increment).astype('float')
-                    signalsum += increment
-                if event_data_getter:
-                    #event_data.append(event_data_getter(increment))
-                    event_data[nevent] = event_data_getter(increment, run = runNum, nevent = nevent)
-                events_processed += 1
-            if nevent % 100 == 0:
-                now = time()
-                deltat = now - last
-                deltan = nevent - last_nevent
-                print 'processed event: ', nevent, (deltan/deltat) * size, "rank is: ", rank, "size is: ", size
-                last = now
-                last_nevent = nevent
-    try:
-        signalsum_final = np.empty_like(signalsum)
-        comm.Allreduce(signalsum, signalsum_final)
-        events_processed = comm.allreduce(events_processed)
-        signalsum_final /= events_processed
-        if event_data_getter:
-            event_data = comm.allgather(event_data)
-        print "rank is: ", rank
-        if rank == 0:
-            print "processed ", events_processed, "events"
-        if event_data:
-            #print event_data
-            #event_data = reduce(lambda x, y: x + y, event_data)
-            print 'before merge'
-            print event_data
-            event_data = utils.merge_dicts(*event_data)
-        return signalsum_final, event_data
-    except UnboundLocalError:
+            rawsum += raw
+            if event_data_getter:
+                frame = assemble_area_detector_subregion(subregion_index, det, runNum, raw, detid)
+                event_data[nevent] = event_data_getter(frame, run = runNum, nevent = nevent)
+            events_processed += 1
+    rawsum_final = np.empty_like(rawsum)
+    comm.Allreduce(rawsum, rawsum_final)
+    events_processed = comm.allreduce(events_processed)
+    if events_processed == 0:
         raise ValueError("No events found for det: " + str(detid) + ", run: " + str(runNum) + ": " + str(events_processed))
+    if rank == 0:
+        print "processed ", events_processed, "events"
+    signal = assemble_area_detector_subregion(subregion_index, det, runNum,
+        rawsum_final / events_processed, detid)
+    if event_data_getter:
+        event_data = utils.gather_event_data(comm, event_data,
+            allgather = event_data_allgather)
+    return RunPartial(signal * events_processed, events_processed, event_data)
+
+
+@utils.eager_persist_to_file("cache/get_pixel_stats_one_run_smd_area/", collective = True,
+    config_fields = CACHE_CONFIG_FIELDS,
+    depends_on = CACHE_DEPENDENCIES)
+def get_pixel_stats_one_run_smd_area(runNum, detid, subregion_index = -1,
+        event_mask = None, **kwargs):
+    """
+    Return a pixelstats.PixelStats accumulator (per-pixel mean, variance,
+    minimum and maximum, and statistics of per-event total counts) over all
+    valid events of a run. The result is merged over all MPI ranks.
+    """
+    comm = utils.get_comm()
+    run_mask = eventmask.get_run_mask(event_mask, runNum)
+    def event_valid(nevent):
+        return run_mask is None or run_mask[nevent]
+    ds = DataSource('exp=%s:run=%d:idx' % (config.expname, runNum))
+    evtgen = chunkgen(ds)
+    read = make_detector_reader(ds, runNum, detid,
+        subregion_index = subregion_index, comm = comm)
+    stats = pixelstats.PixelStats()
+    for nevent, evt in evtgen:
+        if event_valid(nevent):
+            frame = read(evt)
+            if frame is not None:
+                stats.add(frame)
+    stats = stats.allreduce(comm)
+    if stats.n == 0:
+        raise ValueError("No events found for det: " + str(detid) + ", run: " + str(runNum))
+    return stats
 
 
 #@utils.eager_persist_to_file("cache/get_signal_one_run_smd/")
 def get_signal_one_run_smd(runNum, detid, subregion_index = -1,
         event_data_getter = None, event_mask = None, **kwargs):
+    partial = get_partial_one_run_smd(runNum, detid, subregion_index = subregion_index,
+        event_data_getter = event_data_getter, event_mask = event_mask, **kwargs)
+    return partial.signalsum / partial.nevents, partial.event_data
+
+def get_partial_one_run_smd(runNum, detid, subregion_index = -1,
+        event_data_getter = None, event_mask = None, **kwargs):
+    """
+    Return a RunPartial for a single run. Both the area and non-area
+    implementations are cached per run, so that the results for a group of
+    runs can be assembled from cached partials plus any newly added runs.
+    Only run's part of event_mask is passed on, so that cached partials
+    aren't invalidated by changes to the masks of other runs.
+    """
+    event_mask = eventmask.restrict(event_mask, runNum)
     if detid in config.nonarea:
-        return get_signal_one_run_nonarea(runNum, detid,
+        return get_partial_one_run_nonarea(runNum, detid,
             event_data_getter = event_data_getter, event_mask = event_mask, **kwargs)
     else: # Assume detid to be an area detector
-        return get_signal_one_run_smd_area(runNum, detid, subregion_index = subregion_index,
+        return get_partial_one_run_smd_area(runNum, detid, subregion_index = subregion_index,
             event_data_getter = event_data_getter, event_mask = event_mask, **kwargs)
 
 
 
-@utils.eager_persist_to_file("cache/get_signal_many_parallel/")
+@utils.eager_persist_to_file("cache/get_partial_one_run_smd_filtered/", collective = True,
+    excluded = PERFORMANCE_KWARGS,
+    config_fields = CACHE_CONFIG_FIELDS,
+    depends_on = CACHE_DEPENDENCIES,
+    strip_event_data = strip_event_data)
+def get_partial_one_run_smd_filtered(runNum, detid, filter_detid, event_filter,
+        subregion_index = None, event_data_getter = None,
+        event_data_allgather = False, **kwargs):
+    """
+    Single-pass equivalent of evaluating event_filter on filter_detid for
+    every event in a run and then calling get_signal_one_run_smd with the
+    resulting event mask. Each event is read once; both detectors are
+    evaluated on it and only accepted events are accumulated.
+
+    Returns:
+    partial : RunPartial
+        Summed readout of detid over accepted events, the number of accepted
+        events, and a dict mapping their event numbers to the output of
+        event_data_getter.
+    run_mask : eventmask.RunMask
+        Output of event_filter for all events containing filter_detid data.
+
+    event_data and run_mask are only returned in full on rank 0 unless
+    event_data_allgather is True.
+    """
+    comm = utils.get_comm()
+    rank = comm.Get_rank()
+    ds = DataSource('exp=%s:run=%d:idx' % (config.expname, runNum))
+    evtgen = chunkgen(ds)
+    read_filter = make_detector_reader(ds, runNum, filter_detid, comm = comm)
+    if filter_detid == detid and (subregion_index is None or detid in config.nonarea
+            or subregion_index == config.detinfo_map[detid].subregion_index):
+        read_signal = None
+    else:
+        read_signal = make_detector_reader(ds, runNum, detid,
+            subregion_index = subregion_index, comm = comm)
+    signalsum = None
+    events_processed = 0
+    event_data = eventstore.RunEventData(runNum)
+    run_mask = {}
+    for nevent, evt in evtgen:
+        filter_value = read_filter(evt)
+        if filter_value is None:
+            continue
+        accepted = bool(evaluate_event_data_getter(event_filter, filter_detid,
+            filter_value, runNum, nevent))
+        run_mask[nevent] = accepted
+        if not accepted:
+            continue
+        if read_signal is None:
+            value = filter_value
+        else:
+            value = read_signal(evt)
+        if value is None:
+            continue
+        if signalsum is None:
+            signalsum = np.zeros_like(value).astype('float')
+        signalsum += value
+        if event_data_getter:
+            event_data[nevent] = evaluate_event_data_getter(event_data_getter,
+                detid, value, runNum, nevent)
+        events_processed += 1
+    signalsum_final = allreduce_sum(comm, signalsum)
+    events_processed = comm.allreduce(events_processed)
+    if signalsum_final is None or events_processed == 0:
+        raise ValueError("No events found for det: " + str(detid) + ", run: " + str(runNum) + ": " + str(events_processed))
+    if rank == 0:
+        print "processed ", events_processed, "events"
+    run_mask = eventmask.RunMask.from_dict(utils.gather_event_data(comm, run_mask,
+        allgather = event_data_allgather))
+    if event_data_getter:
+        event_data = utils.gather_event_data(comm, event_data,
+            allgather = event_data_allgather)
+    return RunPartial(signalsum_final, events_processed, event_data), run_mask
+
+# Default number of MPI rank groups among which get_signal_many_parallel
+# distributes runs in smd mode, used if config.run_groups isn't set
+RUN_GROUPS = 1
+
+def map_runs(func, runList, run_groups = None, event_data_allgather = False):
+    """
+    Evaluate func on each run number in smd mode, either sequentially or (if
+    run_groups > 1) distributed among run_groups MPI rank groups. In the
+    latter case event data is only returned on rank 0, unless
+    event_data_allgather is True.
+    """
+    if run_groups is None:
+        run_groups = getattr(config, 'run_groups', RUN_GROUPS)
+    if run_groups > 1:
+        if event_data_allgather:
+            return utils.mpimap_grouped(func, runList, run_groups)
+        return utils.mpimap_grouped(func, runList, run_groups, strip = strip_event_data)
+    else:
+        return map(func, runList)
+
+@utils.eager_persist_to_file("cache/get_signal_many_parallel/", excluded = PERFORMANCE_KWARGS,
+    collective = True, config_fields = CACHE_CONFIG_FIELDS,
+    depends_on = CACHE_DEPENDENCIES,
+    strip_event_data = strip_event_data)
 def get_signal_many_parallel(runList, detid, event_data_getter = None,
-    event_mask = None, **kwargs):
+    event_mask = None, run_groups = None, **kwargs):
     """
     Parallel version of get_signal_many
+
+    In smd mode the mean is weighted by the number of events in each run;
+    otherwise each run has equal weight (see merge_run_partials).
+
+    run_groups : int
+        In smd mode, the number of sub-communicators into which COMM_WORLD is
+        split. Runs are distributed among the groups and events among the
+        ranks within each group. Defaults to config.run_groups (or
+        RUN_GROUPS); with a single group
+        runs are processed one after the other by all ranks.
     """
     def mapfunc(run_number):
         return get_signal_one_run(run_number, detid, event_data_getter =
             event_data_getter, event_mask = event_mask, **kwargs)
     def mapfunc_smd(run_number):
-        return get_signal_one_run_smd(run_number, detid, event_data_getter =
+        return get_partial_one_run_smd(run_number, detid, event_data_getter =
             event_data_getter, event_mask = event_mask, **kwargs)
 
     if config.smd:
-        run_data = map(mapfunc_smd, runList)
+        # Runs whose partials are already cached cost only a cache lookup
+        return merge_run_partials(runList, map_runs(mapfunc_smd, runList, run_groups,
+            event_data_allgather = kwargs.get('event_data_allgather', False)))
     else:
         MAXNODES = 14
         pool = ProcessingPool(nodes=min(MAXNODES, len(runList)))
@@ -375,3 +962,114 @@ def get_signal_many_parallel(runList, detid, event_data_getter = None,
     return signal, event_data
 
 
+
+
+@utils.eager_persist_to_file("cache/get_partial_one_run_smd_multi/", collective = True,
+    excluded = PERFORMANCE_KWARGS,
+    config_fields = CACHE_CONFIG_FIELDS,
+    depends_on = CACHE_DEPENDENCIES,
+    strip_event_data = strip_event_data)
+def get_partial_one_run_smd_multi(runNum, detids, event_data_getters = None,
+        event_mask = None, event_data_allgather = False, **kwargs):
+    """
+    Equivalent to calling get_signal_one_run_smd for each detector ID in
+    detids (with the corresponding element of event_data_getters), but with
+    one DataSource and a single traversal of the run's events.
+
+    Area detector subregions are taken from config.detinfo_map. For non-area
+    detectors, event data is keyed by event number. Event data is only
+    returned in full on rank 0 unless event_data_allgather is True.
+
+    Returns a list of RunPartials in the order of detids.
+    """
+    comm = utils.get_comm()
+    rank = comm.Get_rank()
+    run_mask = eventmask.get_run_mask(event_mask, runNum)
+    def event_valid(nevent):
+        return run_mask is None or run_mask[nevent]
+    if event_data_getters is None:
+        event_data_getters = [None] * len(detids)
+    ds = DataSource('exp=%s:run=%d:idx' % (config.expname, runNum))
+    evtgen = chunkgen(ds)
+    readers =\
+        [make_detector_reader(ds, runNum, detid, comm = comm)
+        for detid in detids]
+    signalsums = [None] * len(detids)
+    events_processed = [0] * len(detids)
+    event_data = [eventstore.RunEventData(runNum) for detid in detids]
+    for nevent, evt in evtgen:
+        if not event_valid(nevent):
+            continue
+        for i, (detid, read, getter) in enumerate(zip(detids, readers, event_data_getters)):
+            value = read(evt)
+            if value is None:
+                continue
+            if signalsums[i] is None:
+                signalsums[i] = np.zeros_like(value).astype('float')
+            signalsums[i] += value
+            if getter:
+                event_data[i][nevent] = evaluate_event_data_getter(getter,
+                    detid, value, runNum, nevent)
+            events_processed[i] += 1
+    results = []
+    for i, detid in enumerate(detids):
+        signalsum_final = allreduce_sum(comm, signalsums[i])
+        nevents = comm.allreduce(events_processed[i])
+        if signalsum_final is None or nevents == 0:
+            raise ValueError("No events found for det: " + str(detid) + ", run: " + str(runNum) + ": " + str(nevents))
+        if rank == 0:
+            print detid, ": processed ", nevents, "events"
+        if event_data_getters[i]:
+            detid_event_data = utils.gather_event_data(comm, event_data[i],
+                allgather = event_data_allgather)
+        else:
+            detid_event_data = {}
+        results.append(RunPartial(signalsum_final, nevents, detid_event_data))
+    return results
+
+@utils.eager_persist_to_file("cache/get_signal_many_parallel_multi/", excluded = PERFORMANCE_KWARGS,
+    collective = True, config_fields = CACHE_CONFIG_FIELDS,
+    depends_on = CACHE_DEPENDENCIES,
+    strip_event_data = strip_event_data)
+def get_signal_many_parallel_multi(runList, detids, event_data_getters = None,
+    event_mask = None, run_groups = None, **kwargs):
+    """
+    Multi-detector version of get_signal_many_parallel (smd mode only). See
+    get_partial_one_run_smd_multi.
+
+    Returns a list of (signal, event_data) tuples in the order of detids.
+    """
+    def mapfunc_smd(run_number):
+        return get_partial_one_run_smd_multi(run_number, detids,
+            event_data_getters = event_data_getters,
+            event_mask = eventmask.restrict(event_mask, run_number), **kwargs)
+    run_data = map_runs(mapfunc_smd, runList, run_groups,
+        event_data_allgather = kwargs.get('event_data_allgather', False))
+    return\
+        [merge_run_partials(runList, [run_results[i] for run_results in run_data])
+        for i in range(len(detids))]
+
+@utils.eager_persist_to_file("cache/get_signal_many_parallel_filtered/", excluded = PERFORMANCE_KWARGS,
+    collective = True, config_fields = CACHE_CONFIG_FIELDS,
+    depends_on = CACHE_DEPENDENCIES,
+    strip_event_data = strip_event_data)
+def get_signal_many_parallel_filtered(runList, detid, filter_detid, event_filter,
+    event_data_getter = None, run_groups = None, **kwargs):
+    """
+    Fused filter and signal extraction over many runs (smd mode only). See
+    get_partial_one_run_smd_filtered.
+
+    Returns the mean signal, the event data dict (keyed by run number and
+    then by event number) and the eventmask.EventMask.
+    """
+    def mapfunc_smd(run_number):
+        return get_partial_one_run_smd_filtered(run_number, detid, filter_detid,
+            event_filter, event_data_getter = event_data_getter, **kwargs)
+    run_data = map_runs(mapfunc_smd, runList, run_groups,
+        event_data_allgather = kwargs.get('event_data_allgather', False))
+    partials = [partial for partial, run_mask in run_data]
+    signal, event_data = merge_run_partials(runList, partials)
+    event_mask = eventmask.EventMask(
+        {run_number: run_mask
+        for run_number, (partial, run_mask) in zip(runList, run_data)})
+    return signal, event_data, event_mask
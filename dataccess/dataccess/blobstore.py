@@ -0,0 +1,132 @@
+"""
+Chunked, compressed storage of derived datasets in a storage backend.
+
+A derived dataset's mean frame is split into chunks of whole rows of at most
+CHUNK_BYTES bytes, and its event data into one pair of columns (event
+numbers and values) per run. Each chunk or column is compressed and stored
+as a separate blob whose ID is the sha1 hash of its contents, so identical
+blobs are only stored once. The resulting manifest (a dict of blob IDs,
+dtypes and shapes) is stored in the dataset's catalog document, and the
+data is read back a chunk or run at a time, only when it's accessed.
+"""
+
+import zlib
+import hashlib
+import cPickle
+import collections
+import numpy as np
+
+# Maximum uncompressed size of an array chunk, in bytes
+CHUNK_BYTES = 8 * 1024**2
+
+# zlib compression level (1-9)
+COMPRESSION_LEVEL = 1
+
+
+def put(backend, data):
+    """
+    Compress and store a string, unless an identical blob is already stored.
+    Returns the blob's ID.
+    """
+    compressed = zlib.compress(data, COMPRESSION_LEVEL)
+    blob_id = hashlib.sha1(compressed).hexdigest()
+    if not backend.has_blob(blob_id):
+        backend.put_blob(compressed, blob_id = blob_id)
+    return blob_id
+
+def get(backend, blob_id):
+    return zlib.decompress(backend.get_blob(blob_id))
+
+def put_object(backend, obj):
+    return {'pickle': put(backend, cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))}
+
+def put_array(backend, arr):
+    """
+    Store a numeric ndarray in chunks of whole rows and return its manifest.
+    Other values are pickled into a single blob.
+    """
+    if not isinstance(arr, np.ndarray) or arr.dtype.hasobject or arr.ndim == 0:
+        return put_object(backend, arr)
+    arr = np.ascontiguousarray(arr)
+    row_bytes = max(arr[:1].nbytes, 1)
+    rows_per_chunk = max(1, CHUNK_BYTES // row_bytes)
+    chunks =\
+        [put(backend, arr[start:start + rows_per_chunk].tostring())
+        for start in range(0, max(len(arr), 1), rows_per_chunk)]
+    return {'dtype': arr.dtype.str, 'shape': list(arr.shape),
+        'rows_per_chunk': rows_per_chunk, 'chunks': chunks}
+
+def get_array(backend, manifest, start = None, stop = None):
+    """
+    Return the array (or object) stored under manifest. For chunked arrays,
+    only the chunks holding rows start to stop are read.
+    """
+    if 'pickle' in manifest:
+        return cPickle.loads(get(backend, manifest['pickle']))
+    shape = tuple(manifest['shape'])
+    dtype = np.dtype(str(manifest['dtype']))
+    rows_per_chunk = manifest['rows_per_chunk']
+    start, stop, _ = slice(start, stop).indices(shape[0])
+    stop = max(start, stop)
+    first = start // rows_per_chunk
+    last = -(-stop // rows_per_chunk)
+    pieces =\
+        [np.fromstring(get(backend, blob_id), dtype = dtype).reshape((-1,) + shape[1:])
+        for blob_id in manifest['chunks'][first:last]]
+    if not pieces:
+        return np.empty((0,) + shape[1:], dtype = dtype)
+    offset = first * rows_per_chunk
+    return np.concatenate(pieces)[start - offset: stop - offset]
+
+def put_event_data(backend, event_data):
+    """
+    Store a {run: {nevent: value}} dict and return its manifest: a list
+    of [run, event number manifest, value manifest] entries.
+    """
+    manifest = []
+    for run, run_dict in event_data.iteritems():
+        nevents = sorted(run_dict.keys())
+        values = [run_dict[nevent] for nevent in nevents]
+        try:
+            value_array = np.array(values)
+        except ValueError:
+            value_array = None
+        if value_array is None or value_array.dtype.hasobject:
+            value_manifest = put_object(backend, values)
+        else:
+            value_manifest = put_array(backend, value_array)
+        manifest.append([run, put_array(backend, np.array(nevents, dtype = 'int64')),
+            value_manifest])
+    return manifest
+
+
+class LazyEventData(collections.Mapping):
+    """
+    {run: {nevent: value}} mapping backed by an event data manifest. A run's
+    data is read the first time it's accessed.
+
+    Pickles as a plain dict.
+    """
+    def __init__(self, backend, manifest):
+        self.backend = backend
+        self.manifest = {run: (nevents, values) for run, nevents, values in manifest}
+        self.loaded = {}
+
+    def __getitem__(self, run):
+        if run not in self.loaded:
+            nevent_manifest, value_manifest = self.manifest[run]
+            nevents = get_array(self.backend, nevent_manifest).tolist()
+            values = get_array(self.backend, value_manifest)
+            if isinstance(values, np.ndarray) and values.ndim == 1:
+                values = values.tolist()
+            self.loaded[run] = dict(zip(nevents, values))
+        return self.loaded[run]
+
+    def __iter__(self):
+        return iter(self.manifest)
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __reduce__(self):
+        return (dict, (), None, None, self.iteritems())
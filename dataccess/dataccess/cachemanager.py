@@ -0,0 +1,562 @@
+"""
+Size-bounded storage for utils.eager_persist_to_file.
+
+Cached values are kept in two tiers:
+    -memory: a least-recently-used store shared by all decorated functions,
+    holding at most MEMORY_BUDGET bytes of values.
+    -disk: one pickle file per call. Large arrays within a value are stored
+    next to it in a single sidecar file (see dump and load), which is
+    memory-mapped once when the value is loaded. If DISK_BUDGET or DISK_MAX_AGE is set, files are evicted, least
+    recently used first, once their total size exceeds DISK_BUDGET bytes or
+    they haven't been used for DISK_MAX_AGE seconds.
+
+Hit, miss and byte counts are recorded per decorated function; see report().
+
+Each cache file is accompanied by a JSON .meta file recording the call that
+produced it. main() uses these to list, size, verify and prune cache files
+by function, label or run (see the 'cache' sub-command of mecana).
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import cPickle
+from collections import OrderedDict
+import numpy as np
+import segmentstore
+
+# Maximum total size, in bytes, of values held in memory
+MEMORY_BUDGET = 4 * 1024**3
+
+# Maximum total size, in bytes, of cache files. None means unlimited.
+DISK_BUDGET = None
+
+# Age, in seconds since last use, after which cache files are deleted. None
+# means unlimited.
+DISK_MAX_AGE = None
+
+# Directory searched for cache files by main()
+CACHE_ROOT = 'cache/'
+
+# Arrays of at least this many bytes are stored in the value's sidecar file
+SIDECAR_MIN_BYTES = 1024**2
+
+# Name of the sidecar file within sidecar_dir(path)
+SIDECAR_NAME = 'arrays.bin'
+
+# Alignment, in bytes, of arrays within a sidecar file
+SIDECAR_ALIGNMENT = 64
+
+# np.load mmap_mode for sidecar arrays. Copy-on-write, so that callers can
+# modify loaded arrays in place without affecting the cache.
+SIDECAR_MMAP_MODE = 'c'
+
+
+def sidecar_dir(path):
+    """
+    Directory holding the sidecar file of the cache file path.
+    """
+    return path + '.arrays'
+
+def dump(value, path, pickler = cPickle):
+    """
+    Write value to path. Plain numeric ndarrays of at least SIDECAR_MIN_BYTES
+    within value are written, one after the other, to the single file
+    SIDECAR_NAME in sidecar_dir(path) and referenced from the pickle by
+    (offset, dtype, shape, fortran order); everything else is pickled with
+    the given pickle module (cPickle or dill).
+
+    The pickle file and sidecar directory are written under temporary names
+    and then renamed into place.
+    """
+    tmp_suffix = '.tmp%d' % os.getpid()
+    tmp_dir = sidecar_dir(path) + tmp_suffix
+    # id -> (array, persistent id). The arrays are kept alive so that their
+    # ids aren't reused while pickling.
+    ids = {}
+    state = {'sidecar': None}
+    def persistent_id(obj):
+        if type(obj) in (np.ndarray, np.memmap) and obj.dtype.kind in 'biufc'\
+                and obj.nbytes >= SIDECAR_MIN_BYTES:
+            if id(obj) not in ids:
+                if state['sidecar'] is None:
+                    os.makedirs(tmp_dir)
+                    state['sidecar'] = open(os.path.join(tmp_dir, SIDECAR_NAME), 'wb')
+                f = state['sidecar']
+                f.write('\0' * (-f.tell() % SIDECAR_ALIGNMENT))
+                offset = f.tell()
+                fortran = obj.flags.f_contiguous and not obj.flags.c_contiguous
+                if fortran:
+                    np.ascontiguousarray(obj.T).tofile(f)
+                else:
+                    np.ascontiguousarray(obj).tofile(f)
+                ids[id(obj)] = (obj, (offset, obj.dtype.str, obj.shape, fortran))
+            return ids[id(obj)][1]
+        return None
+    try:
+        with open(path + tmp_suffix, 'wb') as f:
+            p = pickler.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+            p.persistent_id = persistent_id
+            p.dump(value)
+    finally:
+        if state['sidecar'] is not None:
+            state['sidecar'].close()
+    if os.path.isdir(sidecar_dir(path)):
+        shutil.rmtree(sidecar_dir(path), ignore_errors = True)
+    if ids:
+        os.rename(tmp_dir, sidecar_dir(path))
+    os.rename(path + tmp_suffix, path)
+
+def load(path, pickler = cPickle):
+    """
+    Load a value written by dump (or by a plain pickle.dump). All of its
+    sidecar arrays are views of a single memory map of the sidecar file.
+    """
+    directory = sidecar_dir(path)
+    arrays = {}
+    state = {'buffer': None}
+    def persistent_load(pid):
+        if pid in arrays:
+            return arrays[pid]
+        if isinstance(pid, str):
+            # Written by an earlier version of dump, with one .npy file per
+            # array
+            arrays[pid] = np.load(os.path.join(directory, pid), mmap_mode = SIDECAR_MMAP_MODE)
+            return arrays[pid]
+        if state['buffer'] is None:
+            state['buffer'] = np.memmap(os.path.join(directory, SIDECAR_NAME),
+                dtype = np.uint8, mode = SIDECAR_MMAP_MODE)
+        offset, dtype, shape, fortran = pid
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        arr = state['buffer'][offset:offset + nbytes].view(dtype)
+        if fortran:
+            arr = arr.reshape(shape[::-1]).T
+        else:
+            arr = arr.reshape(shape)
+        arrays[pid] = arr
+        return arr
+    with open(path, 'rb') as f:
+        u = pickler.Unpickler(f)
+        u.persistent_load = persistent_load
+        return u.load()
+
+def meta_path(path):
+    """
+    Path of the metadata file of the cache file path.
+    """
+    return path + '.meta'
+
+def write_meta(path, meta):
+    """
+    Write the dict meta as the metadata of the cache file path.
+    """
+    tmp_name = meta_path(path) + '.tmp%d' % os.getpid()
+    with open(tmp_name, 'w') as f:
+        json.dump(meta, f)
+    os.rename(tmp_name, meta_path(path))
+
+def read_meta(path):
+    """
+    Return the metadata dict of the cache file path, or None if it has none.
+    """
+    try:
+        with open(meta_path(path), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def remove(path):
+    """
+    Delete a cache file and its sidecar and metadata files.
+    """
+    for name in (path, meta_path(path)):
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+    shutil.rmtree(sidecar_dir(path), ignore_errors = True)
+
+def file_size(path):
+    """
+    Total size of a cache file and its sidecar and metadata files.
+    """
+    size = os.path.getsize(path)
+    if os.path.isfile(meta_path(path)):
+        size += os.path.getsize(meta_path(path))
+    directory = sidecar_dir(path)
+    if os.path.isdir(directory):
+        size += sum(os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory))
+    return size
+
+
+def sizeof(obj):
+    """
+    Estimate the memory footprint of a cached value, in bytes. Memory-mapped
+    arrays count as zero.
+    """
+    if isinstance(obj, np.memmap):
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(getattr(obj, 'nbytes', None), (int, long)):
+        # e.g. eventstore.RunEventData
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sizeof(k) + sizeof(v) for k, v in obj.iteritems())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(sizeof(x) for x in obj)
+    if hasattr(obj, '__dict__'):
+        return sys.getsizeof(obj) + sizeof(vars(obj))
+    return sys.getsizeof(obj)
+
+
+class CacheStats(object):
+    """
+    Cache access statistics for one decorated function.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def resident_bytes(self):
+        """
+        Size of this function's values currently held in memory.
+        """
+        return memory.owner_bytes(self.name)
+
+    def __repr__(self):
+        return ('%s: %d memory hits, %d disk hits, %d misses, %d bytes read, '
+            '%d bytes written, %d bytes in memory') % (self.name, self.memory_hits,
+            self.disk_hits, self.misses, self.bytes_read, self.bytes_written,
+            self.resident_bytes())
+
+
+class MemoryLRU(object):
+    """
+    In-memory cache with a byte budget, evicting least recently used values
+    first. Values larger than the budget aren't stored.
+    """
+    def __init__(self, budget = None):
+        self.budget = budget
+        # key -> (value, nbytes, owner)
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def get_budget(self):
+        return MEMORY_BUDGET if self.budget is None else self.budget
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        entry = self.entries.pop(key)
+        self.entries[key] = entry
+        return entry[0]
+
+    def put(self, key, value, owner = None):
+        if key in self.entries:
+            self.discard(key)
+        nbytes = sizeof(value)
+        if nbytes > self.get_budget():
+            return
+        self.entries[key] = (value, nbytes, owner)
+        self.nbytes += nbytes
+        while self.nbytes > self.get_budget():
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        if key in self.entries:
+            value, nbytes, owner = self.entries.pop(key)
+            self.nbytes -= nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def owner_bytes(self, owner):
+        return sum(nbytes for value, nbytes, o in self.entries.itervalues() if o == owner)
+
+
+class DiskTier(object):
+    """
+    Tracks the cache files written under registered file name prefixes and
+    evicts them according to DISK_BUDGET and DISK_MAX_AGE.
+    """
+    def __init__(self):
+        self.prefixes = set()
+        # Total size of cache files; computed on first use
+        self.nbytes = None
+
+    def register(self, file_name):
+        self.prefixes.add(file_name)
+        self.nbytes = None
+
+    def entries(self):
+        """
+        Return a list of (path, size, last use time) for all cache files.
+        """
+        result = []
+        for prefix in self.prefixes:
+            dirname, base = os.path.split(prefix)
+            try:
+                names = os.listdir(dirname or '.')
+            except OSError:
+                continue
+            for name in names:
+                if name.startswith(base) and not name.endswith(('.arrays', '.meta'))\
+                        and '.tmp' not in name:
+                    path = os.path.join(dirname, name)
+                    try:
+                        st = os.stat(path)
+                        size = file_size(path)
+                    except OSError:
+                        continue
+                    result.append((path, size, max(st.st_atime, st.st_mtime)))
+        return result
+
+    def touch(self, path):
+        """
+        Mark a cache file as recently used.
+        """
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def add(self, path):
+        """
+        Account for a newly written cache file and evict files if necessary.
+        """
+        if DISK_BUDGET is None and DISK_MAX_AGE is None:
+            return
+        if self.nbytes is None:
+            self.evict()
+            return
+        self.nbytes += file_size(path)
+        if DISK_BUDGET is not None and self.nbytes > DISK_BUDGET:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete cache files older than DISK_MAX_AGE, then the least recently
+        used ones until their total size is below DISK_BUDGET.
+
+        Returns the list of deleted paths.
+        """
+        now = time.time()
+        deleted = []
+        remaining = []
+        for path, size, used in sorted(self.entries(), key = lambda e: e[2]):
+            if DISK_MAX_AGE is not None and now - used > DISK_MAX_AGE:
+                deleted.append(path)
+            else:
+                remaining.append((path, size))
+        total = sum(size for path, size in remaining)
+        for path, size in remaining:
+            if DISK_BUDGET is None or total <= DISK_BUDGET:
+                break
+            deleted.append(path)
+            total -= size
+        for path in deleted:
+            remove(path)
+            memory.discard(path)
+        self.nbytes = total
+        return deleted
+
+
+memory = MemoryLRU()
+disk = DiskTier()
+
+# Maps decorated functions' file name prefixes to their CacheStats
+stats = {}
+
+def get_stats(file_name):
+    if file_name not in stats:
+        stats[file_name] = CacheStats(file_name)
+    return stats[file_name]
+
+def report():
+    """
+    Print cache statistics for all decorated functions that have been called.
+    """
+    print 'memory cache: %d values, %d bytes' % (len(memory.entries), memory.nbytes)
+    for name in sorted(stats):
+        s = stats[name]
+        if s.memory_hits or s.disk_hits or s.misses:
+            print s
+
+
+# Maps decorated functions' file name prefixes to (function name, provenance
+# function). The provenance function returns the source and config hashes
+# that the function's current cache keys depend on.
+functions = {}
+
+def register_function(file_name, func_name, provenance):
+    functions[file_name] = (func_name, provenance)
+
+def find_entries(root = None):
+    """
+    Return a list of (path, metadata) for all cache files under root
+    (CACHE_ROOT by default). Cache files of registered functions that
+    predate metadata files are included with metadata None.
+    """
+    if root is None:
+        root = CACHE_ROOT
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.endswith('.arrays')]
+        for name in filenames:
+            if name.endswith('.meta'):
+                path = os.path.join(dirpath, name[:-len('.meta')])
+                if os.path.isfile(path):
+                    result[path] = read_meta(path)
+    for path, size, used in disk.entries():
+        if os.path.normpath(path).startswith(os.path.normpath(root))\
+                and path not in result:
+            result[path] = None
+    return sorted(result.items())
+
+def entry_function(path, meta):
+    if meta is not None:
+        return meta['function']
+    for prefix, (func_name, provenance) in functions.iteritems():
+        if path.startswith(prefix):
+            return func_name
+    return '?'
+
+def entry_matches(path, meta, function = None, label = None, run = None):
+    """
+    Return True if the cache file path is the value of a call of the named
+    function with label, or run, among its arguments. Files without
+    metadata only match if no condition is given.
+    """
+    if function is None and label is None and run is None:
+        return True
+    if meta is None:
+        return False
+    if function is not None and function not in (meta['function'], meta['prefix']):
+        return False
+    values = meta['args'] + meta['kwargs'].values()
+    if label is not None and label not in values:
+        return False
+    if run is not None and not any(v == run or (isinstance(v, list) and run in v)
+            for v in values):
+        return False
+    return True
+
+def is_stale(path, meta):
+    """
+    Return True if the cache file path can no longer be returned by its
+    function because the function's source or config fields have changed
+    since it was written, False if it can, and None if this can't be
+    determined (the function isn't registered).
+
+    Files without metadata predate source and config hashing and are
+    always stale.
+    """
+    if meta is None:
+        return True
+    if meta['prefix'] not in functions:
+        return None
+    func_name, provenance = functions[meta['prefix']]
+    current = provenance()
+    return current['source'] != meta['source'] or current['config'] != meta['config']
+
+def verify_entry(path):
+    """
+    Load the cache file path, returning None if it's readable and an error
+    message otherwise.
+    """
+    try:
+        load(path)
+    except Exception, e:
+        return '%s: %s' % (type(e).__name__, e)
+    return None
+
+def compact_stores(root = None):
+    """
+    Compact all segmentstore.SegmentStores under root (CACHE_ROOT by
+    default).
+    """
+    if root is None:
+        root = CACHE_ROOT
+    for dirpath, dirnames, filenames in os.walk(root):
+        if segmentstore.INDEX_NAME in filenames:
+            freed = segmentstore.SegmentStore(dirpath).compact()
+            print '%s: compacted, %d bytes freed' % (dirpath, freed)
+
+def main(action, function = None, label = None, run = None, stale = False, root = None):
+    """
+    Inspect or delete cache files.
+
+    action : str
+        'list': print each cache file with its function, size, age and
+            arguments.
+        'size': print the total size of cache files per function.
+        'verify': load each cache file and report unreadable and stale ones.
+        'prune': delete cache files.
+        'compact': compact the segmentstore.SegmentStores of
+            utils.persist_to_file under root. Other processes must not use
+            them meanwhile.
+    function, label, run : select the cache files of calls of the named
+        function, or with label or run among their arguments.
+    stale : boolean
+        Only select stale cache files (see is_stale).
+    """
+    if action == 'compact':
+        compact_stores(root)
+        return
+    entries = [(path, meta) for path, meta in find_entries(root)
+        if entry_matches(path, meta, function = function, label = label, run = run)
+        and (not stale or is_stale(path, meta))]
+    if action == 'list':
+        now = time.time()
+        for path, meta in entries:
+            size = file_size(path)
+            age = (now - os.path.getmtime(path)) / 3600.
+            if meta is None:
+                arguments = '(no metadata)'
+            else:
+                arguments = ', '.join(map(str, meta['args']) +
+                    ['%s=%s' % item for item in sorted(meta['kwargs'].items())])
+            print '%s\t%s\t%d bytes\t%.1f h\t%s' % (entry_function(path, meta),
+                path, size, age, arguments)
+    elif action == 'size':
+        sizes = {}
+        for path, meta in entries:
+            name = entry_function(path, meta)
+            count, size = sizes.get(name, (0, 0))
+            sizes[name] = (count + 1, size + file_size(path))
+        for name in sorted(sizes):
+            print '%s: %d files, %d bytes' % ((name,) + sizes[name])
+        print 'total: %d files, %d bytes' % (len(entries),
+            sum(size for count, size in sizes.itervalues()))
+    elif action == 'verify':
+        nbad = 0
+        for path, meta in entries:
+            error = verify_entry(path)
+            if error is not None:
+                print 'unreadable: %s (%s)' % (path, error)
+                nbad += 1
+            elif is_stale(path, meta):
+                print 'stale: %s' % path
+                nbad += 1
+        print '%d of %d cache files unreadable or stale' % (nbad, len(entries))
+    elif action == 'prune':
+        if function is None and label is None and run is None and not stale:
+            raise ValueError("prune requires at least one of function, label, run or stale")
+        nbytes = 0
+        for path, meta in entries:
+            nbytes += file_size(path)
+            remove(path)
+        print 'deleted %d cache files, %d bytes' % (len(entries), nbytes)
+    else:
+        raise ValueError("Invalid cache action: " + action)
@@ -0,0 +1,130 @@
+"""
+Per-run cache of the calibration constants and geometry needed to turn raw
+quad CSPAD data into pedestal-subtracted, assembled images.
+
+A QuadCalibration is resolved once per (run, detector, quad), kept in memory
+for the rest of the interpreter session and persisted to CALIB_DIR, so that
+extracting a frame costs a raw read plus a single scatter into the image.
+"""
+
+import os
+import numpy as np
+
+import config
+
+# Directory in which resolved calibrations are persisted
+CALIB_DIR = 'cache/calibcache/'
+
+# Quad CSPAD raw data shape: (quads, ASICs per quad, rows, columns)
+CSPAD_RAW_SHAPE = (4, 8, 185, 388)
+
+# In-memory cache, keyed by (run, device name, quad)
+calibrations = {}
+
+
+class QuadCalibration(object):
+    """
+    Pixel coordinate indexes, pedestals and assembly scatter indices for a
+    single quad of a CSPAD in a single run.
+    """
+    def __init__(self, iX, iY, pedestals):
+        """
+        iX, iY : np.ndarray
+            Pixel coordinate index arrays for the quad, shape (8, 185, 388).
+        pedestals : np.ndarray
+            Pedestals for the quad, shape (8, 185, 388).
+        """
+        self.iX = iX
+        self.iY = iY
+        self.pedestals = pedestals
+        # Equivalent to what img_from_pixel_arrays computes on every call
+        self.shape = (int(iX.max()) + 1, int(iY.max()) + 1)
+        self.flat_index = np.ravel_multi_index((iX.ravel(), iY.ravel()), self.shape)
+
+    def assemble(self, W):
+        """
+        Scatter an array of per-pixel values (shape (8, 185, 388)) into an
+        assembled image. Same output as img_from_pixel_arrays(iX, iY, W = W).
+        """
+        img = np.zeros(self.shape, dtype = W.dtype)
+        img.flat[self.flat_index] = W.ravel()
+        return img
+
+    def subtract_and_assemble(self, raw):
+        """
+        Subtract pedestals from raw quad data and assemble the result.
+        """
+        return self.assemble(raw - self.pedestals)
+
+    def save(self, path):
+        dirname = os.path.dirname(path)
+        if dirname and (not os.path.exists(dirname)):
+            os.system('mkdir -p ' + dirname)
+        # Write to a temporary file first so that concurrent readers never see
+        # a partially-written file.
+        tmp_path = path + '.tmp%d' % os.getpid()
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, iX = self.iX, iY = self.iY, pedestals = self.pedestals)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        archive = np.load(path)
+        return cls(archive['iX'], archive['iY'], archive['pedestals'])
+
+
+def calibration_path(runNum, device_name, quad):
+    name = '%s_%04d_%s_%d.npz' % (config.expname, runNum, device_name, quad)
+    return CALIB_DIR + name.replace(':', '_')
+
+def resolve_quad_calibration(det, runNum, quad):
+    """
+    Query psana for a quad's pixel coordinate indexes and pedestals.
+    """
+    geo = det.geometry(runNum)
+    iX, iY = geo.get_pixel_coord_indexes('QUAD:V1', quad)
+    ped = det.pedestals(runNum)
+    ped.shape = CSPAD_RAW_SHAPE
+    return QuadCalibration(iX, iY, ped[quad,:])
+
+def get_quad_calibration(det, runNum, detid, quad, comm = None):
+    """
+    Return the QuadCalibration for a run, detector ID and quad index, in order
+    of preference from: the in-memory cache, CALIB_DIR, and psana.
+
+    comm : mpi4py communicator
+        If provided, this function is collective over comm: only its rank 0
+        goes to disk or psana, and the result is broadcast to the other ranks.
+        Since calls without comm fill the in-memory cache of some ranks only,
+        the ranks agree on whether all of them hold the calibration before
+        any of them returns it from memory.
+    """
+    if quad > 3:
+        quad = 3
+    key = (runNum, config.detinfo_map[detid].device_name, quad)
+    cached = key in calibrations
+    if comm is not None:
+        cached = all(comm.allgather(cached))
+    if cached:
+        return calibrations[key]
+    def lookup():
+        if key in calibrations:
+            return calibrations[key]
+        path = calibration_path(*key)
+        try:
+            return QuadCalibration.load(path)
+        except (IOError, ValueError, KeyError):
+            calib = resolve_quad_calibration(det, runNum, quad)
+            calib.save(path)
+            return calib
+    if comm is None:
+        calib = lookup()
+    else:
+        if comm.Get_rank() == 0:
+            calib = lookup()
+            arrays = (calib.iX, calib.iY, calib.pedestals)
+        else:
+            arrays = None
+        calib = QuadCalibration(*comm.bcast(arrays, root = 0))
+    calibrations[key] = calib
+    return calib
@@ -94,5 +94,27 @@ nonarea = {}
 
 # TODO (maybe): parameters for XES script
 
+# Storage for logbook data and derived datasets: either 'mongo' (the MongoDB
+# server on the LCLS login nodes) or 'local' (a SQLite database and blob
+# directory under database_path, for offline analysis).
+database_backend = 'mongo'
+database_path = 'db/local/'
+
 # Size in microns of the beam spot at best focus
 best_focus_size = 2.
+
+# Event processing options for smd mode (see avg_bgsubtract_hdf):
+#   -deferred_assembly: if True, single-quad CSPAD data is summed in its raw
+#   shape, and pedestal subtraction and image assembly are done once, on the
+#   mean.
+#   -sigma_max: if not None, events whose total counts differ from their
+#   run's mean by more than sigma_max standard deviations are excluded.
+#   Takes precedence over deferred_assembly.
+#   -run_groups: number of MPI rank groups among which runs are distributed.
+#   -prefetch_depth: number of events read ahead by a separate thread (0
+#   disables prefetching; requires MPI thread support).
+# run_groups and prefetch_depth only affect performance.
+deferred_assembly = False
+sigma_max = None
+run_groups = 1
+prefetch_depth = 0
@@ -16,6 +16,8 @@ import hashlib
 import utils
 import logbook
 import database
+import eventmask
+import lineage
 import config
 
 # TODO: make logbook data not required for labels that can be parsed as run
@@ -54,7 +56,23 @@ def get_all_runs(exppath = config.exppath):
     return result
 
 
-@utils.eager_persist_to_file('cache/data_access/get_label_data/')
+def label_runs_key(label, *args, **kwargs):
+    """
+    Cache key component for functions of a dataset label: the label's runs,
+    so that cached values are recomputed (from cached per-run partials plus
+    those of any new runs) when runs are added to the label. None for
+    derived dataset labels.
+    """
+    try:
+        return tuple(logbook.get_all_runlist(label))
+    except ValueError:
+        return None
+
+@utils.eager_persist_to_file('cache/data_access/get_label_data/', collective = True,
+    excluded = avg_bgsubtract_hdf.PERFORMANCE_KWARGS,
+    config_fields = avg_bgsubtract_hdf.CACHE_CONFIG_FIELDS,
+    depends_on = avg_bgsubtract_hdf.CACHE_DEPENDENCIES, extra_key = label_runs_key,
+    strip_event_data = avg_bgsubtract_hdf.strip_event_data)
 def get_label_data(label, detid, default_bg = None, override_bg = None,
     event_data_getter = None, event_mask = None, **kwargs):
     """
@@ -97,22 +115,125 @@ def get_label_data(label, detid, default_bg = None, override_bg = None,
         return signal, event_data
         #print "event data is: ", event_data
 
+def get_label_data_multi(label, detids, event_data_getters = None, event_mask = None):
+    """
+    Equivalent to calling get_label_data(label, detid, ...) for each
+    detector ID in detids, with the corresponding element of
+    event_data_getters (which defaults to None for all detectors).
+
+    In smd mode, the values not already cached are extracted in a single
+    pass over the label's events, and each is then cached under the same key
+    as the corresponding get_label_data call.
+
+    Returns a list of (signal, event_data) tuples in the order of detids.
+    """
+    if event_data_getters is None:
+        event_data_getters = [None] * len(detids)
+    def label_data_kwargs(event_data_getter):
+        return {'event_data_getter': event_data_getter, 'event_mask': event_mask}
+    results = [None] * len(detids)
+    # indices of the detectors whose data isn't cached
+    missing = []
+    for i, (detid, event_data_getter) in enumerate(zip(detids, event_data_getters)):
+        try:
+            results[i] = get_label_data.cached(label, detid,
+                **label_data_kwargs(event_data_getter))
+        except KeyError:
+            missing.append(i)
+    try:
+        runList = logbook.get_all_runlist(label)
+    except ValueError:
+        # derived dataset
+        runList = None
+    if missing and config.smd and runList is not None:
+        outputs = avg_bgsubtract_hdf.get_signal_many_parallel_multi(
+            runList, [detids[i] for i in missing],
+            event_data_getters = [event_data_getters[i] for i in missing],
+            event_mask = event_mask)
+        for i, (signal, event_data) in zip(missing, outputs):
+            if event_data_getters[i] is None:
+                event_data = None
+            results[i] = (signal, event_data)
+            get_label_data.cache_put(results[i], label, detids[i],
+                **label_data_kwargs(event_data_getters[i]))
+    else:
+        for i in missing:
+            results[i] = get_label_data(label, detids[i],
+                **label_data_kwargs(event_data_getters[i]))
+    return results
+
+@utils.eager_persist_to_file('cache/data_access/get_label_data_filtered/', collective = True,
+    excluded = avg_bgsubtract_hdf.PERFORMANCE_KWARGS,
+    config_fields = avg_bgsubtract_hdf.CACHE_CONFIG_FIELDS,
+    depends_on = avg_bgsubtract_hdf.CACHE_DEPENDENCIES, extra_key = label_runs_key,
+    strip_event_data = avg_bgsubtract_hdf.strip_event_data)
+def get_label_data_filtered(label, detid, event_filter, event_filter_detid,
+    event_data_getter = None, **kwargs):
+    """
+    Single-pass alternative to computing an event mask with
+    get_label_data(label, event_filter_detid, event_data_getter = event_filter)
+    and then passing it to get_label_data(label, detid, ...). Only available
+    in smd mode and for labels that correspond to groups of runs.
+
+    Returns:
+    signal : np.ndarray
+        The detector readout averaged over all accepted events.
+    event_data : dict
+        Output of event_data_getter for the accepted events.
+    event_mask : eventmask.EventMask
+        Output of event_filter for all events.
+    """
+    runList = logbook.get_all_runlist(label)
+    if detid in config.nonarea:
+        subregion_index = None
+    else:
+        subregion_index = config.detinfo_map[detid].subregion_index
+    signal, event_data, event_mask =\
+        avg_bgsubtract_hdf.get_signal_many_parallel_filtered(
+            runList, detid, event_filter_detid, event_filter,
+            event_data_getter = event_data_getter,
+            subregion_index = subregion_index, **kwargs)
+    if event_data_getter is None:
+        return signal, None, event_mask
+    else:
+        return signal, event_data, event_mask
+
 #@utils.eager_persist_to_file('cache/data_access/get_label_data_and_filter/')
 def get_data_and_filter_logbook(label, detid, event_data_getter = None,
-    event_filter = None, event_filter_detid = None):
+    event_filter = None, event_filter_detid = None, event_data_allgather = False):
     """
     # TODO: update this. Make it clear that this function is the public interface.
+
+    Event data is only returned in full on the root MPI rank unless
+    event_data_allgather is True.
+
+    The returned array is a lineage.LineageArray tagged with the label, its
+    runs, detid, the event filter (including the filter function's source),
+    the background label and its runs, and fingerprints of the extraction
+    code (this module and avg_bgsubtract_hdf.CACHE_DEPENDENCIES) and of the
+    config.py settings it depends on.
     """
     def get_background():
         """
-        Returns background frame.
+        Returns background label and frame.
 
         Raises KeyError if background label is not found.
         """
         bg_label = get_dataset_attribute_value(label, 'background')
         print "using dark subtraction: ", bg_label
         bg, _ =  get_label_data(bg_label, detid)
-        return bg
+        return bg_label, bg
+    def make_lineage(filter_key, bg_label):
+        # label_runs_key gives None for derived dataset labels
+        if bg_label is None:
+            bg_runs = None
+        else:
+            bg_runs = label_runs_key(bg_label)
+        return ('get_data_and_filter', label, label_runs_key(label),
+            detid, filter_key, bg_label, bg_runs,
+            utils.source_fingerprint(sys.modules[__name__],
+                avg_bgsubtract_hdf.CACHE_DEPENDENCIES),
+            utils.config_fingerprint(avg_bgsubtract_hdf.CACHE_CONFIG_FIELDS))
     def get_event_mask(filterfunc, detid = None):
         """
         TODO
@@ -120,53 +241,78 @@ def get_data_and_filter_logbook(label, detid, event_data_getter = None,
         # filterfunc is a function that takes a np array and returns a boolean
         if detid is None:
             detid = get_dataset_attribute_value(label, 'filter_det')
+        # The mask is needed by all MPI ranks
         imarray, event_data = get_label_data(label, detid,
-            event_data_getter = filterfunc)
-        return event_data
+            event_data_getter = filterfunc, event_data_allgather = True)
+        return eventmask.EventMask.from_dict(event_data)
+
+    # Only passed if set, so that cache keys of the default case don't change
+    if event_data_allgather:
+        allgather_kwargs = {'event_data_allgather': True}
+    else:
+        allgather_kwargs = {}
+
+    def print_mask_summary(event_mask):
+        print "Event mask True entries: ", event_mask.count(), "Total number of events: ", event_mask.nevents()
 
     try:
         if event_filter:
             ipdb.set_trace()
-            event_mask = get_event_mask(event_filter, detid = event_filter_detid)
+            filterfunc, filter_detid = event_filter, event_filter_detid
+            if filter_detid is None:
+                filter_detid = get_dataset_attribute_value(label, 'filter_det')
+            filter_key = (utils.make_hashable(filterfunc),
+                utils.source_fingerprint(filterfunc), filter_detid)
         else:
             args = logbook.eventmask_params(label)
             try:
                 funcstr = get_dataset_attribute_value(label, 'filter_func')
-                filterfunc = eval('config.' + funcstr)(*args)
+                filter_factory = eval('config.' + funcstr)
+                filterfunc = filter_factory(*args)
                 filter_detid = get_dataset_attribute_value(label, 'filter_det')
+                filter_key = (funcstr, utils.source_fingerprint(filter_factory),
+                    tuple(args), filter_detid)
                 print "DETID IS ", filter_detid
                 print "ARGS ARE ", args
                 print "FUNCSTR IS", funcstr
             except AttributeError:
                 raise ValueError("Function " + funcstr + " not found, and no filter_function/filter_detid in config.py")
+        if config.smd:
+            # Evaluate the filter and extract the signal in a single pass
+            imarray, event_data, event_mask = get_label_data_filtered(label,
+                detid, filterfunc, filter_detid, event_data_getter = event_data_getter,
+                **allgather_kwargs)
+            print_mask_summary(event_mask)
+        else:
             event_mask = get_event_mask(filterfunc, detid = filter_detid)
-        merged_mask = utils.merge_dicts(*event_mask.values())
-        sum_true = sum(map(lambda d2: sum(d2.values()), event_mask.values()))
-        n_events = sum(map(lambda d: len(d.keys()), event_mask.values()))
-        print "Event mask True entries: ", sum_true, "Total number of events: ", n_events
-        imarray, event_data =  get_label_data(label, detid,
-            event_data_getter = event_data_getter, event_mask = event_mask)
+            print_mask_summary(event_mask)
+            imarray, event_data =  get_label_data(label, detid,
+                event_data_getter = event_data_getter, event_mask = event_mask,
+                **allgather_kwargs)
     except Exception, e:
         if utils.isroot():
             print "!!!!!!!!!!!!!!!!!!"
             print "WARNING: Event filtering will not be performed."
             print e
             print "!!!!!!!!!!!!!!!!!!"
+        filter_key = None
         imarray, event_data =  get_label_data(label, detid,
-            event_data_getter = event_data_getter)
+            event_data_getter = event_data_getter, **allgather_kwargs)
     try:
-        bg = get_background()
-        return imarray - bg, event_data
+        bg_label, bg = get_background()
+        imarray = imarray - bg
     except KeyError:
         if utils.isroot():
             print "No background label found"
-        return imarray, event_data
+        bg_label = None
+    return lineage.tag(imarray, make_lineage(filter_key, bg_label)), event_data
 
 def get_data_and_filter(label, detid, event_data_getter = None,
-    event_filter = None, event_filter_detid = None):
+    event_filter = None, event_filter_detid = None, event_data_allgather = False):
     try:
         return get_data_and_filter_logbook(label, detid, event_data_getter = event_data_getter,
-            event_filter = event_filter, event_filter_detid = event_filter_detid)
+            event_filter = event_filter, event_filter_detid = event_filter_detid,
+            event_data_allgather = event_data_allgather)
     except:# TODO: catch specific exceptions TODO
         try:
             return database.mongo_query_derived_dataset(label, detid,
@@ -183,8 +329,10 @@ def event_data_dict_to_list(event_data_dict):
     Converts the dict-based representation of event data for a label to
     a flat list of event data objects.
     """
-    run_dicts = event_data_dict.values()
-    return reduce(lambda x, y: x + y, [d.values() for d in run_dicts])
+    return\
+        [value
+        for run_dict in event_data_dict.itervalues()
+        for value in run_dict.itervalues()]
 
 def query_event_data(label, detid, flux_min, flux_max, mode = 'all'):
     def flux(beam_energy):
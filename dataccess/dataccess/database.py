@@ -2,11 +2,15 @@ import hashlib
 import ipdb
 import dill
 import config
-from pymongo import MongoClient
 import cPickle
-import gridfs
+import copy
 import os
 import binascii
+import atexit
+import storage
+import blobstore
+import writequeue
+import logbookindex
 
 """
 Interface module for mecana's MongoDB collection.
@@ -14,10 +18,20 @@ Interface module for mecana's MongoDB collection.
 Includes functions for storing and replaying individual function calls within 
 mecana's modules, for storing logging spreadsheet data, for caching mecana's
 outputs, and for inserting and accessing derived datasets.
+
+Data is stored through the backend returned by storage.get_backend(): MongoDB
+by default, or a local SQLite database (see storage.py). No connection is
+made until data is first accessed.
+
+Attributes of derived datasets are read from an in-process catalog of the
+derived dataset collection, which is reloaded only when the collection's
+version (incremented by every write to it) changes.
+
+Logbook data, label objects and session caches are written asynchronously
+by a background thread (see writequeue.py). Functions reading them first
+wait for pending writes, and pending writes are flushed at exit.
 """
 
-MONGO_HOST = 'pslogin03'
-MONGO_PORT = 4040
 token = ''
 
 db_dir = 'db/'
@@ -33,10 +47,45 @@ def hash(obj):
 # Functions for interacting with Mongo and inserting into/loading from
 # appending to the interpreter-wide Mongodb cache.
 to_insert = {}
-client = MongoClient(MONGO_HOST, MONGO_PORT)
-collection = client.database[config.expname + token]
-# Use GridFS to fit store objects > 16 MB
-FS = gridfs.GridFS(client.database)
+
+def main_collection():
+    return config.expname + token
+
+def derived_collection():
+    return config.expname + token + '_derived'
+
+def objects_collection():
+    return config.logbook_ID + '_objects_by_label'
+
+# Indexes created by get_backend(), as {collection name function: [field lists]}
+INDEXES = {
+    main_collection: [['name'], ['key', 'state_hash']],
+    derived_collection: [['source_logbook', 'label', 'detid', 'event_data_getter_hash']],
+    objects_collection: [['label']]}
+
+# Collections whose indexes have been ensured in this process
+indexed_collections = set()
+
+def get_backend():
+    """
+    Return the storage backend, creating the collections' indexes on first
+    use.
+    """
+    backend = storage.get_backend()
+    for collection_func, field_lists in INDEXES.iteritems():
+        name = collection_func()
+        if (id(backend), name) not in indexed_collections:
+            for fields in field_lists:
+                backend.ensure_index(name, fields)
+            indexed_collections.add((id(backend), name))
+    return backend
+
+def getter_hash(encoded_getter):
+    """
+    Return the hash of an event data getter encoded by dumps_b2a. Derived
+    datasets are indexed on it instead of the (large) encoded getter.
+    """
+    return hashlib.sha1(encoded_getter).hexdigest()
 
 def dumps_b2a(obj):
     """
@@ -64,17 +113,39 @@ def mongo_add(key, obj):
     """
     to_insert[key] = obj
 
+# The process's write queue; created on the first asynchronous write.
+write_state = {'queue': None}
+
+def queue_write(collection, d, mongo_query_dict = None):
+    """
+    Queue the insertion of d into the named collection, followed by the
+    removal of other documents matching mongo_query_dict (if not None).
+    d is written later by the writer thread, so it must not be modified
+    afterwards.
+    """
+    if write_state['queue'] is None:
+        write_state['queue'] = writequeue.WriteQueue(get_backend)
+        atexit.register(flush_writes)
+    write_state['queue'].put(collection, d, mongo_query_dict)
+
+def flush_writes(timeout = writequeue.FLUSH_TIMEOUT):
+    """
+    Wait up to timeout seconds for queued writes to complete. Returns
+    False if some are still pending.
+    """
+    if write_state['queue'] is None:
+        return True
+    return write_state['queue'].flush(timeout)
+
 def mongo_replace(collection, d, mongo_query_dict):
     """
+    Insert d into the named collection, replacing stale documents. The
+    write is asynchronous.
+
     mongo_query_dict: a query that will match stale documents
     that must be removed.
     """
-    remove_query_dict = {k: v for k, v in mongo_query_dict.iteritems()}
-    inserted = collection.insert(d, check_keys = False)
-    remove_query_dict['_id'] = {"$ne": inserted}
-    if list(collection.find(remove_query_dict)):
-        collection.remove(remove_query_dict)
-        print "removed"
+    queue_write(collection, d, mongo_query_dict)
 
 #def mongo_insert_logbook_dict(d):
 #    """
@@ -89,27 +160,41 @@ def mongo_replace(collection, d, mongo_query_dict):
 
 def mongo_insert_logbook_dict(d):
     """ 
-    Insert logging spreadsheet data into MongoDB.
+    Insert logging spreadsheet data into MongoDB, stamped with a version
+    that identifies its contents (see logbookindex.version_stamp). A copy
+    of d is queued, so the caller's dictionary isn't modified.
     """
+    d = copy.deepcopy(d)
+    d['version'] = logbookindex.version_stamp(d)
     d['name'] = config.logbook_ID
-    collection = client.database[config.expname + token]
     query_dict = {'name': {"$eq": config.logbook_ID}}
-    mongo_replace(collection, d, query_dict)
+    mongo_replace(main_collection(), d, query_dict)
+
+def mongo_get_logbook_version():
+    """
+    Return the version stamp of the logging spreadsheet data, or None if
+    it has none (i.e. it was inserted by an earlier version of this module).
+    """
+    flush_writes()
+    result_list = get_backend().find(main_collection(), {"name": config.logbook_ID},
+        fields = ['version'])
+    if not result_list:
+        raise KeyError("%s: logbook data not found" % config.logbook_ID)
+    return result_list[0].get('version')
 
 def mongo_get_logbook_dict():
     """
     Return the logging spreadsheet data dictionary.
     """
-    raw_dict = list(collection.find({"name": config.logbook_ID}))[0]
-    for k, v in raw_dict.iteritems():
-        if isinstance(v, dict) and 'runs' in v:
-            v['runs'] = tuple(v['runs'])
-    return {k: v for k, v in raw_dict.iteritems() if isinstance(v, dict)}
+    flush_writes()
+    raw_dict = get_backend().find(main_collection(), {"name": config.logbook_ID})[0]
+    return logbookindex.logbook_contents(raw_dict)
 
 def mongo_commit(label_dependencies = None):
     """
     Insert the interpreter session's cache (created by calls to mongo_add)
-    into MongoDB.
+    into MongoDB, replacing any earlier copy with the same key and state
+    hash. The write is asynchronous.
     """
     def get_state_hash(dependency_dicts):
         """
@@ -127,25 +212,23 @@ def mongo_commit(label_dependencies = None):
         state_hash = get_state_hash(dependency_dicts)
     except KeyError:
         raise KeyError("Attempting to insert non-initialized dict into mongo database")
-    if not list(collection.find({'key': key, 'state_hash': state_hash})):
-        to_insert['state_hash'] = state_hash
-        collection.insert(to_insert, check_keys = False) 
+    to_insert['state_hash'] = state_hash
+    mongo_replace(main_collection(), dict(to_insert), {'key': key, 'state_hash': state_hash})
 
 def mongo_store_object_by_label(obj, label):
     """
     Store a python object to MongoDB.
     """
-    collection = client.database[config.logbook_ID + '_objects_by_label']
     d = {'label': label, 'object': dumps_b2a(obj)}
     query_dict = {'label': label}
-    mongo_replace(collection, d, query_dict)
+    mongo_replace(objects_collection(), d, query_dict)
 
 def mongo_query_object_by_label(label):
     """
     Query a python object stored to MongoDB.
     """
-    collection = client.database[config.logbook_ID + '_objects_by_label']
-    result_list = list(collection.find({'label': label}))
+    flush_writes()
+    result_list = get_backend().find(objects_collection(), {'label': label})
     if not result_list:
         raise KeyError("%s: object not found" % label)
     # TODO: treat case of multiple results
@@ -164,8 +247,11 @@ def mongo_insert_derived_dataset(data_dict):
         -'data', a tuple containing the query's averaged detector readout and
         event data dictionary.
         -All logbook attributes that were used to evaluate the query.
+
+    The readout and event data are stored as chunked, compressed blobs (see
+    blobstore.py) referenced from the dataset's document.
     """
-    collection = client.database[config.expname + token + '_derived']
+    backend = get_backend()
     # initialize to_insert with the remaining key/value pairs. These include
     # all applicable logbook attributes.
     to_insert =\
@@ -174,54 +260,87 @@ def mongo_insert_derived_dataset(data_dict):
         if k != 'data'}
     try:
         # extract the (frame, event data dict) tuple
-        blob = cPickle.dumps(data_dict.pop('data'))
-        # Serialize the data tuple and store it
-        to_insert['gridFS_ID'] = FS.put(blob)
+        mean_frame, event_data = data_dict.pop('data')
+        to_insert['mean_frame'] = blobstore.put_array(backend, mean_frame)
+        if event_data is not None:
+            to_insert['event_data'] = blobstore.put_event_data(backend, event_data)
 
         to_insert['detid'] = data_dict['detid']
         to_insert['event_data_getter'] = data_dict['event_data_getter']
+        to_insert['event_data_getter_hash'] = getter_hash(data_dict['event_data_getter'])
     except KeyError:
         pass
     to_insert['label'] = data_dict['label']
     to_insert['source_logbook'] = config.logbook_ID
-    collection.insert(to_insert)
+    backend.insert(derived_collection(), to_insert)
+    backend.bump_version(derived_collection())
+
+
+# In-process copy of the derived dataset collection's documents for the
+# current logbook, and the labels matching each pattern looked up so far.
+catalog_state = {'key': None, 'attributes': {}, 'matches': {}}
+
+def derived_catalog():
+    """
+    Return catalog_state, reloading it if the derived dataset collection
+    has changed since it was last loaded.
+    """
+    backend = get_backend()
+    key = (id(backend), derived_collection(), config.logbook_ID,
+        backend.get_version(derived_collection()))
+    if catalog_state['key'] != key:
+        documents =\
+            backend.find(derived_collection(), {'source_logbook': config.logbook_ID})
+        catalog_state['attributes'] =\
+            {d['label']: {k: v for k, v in d.iteritems() if k != 'label'}
+            for d in documents}
+        catalog_state['matches'] = {}
+        catalog_state['key'] = key
+    return catalog_state
 
 
 def mongo_get_all_derived_datasets():
     """
     Return a dictionary in the same format as that returned by logbook.get_pub_logbook_dict().
     """
-    collection = client.database[config.expname + token + '_derived']
-    documents =\
-        list(collection.find({'source_logbook': config.logbook_ID}))
-    def insert_one(d):
-        label = d.pop('label')
-        return label, d
-    attribute_dict =\
-        {k: v
-        for k, v in map(insert_one, documents)}
-    return attribute_dict
+    return {label: dict(d)
+        for label, d in derived_catalog()['attributes'].iteritems()}
     
 
 def mongo_query_derived_dataset(label, detid, event_data_getter = None):
     """
     Return a query output dataset previously inserted by mongo_insert_derived_dataset.
     
-    The return value is a tuple containing an averaged frame and an event data dictionary.
+    The return value is a tuple containing an averaged frame and an event data
+    dictionary. The event data of each run is only read from the database
+    when it's accessed.
     """
-    collection = client.database[config.expname + token + '_derived']
-    result_list =\
-        list(collection.find({'source_logbook': config.logbook_ID,
-            'label': {'$regex': label}, 'detid': detid, 'event_data_getter': dumps_b2a(event_data_getter)}))
+    backend = get_backend()
+    encoded_getter = dumps_b2a(event_data_getter)
+    query_dict = {'source_logbook': config.logbook_ID, 'label': {'$regex': label},
+        'detid': detid}
+    result_list = backend.find(derived_collection(),
+        dict(query_dict, event_data_getter_hash = getter_hash(encoded_getter)))
+    if not result_list:
+        # Inserted by earlier versions, without the getter's hash
+        result_list = backend.find(derived_collection(),
+            dict(query_dict, event_data_getter = encoded_getter))
     if not result_list:
         dataset = mongo_query_object_by_label(label)
         return dataset.evaluate(detid, event_data_getter = event_data_getter)
     result = result_list[0]
     if len(result_list) > 1:
         print "WARNING: regex '%s' matches more than one derived dataset. First match will be selected: %s" % (label, result['label'])
-    blob = FS.get(result['gridFS_ID']).read()
     print "loading dataset from MongoDB"
-    return cPickle.loads(blob)
+    if 'gridFS_ID' in result:
+        # Stored as a single pickle by earlier versions
+        return cPickle.loads(backend.get_blob(result['gridFS_ID']))
+    mean_frame = blobstore.get_array(backend, result['mean_frame'])
+    if 'event_data' in result:
+        event_data = blobstore.LazyEventData(backend, result['event_data'])
+    else:
+        event_data = None
+    return mean_frame, event_data
 
 
 def get_derived_dataset_attribute(pat, attribute):
@@ -232,10 +351,13 @@ def get_derived_dataset_attribute(pat, attribute):
     """
     import re
     pat = '^' + pat + '$'
-    attribute_map = mongo_get_all_derived_datasets()
-    matching_labels =\
-        filter(lambda lab: bool(re.search(pat, lab, flags = re.IGNORECASE)),
-            attribute_map.keys())
+    catalog = derived_catalog()
+    attribute_map = catalog['attributes']
+    if pat not in catalog['matches']:
+        catalog['matches'][pat] =\
+            filter(lambda lab: bool(re.search(pat, lab, flags = re.IGNORECASE)),
+                attribute_map.keys())
+    matching_labels = catalog['matches'][pat]
     if not matching_labels:
         raise KeyError("%s: no matching derived dataset label found" % pat) 
     result_label = matching_labels[0]
@@ -245,7 +367,9 @@ def get_derived_dataset_attribute(pat, attribute):
 
 def delete_all_derived_datasets():
     # TODO: flush cache in data_access as well
-    collections = [client.database[config.expname + token + '_derived'], client.database[config.logbook_ID + '_objects_by_label']]
-    for collection in collections:
-        collection.delete_many({})
+    flush_writes()
+    backend = get_backend()
+    for collection in [derived_collection(), objects_collection()]:
+        backend.remove(collection, {})
+    backend.bump_version(derived_collection())
     os.system('rm -rf cache/query/DataSet.evaluate*')
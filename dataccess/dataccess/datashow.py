@@ -24,6 +24,9 @@ def one_plot(label, detid, path = None, masked = False, rmin = None, rmax = None
             utils.save_image_and_show(path, imarray, title = label + '_' + detid, rmin = rmin, rmax = rmax, show_plot = show)
     else:
         imarray, framesdict = data_access.get_label_data(label, detid, event_data_getter = identity)
+        # Event data is only gathered to the root rank
+        if not utils.isroot():
+            return
         frames = framesdict.values()[0].values()
         if not path:
             path = 'datashow_images/' + label + '_' + str(detid)
@@ -0,0 +1,213 @@
+"""
+Compact event masks.
+
+An EventMask replaces the {run: {nevent: bool}} dicts built from event
+filter output. Each run's mask is a RunMask: a pair of boolean arrays
+indexed by event number, recording which events were evaluated by the
+filter and which of those were accepted. Lookups are O(1), logical
+operations and counts are vectorized, and pickling or hashing a mask
+packs it into bits.
+"""
+
+import hashlib
+import numpy as np
+
+
+def _resize(arr, n):
+    out = np.zeros(n, dtype = bool)
+    out[:len(arr)] = arr
+    return out
+
+
+class RunMask(object):
+    """
+    Event mask for a single run.
+
+    Public attributes:
+        valid : boolean array; True for events evaluated by the filter.
+        accepted : boolean array; True for accepted events. Always False
+            where valid is False.
+    Both are indexed by event number.
+    """
+    def __init__(self, valid, accepted):
+        self.valid = np.asarray(valid, dtype = bool)
+        self.accepted = np.asarray(accepted, dtype = bool) & self.valid
+
+    @classmethod
+    def from_dict(cls, run_mask):
+        """
+        Construct a RunMask from a {nevent: bool} dict, or from a sequence
+        of bools indexed by event number.
+        """
+        if not hasattr(run_mask, 'keys'):
+            accepted = np.asarray(run_mask, dtype = bool)
+            return cls(np.ones(len(accepted), dtype = bool), accepted)
+        nevents = np.fromiter(run_mask.keys(), dtype = 'int64', count = len(run_mask))
+        n = nevents.max() + 1 if len(nevents) else 0
+        valid = np.zeros(n, dtype = bool)
+        accepted = np.zeros(n, dtype = bool)
+        valid[nevents] = True
+        accepted[nevents] = np.fromiter(run_mask.values(), dtype = bool, count = len(run_mask))
+        return cls(valid, accepted)
+
+    def __len__(self):
+        return len(self.valid)
+
+    def __getitem__(self, nevent):
+        """
+        Return True if event nevent was accepted, and False if it was rejected
+        or not evaluated.
+        """
+        if 0 <= nevent < len(self.accepted):
+            return bool(self.accepted[nevent])
+        return False
+
+    def __contains__(self, nevent):
+        return 0 <= nevent < len(self.valid) and bool(self.valid[nevent])
+
+    def __iter__(self):
+        """
+        Iterate over the numbers of evaluated events.
+        """
+        return iter(np.flatnonzero(self.valid).tolist())
+
+    def __array__(self, dtype = None):
+        return self.accepted if dtype is None else self.accepted.astype(dtype)
+
+    def _combine(self, other, op):
+        n = max(len(self), len(other))
+        return RunMask(_resize(self.valid, n) | _resize(other.valid, n),
+            op(_resize(self.accepted, n), _resize(other.accepted, n)))
+
+    def __and__(self, other):
+        return self._combine(other, np.logical_and)
+
+    def __or__(self, other):
+        return self._combine(other, np.logical_or)
+
+    def __invert__(self):
+        """
+        Accept exactly the evaluated events that this mask rejects.
+        """
+        return RunMask(self.valid, ~self.accepted)
+
+    def count(self):
+        """
+        Number of accepted events.
+        """
+        return int(np.count_nonzero(self.accepted))
+
+    def nevents(self):
+        """
+        Number of events evaluated by the filter.
+        """
+        return int(np.count_nonzero(self.valid))
+
+    def to_dict(self):
+        return dict(zip(np.flatnonzero(self.valid).tolist(),
+            self.accepted[self.valid].tolist()))
+
+    def __getstate__(self):
+        return (len(self.valid), np.packbits(self.valid), np.packbits(self.accepted))
+
+    def __setstate__(self, state):
+        n, valid, accepted = state
+        self.valid = np.unpackbits(valid)[:n].astype(bool)
+        self.accepted = np.unpackbits(accepted)[:n].astype(bool)
+
+    def __cache_key__(self):
+        n, valid, accepted = self.__getstate__()
+        return hashlib.sha1(str(n) + valid.tostring() + accepted.tostring()).hexdigest()
+
+
+class EventMask(object):
+    """
+    Event masks for a group of runs, indexed by run number like the
+    {run: {nevent: bool}} dicts it replaces.
+    """
+    def __init__(self, run_masks = None):
+        """
+        run_masks : dict
+            Maps run numbers to RunMasks.
+        """
+        self.run_masks = dict(run_masks or {})
+
+    @classmethod
+    def from_dict(cls, event_mask):
+        """
+        Construct an EventMask from a {run: {nevent: bool}} dict.
+        """
+        return cls({run: RunMask.from_dict(run_mask)
+            for run, run_mask in event_mask.iteritems()})
+
+    def __getitem__(self, run):
+        return self.run_masks[run]
+
+    def __contains__(self, run):
+        return run in self.run_masks
+
+    def __iter__(self):
+        return iter(self.runs())
+
+    def __len__(self):
+        return len(self.run_masks)
+
+    def runs(self):
+        return sorted(self.run_masks.keys())
+
+    def _combine(self, other, op):
+        empty = RunMask([], [])
+        return EventMask({run: op(self.run_masks.get(run, empty), other.run_masks.get(run, empty))
+            for run in set(self.run_masks) | set(other.run_masks)})
+
+    def __and__(self, other):
+        return self._combine(other, lambda a, b: a & b)
+
+    def __or__(self, other):
+        return self._combine(other, lambda a, b: a | b)
+
+    def __invert__(self):
+        return EventMask({run: ~run_mask for run, run_mask in self.run_masks.iteritems()})
+
+    def count(self):
+        """
+        Number of accepted events over all runs.
+        """
+        return sum(run_mask.count() for run_mask in self.run_masks.itervalues())
+
+    def nevents(self):
+        """
+        Number of events evaluated by the filter over all runs.
+        """
+        return sum(run_mask.nevents() for run_mask in self.run_masks.itervalues())
+
+    def to_dict(self):
+        return {run: run_mask.to_dict() for run, run_mask in self.run_masks.iteritems()}
+
+    def __cache_key__(self):
+        return hashlib.sha1(''.join(str(run) + self.run_masks[run].__cache_key__()
+            for run in self.runs())).hexdigest()
+
+
+def restrict(event_mask, run):
+    """
+    Return an EventMask holding only run's mask from event_mask, or None if
+    event_mask is empty or None. Per-run functions are passed this instead
+    of the full mask so that their cache keys depend on their own run only.
+    """
+    run_mask = get_run_mask(event_mask, run)
+    if run_mask is None:
+        return None
+    return EventMask({run: run_mask})
+
+def get_run_mask(event_mask, run):
+    """
+    Return the RunMask for run in event_mask (an EventMask or a
+    {run: {nevent: bool}} dict), or None if event_mask is empty or None.
+    """
+    if not event_mask:
+        return None
+    run_mask = event_mask[run]
+    if not isinstance(run_mask, RunMask):
+        run_mask = RunMask.from_dict(run_mask)
+    return run_mask
@@ -0,0 +1,138 @@
+"""
+Event data containers with a bounded memory footprint.
+
+A RunEventData behaves like the {nevent: value} dicts that event data
+getters' outputs are normally collected in. Once the array values it holds
+in memory exceed its budget they are moved to chunk files in SPILL_DIR and
+read back through read-only memory maps, so that collecting whole frames
+over a run (e.g. with event_data_getter = utils.identity) doesn't exhaust
+the node's memory.
+"""
+
+import os
+import shutil
+import tempfile
+import collections
+import numpy as np
+
+# Directory under which spilled event data is stored
+SPILL_DIR = 'cache/eventstore/'
+
+# Default budget, in bytes, for the array values a RunEventData keeps in
+# memory. None disables spilling.
+EVENT_DATA_BUDGET = 2 * 1024**3
+
+
+class RunEventData(collections.MutableMapping):
+    """
+    Mapping of event numbers to event data values for a single run.
+
+    Scalar and non-array values are always kept in memory. Array values are
+    kept in memory until their total size exceeds budget, at which point all
+    of them are written to disk, one chunk file per (dtype, shape), and
+    subsequently accessed as read-only memory-mapped arrays.
+
+    Pickles as a plain dict.
+    """
+    def __init__(self, run, budget = None, spill_dir = None):
+        self.run = run
+        if budget is None:
+            budget = EVENT_DATA_BUDGET
+        self.budget = budget
+        if spill_dir is None:
+            spill_dir = SPILL_DIR
+        self.spill_dir = spill_dir
+        # In-memory values, and total size of the array values among them
+        self.memory = {}
+        self.nbytes = 0
+        # Spilled values: nevent -> (chunk number, row)
+        self.index = {}
+        self.chunk_paths = []
+        self.chunk_maps = {}
+        self.directory = None
+
+    def empty_like(self):
+        """
+        Return an empty RunEventData with the same run, budget and spill
+        directory.
+        """
+        return RunEventData(self.run, budget = self.budget, spill_dir = self.spill_dir)
+
+    def __getitem__(self, nevent):
+        if nevent in self.memory:
+            return self.memory[nevent]
+        chunk, row = self.index[nevent]
+        if chunk not in self.chunk_maps:
+            self.chunk_maps[chunk] = np.load(self.chunk_paths[chunk], mmap_mode = 'r')
+        return self.chunk_maps[chunk][row]
+
+    def __setitem__(self, nevent, value):
+        if nevent in self:
+            del self[nevent]
+        self.memory[nevent] = value
+        if isinstance(value, np.ndarray):
+            self.nbytes += value.nbytes
+            if self.budget is not None and self.nbytes > self.budget:
+                self.spill()
+
+    def __delitem__(self, nevent):
+        if nevent in self.memory:
+            value = self.memory.pop(nevent)
+            if isinstance(value, np.ndarray):
+                self.nbytes -= value.nbytes
+        else:
+            del self.index[nevent]
+
+    def __contains__(self, nevent):
+        return nevent in self.memory or nevent in self.index
+
+    def __iter__(self):
+        return iter(sorted(self.memory.keys() + self.index.keys()))
+
+    def __len__(self):
+        return len(self.memory) + len(self.index)
+
+    def __reduce__(self):
+        return (dict, (), None, None, self.iteritems())
+
+    def spill(self):
+        """
+        Move all in-memory array values to disk.
+        """
+        if self.directory is None:
+            if not os.path.exists(self.spill_dir):
+                os.system('mkdir -p ' + self.spill_dir)
+            self.directory = tempfile.mkdtemp(prefix = 'run%04d_' % self.run,
+                dir = self.spill_dir)
+        groups = collections.defaultdict(list)
+        for nevent, value in self.memory.iteritems():
+            if isinstance(value, np.ndarray):
+                groups[(value.dtype.str, value.shape)].append(nevent)
+        for (dtype_str, shape), nevents in groups.iteritems():
+            chunk = len(self.chunk_paths)
+            path = os.path.join(self.directory, '%d.npy' % chunk)
+            # Rows are written one at a time to avoid a second in-memory copy
+            out = np.lib.format.open_memmap(path, mode = 'w+',
+                dtype = np.dtype(dtype_str), shape = (len(nevents),) + shape)
+            for row, nevent in enumerate(sorted(nevents)):
+                out[row] = self.memory.pop(nevent)
+                self.index[nevent] = (chunk, row)
+            out.flush()
+            del out
+            self.chunk_paths.append(path)
+        self.nbytes = 0
+
+    def close(self):
+        """
+        Delete spilled data. Arrays previously returned from this object
+        remain readable.
+        """
+        self.chunk_maps = {}
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors = True)
+            self.directory = None
+        self.index = {}
+        self.chunk_paths = []
+
+    def __del__(self):
+        self.close()
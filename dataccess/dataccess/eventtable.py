@@ -0,0 +1,138 @@
+"""
+Columnar representation of event data.
+
+An EventTable holds the same information as the nested event data dicts
+returned by data_access.get_label_data and friends ({run: {nevent: value}}),
+as three NumPy arrays of equal length: run numbers, event numbers and
+values. Operations on it are vectorized over events.
+"""
+
+import numpy as np
+
+
+class EventTable(object):
+    """
+    Event data as run, nevent and value columns.
+
+    Public attributes:
+        run : 1d np.ndarray of run numbers.
+        nevent : 1d np.ndarray of event numbers.
+        value : np.ndarray whose first axis runs over events.
+    """
+    def __init__(self, run, nevent, value):
+        self.run = np.asarray(run)
+        self.nevent = np.asarray(nevent, dtype = 'int64')
+        self.value = np.asarray(value)
+        if not (len(self.run) == len(self.nevent) == len(self.value)):
+            raise ValueError("EventTable columns must have equal lengths")
+
+    @classmethod
+    def from_dict(cls, event_data_dict):
+        """
+        Construct an EventTable from a {run: {nevent: value}} dict.
+        """
+        runs = []
+        counts = []
+        nevents = []
+        values = []
+        for run, run_dict in event_data_dict.iteritems():
+            items = run_dict.items()
+            runs.append(run)
+            counts.append(len(items))
+            nevents.extend(k for k, v in items)
+            values.extend(v for k, v in items)
+        return cls(np.repeat(np.array(runs), counts),
+            np.array(nevents, dtype = 'int64'), np.array(values))
+
+    @classmethod
+    def merge(cls, *tables):
+        """
+        Combine several EventTables. As with utils.merge_dicts, a run
+        present in more than one table is taken from the last of them.
+        """
+        tables = [t for t in tables if len(t)]
+        if not tables:
+            return cls([], [], [])
+        columns = ([], [], [])
+        for i, table in enumerate(tables):
+            later_runs = [t.run for t in tables[i + 1:]]
+            if later_runs:
+                table = table.filter(~np.in1d(table.run, np.concatenate(later_runs)))
+            for column, arr in zip(columns, (table.run, table.nevent, table.value)):
+                column.append(arr)
+        return cls(*map(np.concatenate, columns))
+
+    def __len__(self):
+        return len(self.nevent)
+
+    def filter(self, mask):
+        """
+        Return an EventTable containing the events selected by mask, a
+        boolean array over events or a function mapping the value column to
+        one.
+        """
+        if callable(mask):
+            mask = mask(self.value)
+        mask = np.asarray(mask, dtype = bool)
+        return EventTable(self.run[mask], self.nevent[mask], self.value[mask])
+
+    def sort(self):
+        """
+        Return a copy of this table sorted by run and event number.
+        """
+        order = np.lexsort((self.nevent, self.run))
+        return EventTable(self.run[order], self.nevent[order], self.value[order])
+
+    def groupby_run(self):
+        """
+        Return a list of (run, EventTable) pairs, one per run, in order of
+        increasing run number.
+        """
+        order = np.argsort(self.run, kind = 'mergesort')
+        run = self.run[order]
+        runs, starts = np.unique(run, return_index = True)
+        bounds = list(starts[1:]) + [len(run)]
+        return\
+            [(r, EventTable(run[start:end], self.nevent[order[start:end]],
+                self.value[order[start:end]]))
+            for r, start, end in zip(runs.tolist(), starts, bounds)]
+
+    def counts_by_run(self):
+        """
+        Return a dict mapping run numbers to the number of events in each.
+        """
+        runs, counts = np.unique(self.run, return_counts = True)
+        return dict(zip(runs.tolist(), counts.tolist()))
+
+    def to_dict(self):
+        """
+        Return the {run: {nevent: value}} dict representation of this table.
+        """
+        def run_dict(table):
+            if table.value.ndim == 1:
+                values = table.value.tolist()
+            else:
+                values = table.value
+            return dict(zip(table.nevent.tolist(), values))
+        return {r: run_dict(table) for r, table in self.groupby_run()}
+
+    def to_array(self):
+        """
+        Return a 2d float array with rows (run, nevent, value). Values must
+        be scalars.
+        """
+        if self.value.ndim != 1:
+            raise ValueError("to_array requires scalar event data values")
+        return np.column_stack((self.run, self.nevent, self.value)).astype(float)
+
+    def to_dataframe(self):
+        """
+        Return a pandas DataFrame with columns run, nevent and value.
+        """
+        import pandas as pd
+        if self.value.ndim == 1:
+            value = self.value
+        else:
+            value = list(self.value)
+        return pd.DataFrame({'run': self.run, 'nevent': self.nevent, 'value': value},
+            columns = ['run', 'nevent', 'value'])
@@ -0,0 +1,80 @@
+"""
+Lineage tokens for derived detector arrays.
+
+Arrays returned by data_access.get_data_and_filter are LineageArrays tagged
+with a token describing how they were produced (dataset label, runs,
+detector ID, event filter, background label and a fingerprint of the
+relevant config.py settings). utils.make_hashable hashes a tagged array by
+its token instead of its pixel data, so that functions taking such arrays
+(e.g. xrd.process_imarray) can be cached with utils.eager_persist_to_file
+at negligible cost.
+
+Tokens aren't propagated to arrays computed from a LineageArray: slices,
+views and arithmetic results are untagged (and hashed by content) unless
+explicitly tagged with derive.
+"""
+
+import numpy as np
+
+
+class LineageArray(np.ndarray):
+    """
+    ndarray carrying a lineage token.
+
+    Public attributes:
+        lineage : tuple, or None for untagged arrays.
+    """
+    def __new__(cls, arr, lineage = None):
+        obj = np.asarray(arr).view(cls)
+        obj.lineage = lineage
+        return obj
+
+    def __array_finalize__(self, obj):
+        self.lineage = None
+
+    def __array_wrap__(self, out_arr, context = None):
+        # Results of ufuncs are plain arrays (or scalars)
+        result = np.ndarray.__array_wrap__(self, out_arr, context).view(np.ndarray)
+        if result.ndim == 0:
+            return result[()]
+        return result
+
+    def __reduce__(self):
+        constructor, args, state = np.ndarray.__reduce__(self)
+        return constructor, args, (state, self.lineage)
+
+    def __setstate__(self, state):
+        array_state, self.lineage = state
+        np.ndarray.__setstate__(self, array_state)
+
+    def __cache_key__(self):
+        if self.lineage is None:
+            return self.view(np.ndarray)
+        return ('lineage',) + tuple(self.lineage)
+
+
+def tag(arr, lineage):
+    """
+    Return a LineageArray view of arr with the given lineage token.
+    """
+    return LineageArray(arr, lineage)
+
+def get_lineage(arr):
+    """
+    Return arr's lineage token, or None if it has none.
+    """
+    return getattr(arr, 'lineage', None)
+
+def derive(arr, source, step):
+    """
+    Tag arr, computed from source by the operation described by step (a
+    hashable object), with source's lineage extended by step. Returns arr
+    unchanged if source isn't tagged.
+
+    The operation must not depend on anything but source and step (or
+    settings already covered by source's config fingerprint).
+    """
+    lineage = get_lineage(source)
+    if lineage is None:
+        return arr
+    return tag(arr, tuple(lineage) + (step,))
@@ -26,6 +26,7 @@ from atomicfile import AtomicFile
 
 import utils
 import database
+import logbookindex
 
 import config
 
@@ -264,11 +265,40 @@ def make_labels(fname = 'labels.txt', min_cluster_size = 2):
     return bounds
 
 
-@utils.memoize(timeout = 5)
-def get_pub_logbook_dict():
+# Minimum time, in seconds, between queries of the logbook's version stamp
+VERSION_CHECK_INTERVAL = 5.
+
+# The process's LogbookIndex; rebuilt by get_logbook_index() when the
+# logbook's version stamp changes. 'checked' is the time of the last
+# version query.
+index_state = {'index': None, 'checked': 0.}
+
+def get_logbook_index():
+    """
+    Return a LogbookIndex of the current logbook data. The version stamp is
+    queried at most once every VERSION_CHECK_INTERVAL seconds.
+    """
+    index = index_state['index']
+    if index is not None and time.time() - index_state['checked'] < VERSION_CHECK_INTERVAL:
+        return index
+    version = database.mongo_get_logbook_version()
+    index_state['checked'] = time.time()
+    if index is not None and version is not None and version == index.version:
+        return index
     if utils.isroot():
         print "Querying MongoDB"
-    return database.mongo_get_logbook_dict()
+    logbook_dict = database.mongo_get_logbook_dict()
+    if version is None:
+        # Inserted without a version stamp
+        version = logbookindex.version_stamp(logbook_dict)
+        if index is not None and version == index.version:
+            return index
+    index_state['index'] = logbookindex.LogbookIndex(logbook_dict, version)
+    return index_state['index']
+
+def get_pub_logbook_dict():
+    return {label: dict(d)
+        for label, d in get_logbook_index().logbook_dict.iteritems()}
 
 
 def get_label_runranges():
@@ -279,11 +309,7 @@ def get_label_runranges():
 
     Output type: Dict mapping strings to lists of tuples.
     """
-    complete_dict = get_pub_logbook_dict()
-    labels_to_runs = {}
-    for label, d in complete_dict.iteritems():
-        labels_to_runs[label] = d['runs']
-    return labels_to_runs
+    return get_logbook_index().columns.get('runs', {}).copy()
 
 def get_label_attribute(label, property):
     """
@@ -297,37 +323,21 @@ def get_label_attribute(label, property):
             pass
     if not config.use_logbook:
         raise AttributeError("Logbook not available (disabled in config.py)")
-    complete_dict = get_pub_logbook_dict()
-    def runs_to_label(run_range):
-        """
-        Given a run range, look for a label whose run range matches
-        and return it. If a matching label isn't found, return None.
-        """
-        red = lambda x, y: x + y
-        # TODO: poorly-abstracted...
-        filtered_dict = {k: v for k, v in complete_dict.iteritems() if v['runs'] != (None,)}
-        labels_to_runtuples = {lab: tuple(get_all_runlist(lab)) for lab in
-            filtered_dict}
-        runtuples_to_labels = {v: k for k, v in labels_to_runtuples.items()}
-        target_set = set(run_range)
-        for runtuple in runtuples_to_labels:
-            if target_set <= set(runtuple):
-                return runtuples_to_labels[runtuple]
-        return None
-
-    if label not in complete_dict:
+    index = get_logbook_index()
+    if label not in index:
         try:
             runs = parse_run(label)
         except ValueError:
             raise ValueError("label: " + label + " is neither a label nor a correctly-formated run range")
-        if runs_to_label(runs) is not None:
-            label = runs_to_label(runs)
+        # Look for a label whose run range includes runs
+        matching_label = index.runs_to_label(runs)
+        if matching_label is not None:
+            label = matching_label
         else:
             # TODO: stale error message here
             raise KeyError("label: " + label + " is neither a label nor a valid range of run numbers")
-    label_dict = complete_dict[label]
     try:
-        return label_dict[property]
+        return index.attribute(label, property)
     except KeyError:
         raise KeyError("attribute: " + property + " of label: " + label + " not found")
 
@@ -353,12 +363,12 @@ def get_all_runlist(label, fname = 'labels.txt'):
         runs = parse_run(label)
         return list(runs)
     except: # except what?
-        mapping = get_label_runranges()
+        index = get_logbook_index()
         # list of tuples denoting run ranges
         # TODO: reorder this and remove fname as a parameter throughout this
         # module once spreadsheet synchronization has been sufficiently tested.
         try:
-            groups = mapping[label]
+            groups = index.runs(label)
             return list(groups)
         except KeyError:
             # TODO: make sure that the run number exists
@@ -383,4 +393,6 @@ def main(url = config.url):
         mapping = spreadsheet_mapping(url)
         print mapping
         database.mongo_insert_logbook_dict(mapping)
+        # Pick up the new version on the next lookup
+        index_state['checked'] = 0.
         time.sleep(1)
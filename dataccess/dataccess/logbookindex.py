@@ -0,0 +1,109 @@
+"""
+Precomputed lookup tables for logbook data.
+
+A LogbookIndex is built from the dictionary returned by
+database.mongo_get_logbook_dict() (label -> attribute dict) and maps
+labels to runs, runs to labels, and (attribute, label) pairs to values.
+logbook.get_logbook_index() rebuilds it only when the version stamp of the
+logbook document (see version_stamp) changes.
+"""
+
+import json
+import hashlib
+
+
+def logbook_contents(document):
+    """
+    Return the label entries of a logbook document, i.e. its dict values
+    (dropping fields like 'name' and 'version'), with each label's runs as
+    a tuple.
+    """
+    contents = {}
+    for label, attributes in document.iteritems():
+        if isinstance(attributes, dict):
+            attributes = dict(attributes)
+            if 'runs' in attributes:
+                attributes['runs'] = tuple(attributes['runs'])
+            contents[label] = attributes
+    return contents
+
+def version_stamp(document):
+    """
+    Return a string identifying the label entries of a logbook document
+    (see logbook_contents), so that a document and the dictionary loaded
+    from it get the same stamp.
+    """
+    return hashlib.sha1(json.dumps(logbook_contents(document),
+        sort_keys = True, default = repr)).hexdigest()
+
+
+class LogbookIndex(object):
+    """
+    Public attributes:
+        version : version stamp of the logbook data the index was built from.
+        logbook_dict : the logbook data, {label: {attribute: value}}.
+        label_runs : {label: sorted tuple of run numbers}, for labels with
+            runs.
+        run_labels : {run number: set of labels including it}.
+        columns : {attribute: {label: value}}.
+    """
+    def __init__(self, logbook_dict, version = None):
+        if version is None:
+            version = version_stamp(logbook_dict)
+        self.version = version
+        self.logbook_dict = logbook_dict
+        self.label_runs = {}
+        self.run_labels = {}
+        self.columns = {}
+        for label, attributes in logbook_dict.iteritems():
+            for attribute, value in attributes.iteritems():
+                self.columns.setdefault(attribute, {})[label] = value
+            runs = attributes.get('runs')
+            if runs is None or tuple(runs) == (None,):
+                continue
+            self.label_runs[label] = tuple(sorted(set(runs)))
+            for run in self.label_runs[label]:
+                self.run_labels.setdefault(run, set()).add(label)
+
+    def __contains__(self, label):
+        return label in self.logbook_dict
+
+    def runs(self, label):
+        """
+        Return the run numbers of a label. Raises KeyError if the label
+        isn't in the logbook.
+        """
+        return self.logbook_dict[label]['runs']
+
+    def labels(self, run):
+        """
+        Return the set of labels whose runs include run.
+        """
+        return self.run_labels.get(run, set())
+
+    def attribute(self, label, attribute):
+        """
+        Return the value of a label's attribute. Raises KeyError if either
+        is missing.
+        """
+        return self.columns[attribute][label]
+
+    def runs_to_label(self, runs):
+        """
+        Return the label whose runs include all of the given runs, or None
+        if there isn't one. If several labels qualify, the one with the
+        fewest runs (and then the first in alphabetical order) is returned.
+        """
+        runs = set(runs)
+        if not runs:
+            return None
+        candidates = None
+        for run in runs:
+            labels = self.labels(run)
+            if candidates is None:
+                candidates = set(labels)
+            else:
+                candidates &= labels
+            if not candidates:
+                return None
+        return min(candidates, key = lambda label: (len(self.label_runs[label]), label))
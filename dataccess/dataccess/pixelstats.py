@@ -0,0 +1,148 @@
+"""
+Streaming per-pixel statistics of detector frames.
+
+PixelStats accumulates the count, mean, variance (using Welford's algorithm),
+minimum and maximum of a sequence of equally-shaped arrays without storing
+them, along with the same statistics of each array's total counts.
+Accumulators built on different MPI ranks (or from different runs) can be
+merged exactly.
+"""
+
+import numpy as np
+
+
+class PixelStats(object):
+    """
+    Mergeable streaming statistics of a sequence of arrays (or scalars).
+
+    Public attributes:
+        n : number of arrays accumulated.
+        mean, min, max : per-element statistics (None if n == 0).
+        totals : PixelStats of the arrays' sums (None if track_totals
+            is False).
+    """
+    def __init__(self, track_totals = True):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        if track_totals:
+            self.totals = PixelStats(track_totals = False)
+        else:
+            self.totals = None
+
+    def add(self, frame):
+        """
+        Add one array to the accumulator.
+        """
+        frame = np.asarray(frame, dtype = 'float')
+        if self.n == 0:
+            self.mean = np.zeros_like(frame)
+            self.m2 = np.zeros_like(frame)
+            self.min = frame.copy()
+            self.max = frame.copy()
+        self.n += 1
+        delta = frame - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (frame - self.mean)
+        self.min = np.minimum(self.min, frame)
+        self.max = np.maximum(self.max, frame)
+        if self.totals is not None:
+            self.totals.add(np.sum(frame))
+
+    def merge(self, other):
+        """
+        Combine other into this accumulator (Chan et al.'s pairwise update)
+        and return self.
+        """
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n = other.n
+            self.mean = other.mean.copy()
+            self.m2 = other.m2.copy()
+            self.min = other.min.copy()
+            self.max = other.max.copy()
+        else:
+            n = self.n + other.n
+            delta = other.mean - self.mean
+            self.mean = self.mean + delta * (float(other.n) / n)
+            self.m2 = self.m2 + other.m2 + delta**2 * (float(self.n) * other.n / n)
+            self.min = np.minimum(self.min, other.min)
+            self.max = np.maximum(self.max, other.max)
+            self.n = n
+        if self.totals is not None and other.totals is not None:
+            self.totals.merge(other.totals)
+        return self
+
+    @property
+    def variance(self):
+        """
+        Population variance.
+        """
+        if self.n == 0:
+            return None
+        return self.m2 / self.n
+
+    @property
+    def std(self):
+        if self.n == 0:
+            return None
+        return np.sqrt(self.variance)
+
+    @property
+    def sum(self):
+        if self.n == 0:
+            return None
+        return self.mean * self.n
+
+    def allreduce(self, comm):
+        """
+        Return the merge of this accumulator over all ranks of comm. The
+        per-element arrays are combined with buffer-based Allreduces.
+        """
+        from mpi4py import MPI
+        result = PixelStats(track_totals = self.totals is not None)
+        if self.totals is not None:
+            totals = comm.allgather(self.totals)
+            result.totals = reduce(lambda x, y: x.merge(y), totals,
+                PixelStats(track_totals = False))
+        n = comm.allreduce(self.n)
+        if n == 0:
+            return result
+        shapes = filter(lambda shape: shape is not None,
+            comm.allgather(None if self.n == 0 else np.shape(self.mean)))
+        shape = shapes[0]
+        def allreduce_array(arr, fill, op):
+            if arr is None:
+                arr = np.empty(shape)
+                arr.fill(fill)
+            arr = np.ascontiguousarray(arr, dtype = 'float').ravel()
+            out = np.empty_like(arr)
+            comm.Allreduce(arr, out, op = op)
+            return out.reshape(shape)
+        weighted_mean = None if self.n == 0 else self.mean * self.n
+        mean = allreduce_array(weighted_mean, 0., MPI.SUM) / n
+        # Each rank's M2, plus the spread of its mean around the global mean
+        if self.n == 0:
+            m2 = None
+        else:
+            m2 = self.m2 + self.n * (self.mean - mean)**2
+        result.n = n
+        result.mean = mean
+        result.m2 = allreduce_array(m2, 0., MPI.SUM)
+        result.min = allreduce_array(self.min, np.inf, MPI.MIN)
+        result.max = allreduce_array(self.max, -np.inf, MPI.MAX)
+        return result
+
+    def clip_bounds(self, sigma_max):
+        """
+        Return the (lower, upper) bounds of frame total counts within
+        sigma_max standard deviations of the mean total counts.
+        """
+        if self.totals is None or self.totals.n == 0:
+            raise ValueError("No total count statistics accumulated")
+        center = float(self.totals.mean)
+        width = float(self.totals.std) * sigma_max
+        return center - width, center + width
@@ -13,6 +13,7 @@ import utils
 import summarymetrics
 import data_access
 import database
+import eventtable
 from recordclass import recordclass
 
 
@@ -185,17 +186,18 @@ class DataSet(object):
                 event_filter_detid = self.event_filter_detid)
                 for label in labels]
         frames = np.array(map(lambda x: x[0], pairs))
-        event_data_dicts = map(lambda x: x[1], pairs)
-        def dict_nevents(d):
-            return len(d.values()[0].keys())
-        nevents_per_run = np.array(map(dict_nevents, event_data_dicts))
+        tables = map(lambda x: eventtable.EventTable.from_dict(x[1]), pairs)
+        # Event data is only complete on the root MPI rank, so the event
+        # counts used as weights are taken from there.
+        nevents_per_run = utils.get_comm().bcast(np.array(map(len, tables)), root = 0)
 
-        merged = utils.merge_dicts(*event_data_dicts)
+        merged = eventtable.EventTable.merge(*tables).to_dict()
         # Mean of the averaged frames, weighted by the number of events
         # processed from each run.
         mean_frame = reduce(lambda x, y: x + y,
             nevents_per_run[:, None, None] * frames)/np.sum(nevents_per_run)
-        if insert:
+        # Event data is only complete on the root MPI rank
+        if insert and utils.isroot():
             self._db_insert(mean_frame, merged, detid)
         return mean_frame, merged
 
@@ -0,0 +1,177 @@
+"""
+Append-only key-value store backing utils.persist_to_file.
+
+A SegmentStore is a directory holding:
+    -segment files (*.seg): concatenated pickled values. Each writing
+    SegmentStore instance appends to a segment file of its own, so that
+    concurrent processes never write to the same file.
+    -an index file: one line 'key segment offset length' per stored value,
+    appended under an exclusive lock. A key's last line wins.
+
+Opening a store reads the index only; values are read from their segments
+one key at a time. Overwritten values stay in their segments until the
+store is compacted (see compact), which must be done while no other
+process uses it.
+"""
+
+import os
+import time
+import fcntl
+import socket
+import tempfile
+import cPickle
+
+INDEX_NAME = 'index'
+SEGMENT_SUFFIX = '.seg'
+
+
+class SegmentStore(object):
+    """
+    Persistent mapping of string keys (without whitespace) to picklable
+    values.
+    """
+    def __init__(self, directory, pickler = cPickle):
+        self.directory = directory
+        self.pickler = pickler
+        # key -> (segment name, offset, length)
+        self.index = {}
+        # Number of bytes of the index file read so far
+        self.index_offset = 0
+        # Name of the segment file this instance appends to; created on the
+        # first write
+        self.segment = None
+        self.refresh()
+
+    def index_path(self):
+        return os.path.join(self.directory, INDEX_NAME)
+
+    def refresh(self):
+        """
+        Read index entries appended since the last call, e.g. by other
+        processes.
+        """
+        try:
+            with open(self.index_path(), 'rb') as f:
+                f.seek(self.index_offset)
+                data = f.read()
+        except IOError:
+            return
+        # Only complete lines
+        data = data[:data.rfind('\n') + 1]
+        for line in data.splitlines():
+            key, segment, offset, length = line.split()
+            self.index[key] = (segment, int(offset), int(length))
+        self.index_offset += len(data)
+
+    def __contains__(self, key):
+        if key not in self.index:
+            self.refresh()
+        return key in self.index
+
+    def __len__(self):
+        self.refresh()
+        return len(self.index)
+
+    def keys(self):
+        self.refresh()
+        return self.index.keys()
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        segment, offset, length = self.index[key]
+        with open(os.path.join(self.directory, segment), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) != length:
+            raise KeyError("%s: truncated segment %s" % (key, segment))
+        return self.pickler.loads(data)
+
+    def __setitem__(self, key, value):
+        data = self.pickler.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        if self.segment is None:
+            if not os.path.isdir(self.directory):
+                os.system('mkdir -p ' + self.directory)
+            fd, path = tempfile.mkstemp(suffix = SEGMENT_SUFFIX, dir = self.directory,
+                prefix = '%s-%d-' % (socket.gethostname(), os.getpid()))
+            os.close(fd)
+            self.segment = os.path.basename(path)
+        with open(os.path.join(self.directory, self.segment), 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+        with open(self.index_path(), 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write('%s %s %d %d\n' % (key, self.segment, offset, len(data)))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.index[key] = (self.segment, offset, len(data))
+
+    def segments(self):
+        """
+        Return the names of all segment files in the store's directory.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [name for name in names if name.endswith(SEGMENT_SUFFIX)]
+
+    def total_bytes(self):
+        """
+        Total size of the store's segment files.
+        """
+        return sum(os.path.getsize(os.path.join(self.directory, name))
+            for name in self.segments())
+
+    def live_bytes(self):
+        """
+        Total size of the values currently referenced by the index.
+        """
+        self.refresh()
+        return sum(length for segment, offset, length in self.index.itervalues())
+
+    def compact(self):
+        """
+        Rewrite the store's live values into a single segment, and delete
+        all other segments and the index entries of overwritten values.
+        Values in missing or truncated segments are dropped.
+
+        Must not be called while other processes are using the store.
+
+        Returns the number of bytes freed.
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+        self.refresh()
+        before = self.total_bytes()
+        old_segments = self.segments()
+        fd, path = tempfile.mkstemp(suffix = SEGMENT_SUFFIX, dir = self.directory,
+            prefix = 'compacted-%d-' % int(time.time()))
+        new_segment = os.path.basename(path)
+        new_index = {}
+        with os.fdopen(fd, 'wb') as out:
+            for key, (segment, offset, length) in sorted(self.index.items(),
+                    key = lambda item: item[1]):
+                try:
+                    with open(os.path.join(self.directory, segment), 'rb') as f:
+                        f.seek(offset)
+                        data = f.read(length)
+                except IOError:
+                    continue
+                if len(data) != length:
+                    continue
+                new_index[key] = (new_segment, out.tell(), length)
+                out.write(data)
+        tmp_index = self.index_path() + '.tmp%d' % os.getpid()
+        with open(tmp_index, 'wb') as f:
+            for key, (segment, offset, length) in new_index.iteritems():
+                f.write('%s %s %d %d\n' % (key, segment, offset, length))
+        os.rename(tmp_index, self.index_path())
+        for name in old_segments:
+            os.remove(os.path.join(self.directory, name))
+        self.index = new_index
+        self.index_offset = os.path.getsize(self.index_path())
+        self.segment = None
+        return before - self.total_bytes()
@@ -0,0 +1,335 @@
+"""
+Storage backends for database.py.
+
+A backend stores documents (dicts) in named collections, plus binary
+blobs. It supports the subset of MongoDB's interface that database.py
+uses:
+    -insert(collection, doc): add doc, setting its '_id'.
+    -find(collection, query, fields = None): list of matching documents,
+    or, if fields is given, of their '_id' and the given fields.
+    -remove(collection, query): delete matching documents.
+    -write_batch(ops): apply a list of (collection, doc, query) operations
+    in order, each inserting doc and, unless query is None, removing all
+    other documents matching query (see writequeue.py).
+    -put_blob(data, blob_id = None) / get_blob(blob_id) / has_blob(blob_id):
+    store, retrieve and look up a string. put_blob returns the blob's ID,
+    which is chosen by the backend unless given.
+    -ensure_index(collection, fields): index the collection on fields.
+    -get_version(collection) / bump_version(collection): a counter that
+    writers increment after changing a collection, so that readers can
+    tell whether their copy of it is current.
+Queries map field names to a value (equality) or to a dict with one of
+the operators '$eq', '$ne' or '$regex' (matched with re.search).
+
+Two implementations are provided:
+    -MongoBackend: the MongoDB instance at (MONGO_HOST, MONGO_PORT), with
+    blobs in GridFS. The client is created on first use and shared by all
+    callers in the process; pymongo pools its connections.
+    -LocalBackend: a SQLite file and a directory of blob files under a
+    local path, for offline analysis and tests.
+
+The backend is selected by config.database_backend ('mongo', the default,
+or 'local'); LocalBackend's directory is config.database_path.
+"""
+
+import os
+import re
+import sqlite3
+import hashlib
+import cPickle
+import threading
+import collections
+import config
+
+MONGO_HOST = 'pslogin03'
+MONGO_PORT = 4040
+
+# Maximum number of pooled connections to MongoDB
+MONGO_POOL_SIZE = 16
+
+# Default directory of LocalBackend
+LOCAL_PATH = 'db/local/'
+
+# Collection holding MongoBackend's collection version counters
+VERSION_COLLECTION = 'collection_versions'
+
+
+def match(doc, query):
+    """
+    Return True if doc matches query.
+    """
+    for field, condition in query.iteritems():
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            for op, operand in condition.iteritems():
+                if op == '$eq' and value != operand:
+                    return False
+                elif op == '$ne' and value == operand:
+                    return False
+                elif op == '$regex' and not (isinstance(value, basestring)
+                        and re.search(operand, value)):
+                    return False
+                elif op not in ('$eq', '$ne', '$regex'):
+                    raise ValueError("Unsupported query operator: " + op)
+        elif value != condition:
+            return False
+    return True
+
+
+class MongoBackend(object):
+    def __init__(self, host = MONGO_HOST, port = MONGO_PORT):
+        self.host = host
+        self.port = port
+        self._client = None
+        self._fs = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from pymongo import MongoClient
+            self._client = MongoClient(self.host, self.port, maxPoolSize = MONGO_POOL_SIZE)
+        return self._client
+
+    @property
+    def fs(self):
+        # Use GridFS to store objects > 16 MB
+        if self._fs is None:
+            import gridfs
+            self._fs = gridfs.GridFS(self.client.database)
+        return self._fs
+
+    def collection(self, name):
+        return self.client.database[name]
+
+    def insert(self, collection, doc):
+        return self.collection(collection).insert(doc, check_keys = False)
+
+    def find(self, collection, query, fields = None):
+        return list(self.collection(collection).find(query, fields))
+
+    def remove(self, collection, query):
+        self.collection(collection).remove(query)
+
+    def write_batch(self, ops):
+        # One insert and at most one remove per collection. An operation's
+        # query mustn't remove documents inserted by it or later operations.
+        from bson.objectid import ObjectId
+        by_collection = collections.OrderedDict()
+        for collection, doc, query in ops:
+            doc.setdefault('_id', ObjectId())
+            by_collection.setdefault(collection, []).append((doc, query))
+        for collection, entries in by_collection.iteritems():
+            self.collection(collection).insert([doc for doc, query in entries],
+                check_keys = False)
+            stale =\
+                [dict(query, _id = {'$nin': [doc['_id'] for doc, _ in entries[i:]]})
+                for i, (doc, query) in enumerate(entries)
+                if query is not None]
+            if stale:
+                self.collection(collection).remove({'$or': stale})
+
+    def ensure_index(self, collection, fields):
+        self.collection(collection).create_index([(field, 1) for field in fields])
+
+    def get_version(self, collection):
+        doc = self.collection(VERSION_COLLECTION).find_one({'collection': collection})
+        if doc is None:
+            return 0
+        return doc['version']
+
+    def bump_version(self, collection):
+        self.collection(VERSION_COLLECTION).update({'collection': collection},
+            {'$inc': {'version': 1}}, upsert = True)
+
+    def put_blob(self, data, blob_id = None):
+        import gridfs
+        if blob_id is None:
+            return self.fs.put(data)
+        try:
+            return self.fs.put(data, _id = blob_id)
+        except gridfs.errors.FileExists:
+            # Stored concurrently by another process
+            return blob_id
+
+    def has_blob(self, blob_id):
+        return self.fs.exists(blob_id)
+
+    def get_blob(self, blob_id):
+        import gridfs
+        try:
+            return self.fs.get(blob_id).read()
+        except gridfs.errors.NoFile:
+            raise KeyError("%s: blob not found" % blob_id)
+
+
+def index_value(value):
+    """
+    Representation of a document field value in LocalBackend's field index.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return sqlite3.Binary(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+
+class LocalBackend(object):
+    """
+    Documents are pickled into a SQLite table indexed by collection, and
+    the values of indexed fields are copied to a table indexed by (collection,
+    field, value). Blobs are files named by their IDs (by default the sha1
+    hash of their contents).
+
+    Each thread uses its own SQLite connection.
+    """
+    def __init__(self, path = LOCAL_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            if not os.path.isdir(self.path):
+                os.system('mkdir -p ' + self.path)
+            self._local.connection = sqlite3.connect(os.path.join(self.path, 'index.sqlite'),
+                timeout = 60)
+            for statement in [
+                    'CREATE TABLE IF NOT EXISTS documents '
+                        '(id INTEGER PRIMARY KEY AUTOINCREMENT, collection TEXT, body BLOB)',
+                    'CREATE INDEX IF NOT EXISTS documents_collection ON documents (collection)',
+                    'CREATE TABLE IF NOT EXISTS indexes '
+                        '(collection TEXT, field TEXT, PRIMARY KEY (collection, field))',
+                    'CREATE TABLE IF NOT EXISTS fields '
+                        '(doc_id INTEGER, collection TEXT, field TEXT, value BLOB)',
+                    'CREATE INDEX IF NOT EXISTS fields_value ON fields (collection, field, value)',
+                    'CREATE INDEX IF NOT EXISTS fields_doc ON fields (doc_id)',
+                    'CREATE TABLE IF NOT EXISTS versions '
+                        '(collection TEXT PRIMARY KEY, version INTEGER)']:
+                self._local.connection.execute(statement)
+            self._local.connection.commit()
+        return self._local.connection
+
+    def indexed_fields(self, collection):
+        return set(field for (field,) in self.connection.execute(
+            'SELECT field FROM indexes WHERE collection = ?', (collection,)))
+
+    def ensure_index(self, collection, fields):
+        new_fields = set(fields) - self.indexed_fields(collection)
+        if not new_fields:
+            return
+        docs = self.find(collection, {})
+        with self.connection:
+            for field in new_fields:
+                self.connection.execute('INSERT OR IGNORE INTO indexes VALUES (?, ?)',
+                    (collection, field))
+                self.connection.executemany('INSERT INTO fields VALUES (?, ?, ?, ?)',
+                    [(doc['_id'], collection, field, index_value(doc[field]))
+                    for doc in docs if field in doc])
+
+    def get_version(self, collection):
+        row = self.connection.execute('SELECT version FROM versions WHERE collection = ?',
+            (collection,)).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def bump_version(self, collection):
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO versions VALUES (?, 0)', (collection,))
+            self.connection.execute('UPDATE versions SET version = version + 1 '
+                'WHERE collection = ?', (collection,))
+
+    def blob_dir(self):
+        return os.path.join(self.path, 'blobs')
+
+    def insert(self, collection, doc):
+        indexed = self.indexed_fields(collection)
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO documents (collection, body) VALUES (?, ?)',
+                (collection, sqlite3.Binary(cPickle.dumps(doc, cPickle.HIGHEST_PROTOCOL))))
+            self.connection.executemany('INSERT INTO fields VALUES (?, ?, ?, ?)',
+                [(cursor.lastrowid, collection, field, index_value(doc[field]))
+                for field in indexed if field in doc])
+        doc['_id'] = cursor.lastrowid
+        return doc['_id']
+
+    def find(self, collection, query, fields = None):
+        # Select candidates by the equality conditions on indexed fields,
+        # then apply the full query to them
+        sql = 'SELECT id, body FROM documents WHERE collection = ?'
+        params = [collection]
+        indexed = self.indexed_fields(collection)
+        for field, condition in query.iteritems():
+            if isinstance(condition, dict) and condition.keys() == ['$eq']:
+                condition = condition['$eq']
+            if field in indexed and condition is not None and not isinstance(condition, dict):
+                sql += (' AND id IN (SELECT doc_id FROM fields WHERE collection = ?'
+                    ' AND field = ? AND value = ?)')
+                params += [collection, field, index_value(condition)]
+        result = []
+        for doc_id, body in self.connection.execute(sql + ' ORDER BY id', params):
+            doc = cPickle.loads(str(body))
+            doc['_id'] = doc_id
+            if match(doc, query):
+                if fields is not None:
+                    doc = {k: v for k, v in doc.iteritems() if k in fields or k == '_id'}
+                result.append(doc)
+        return result
+
+    def remove(self, collection, query):
+        ids = [(doc['_id'],) for doc in self.find(collection, query)]
+        with self.connection:
+            self.connection.executemany('DELETE FROM documents WHERE id = ?', ids)
+            self.connection.executemany('DELETE FROM fields WHERE doc_id = ?', ids)
+
+    def write_batch(self, ops):
+        for collection, doc, query in ops:
+            inserted = self.insert(collection, doc)
+            if query is not None:
+                self.remove(collection, dict(query, _id = {'$ne': inserted}))
+
+    def put_blob(self, data, blob_id = None):
+        if blob_id is None:
+            blob_id = hashlib.sha1(data).hexdigest()
+        path = os.path.join(self.blob_dir(), blob_id)
+        if not os.path.exists(path):
+            if not os.path.isdir(self.blob_dir()):
+                os.system('mkdir -p ' + self.blob_dir())
+            tmp_name = path + '.tmp%d' % os.getpid()
+            with open(tmp_name, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_name, path)
+        return blob_id
+
+    def has_blob(self, blob_id):
+        return os.path.exists(os.path.join(self.blob_dir(), blob_id))
+
+    def get_blob(self, blob_id):
+        try:
+            with open(os.path.join(self.blob_dir(), blob_id), 'rb') as f:
+                return f.read()
+        except IOError:
+            raise KeyError("%s: blob not found" % blob_id)
+
+
+# The process's backend; created by get_backend() on first use.
+backend_state = {'backend': None}
+
+def get_backend():
+    """
+    Return the process's storage backend, creating it on first use.
+    """
+    if backend_state['backend'] is None:
+        name = getattr(config, 'database_backend', 'mongo')
+        if name == 'mongo':
+            backend_state['backend'] = MongoBackend()
+        elif name == 'local':
+            backend_state['backend'] = LocalBackend(getattr(config, 'database_path', LOCAL_PATH))
+        else:
+            raise ValueError("config.database_backend: invalid value: %s" % name)
+    return backend_state['backend']
+
+def set_backend(backend):
+    """
+    Use backend for all subsequent database operations.
+    """
+    backend_state['backend'] = backend
@@ -5,6 +5,7 @@ import config
 import numpy as np
 import matplotlib.pyplot as plt
 from dataccess import utils
+from dataccess.eventtable import EventTable
 
 import playback
 
@@ -24,7 +25,7 @@ def get_detector_data_all_events(labels, detid, funcstr = None, func = None, plo
         except:
             args = ['()']
         label = (label + "; filter params: %s" % ','.join(map(str, args))) 
-        arr = filter(lambda x: not np.isnan(x), arr)
+        arr = arr[~np.isnan(arr)]
         plt.hist(arr, bins = nbins, alpha = 0.5, label = label, **kwargs)
     @playback.db_insert
     @utils.ifplot
@@ -66,23 +67,22 @@ def get_detector_data_all_events(labels, detid, funcstr = None, func = None, plo
                 except ValueError:# no events found in one or more runs in label
                     print label, ": no events found"
                     pass
-        merged = utils.merge_dicts(*event_data_dicts)
+        tables = map(EventTable.from_dict, event_data_dicts)
+        merged = EventTable.merge(*tables)
         if plot:
             if separate:
-                for d, label in zip(event_data_dicts, labels):
-                    event_data_list = data.event_data_dict_to_list(d)
-                    plot(event_data_list, label =  label)
+                for table, label in zip(tables, labels):
+                    plot(table.value, label =  label)
             else:
-                event_data_list = data.event_data_dict_to_list(merged)
-                plot(event_data_list, label = label)
+                plot(merged.value, label = label)
             finalize_plot()
             show()
-        result = np.array(data.event_data_dict_to_list(merged))
+        result = merged.value
         #print "RESULT IS", event_data
         # header kwarg is passed to np.savetxt
-        for d, label in zip(event_data_dicts, labels):
-            utils.save_0d_event_data(basepath + '_' + label + '.dat', d, header = "Run\tevent\tvalue")
-        utils.save_0d_event_data(merged_path + '.dat', d, header = "Run\tevent\tvalue")
+        for table, label in zip(tables, labels):
+            utils.save_0d_event_data(basepath + '_' + label + '.dat', table, header = "Run\tevent\tvalue")
+        utils.save_0d_event_data(merged_path + '.dat', merged, header = "Run\tevent\tvalue")
         return result
     return depends_on_data_access()
 
@@ -12,7 +12,14 @@ import hashlib
 import itertools
 import database
 import playback
+import cachemanager
+import segmentstore
 import random
+import inspect
+import mmap
+import weakref
+import collections
+from contextlib import contextmanager
 #from datetime import import datetime
 #from atomicwrites import atomic_write
 #import collections
@@ -77,10 +84,179 @@ def mpimap(func, lst):
         results = list(roundrobin(*results))
     return results
 
+def mpimap_grouped(func, lst, ngroups, strip = None):
+    """
+    Map func over list with two levels of parallelism: COMM_WORLD is split
+    into ngroups sub-communicators, elements of lst are assigned to groups in
+    round-robin order, and within each group func is evaluated with
+    get_comm() returning the group's communicator, so that func may itself
+    parallelize over the ranks of its group.
+
+    The full result is returned on rank 0 of COMM_WORLD. If strip is
+    provided, the other ranks get a list of strip(result) for each element
+    instead (e.g. with event data, which is only needed on rank 0, left
+    out); otherwise they get the full result as well.
+    """
+    from mpi4py import MPI
+    world = MPI.COMM_WORLD
+    rank = world.Get_rank()
+    ngroups = max(1, min(ngroups, world.Get_size(), len(lst)))
+    color = rank % ngroups
+    group = world.Split(color, rank)
+    results = {}
+    errors = []
+    with comm_context(group):
+        for n, elt in enumerate(lst):
+            if n % ngroups == color:
+                try:
+                    results[n] = func(elt)
+                except Exception, e:
+                    # Defer raising so that no rank is left waiting in the
+                    # allgather below.
+                    errors.append(e)
+                    break
+    # One copy of each group's results is enough
+    if group.Get_rank() != 0:
+        results = {}
+    group.Free()
+    gathered_errors = reduce(lambda x, y: x + y, world.allgather(errors))
+    if gathered_errors:
+        raise gathered_errors[0]
+    if strip is None:
+        merged = merge_dicts(*world.allgather(results))
+    else:
+        gathered = world.gather(results, root = 0)
+        stripped = world.allgather({n: strip(result) for n, result in results.iteritems()})
+        if rank == 0:
+            merged = merge_dicts(*gathered)
+        else:
+            merged = merge_dicts(*stripped)
+    return [merged[n] for n in range(len(lst))]
+
+def event_data_descriptor(event_data):
+    """
+    Return (dtype string, value shape) if all values in an event data dict
+    are numeric scalars or numeric arrays of a common dtype and shape,
+    'pickle' if they aren't, and None if the dict is empty.
+    """
+    descriptors = set()
+    for value in event_data.itervalues():
+        value = np.asarray(value)
+        if value.dtype.kind not in 'biuf':
+            return 'pickle'
+        descriptors.add((value.dtype.str, value.shape))
+        if len(descriptors) > 1:
+            return 'pickle'
+    if not descriptors:
+        return None
+    return descriptors.pop()
+
+def gather_event_data(comm, event_data, allgather = False):
+    """
+    Merge the event data dicts ({nevent: value}) of all ranks of comm.
+
+    If every rank's values are numeric scalars or numeric arrays of one
+    shape and dtype, they are transferred as typed buffers with Gatherv (or
+    Allgatherv); otherwise the dicts are pickled.
+
+    If event_data has a memory budget (see eventstore.RunEventData), the
+    transfer is split into rounds so that the receiving ranks hold at most
+    about one budget's worth of received values at a time, and the merged
+    data is returned in a container of the same kind.
+
+    Returns the merged dict on rank 0, or on all ranks if allgather is True.
+    Other ranks get an empty dict.
+    """
+    from mpi4py import MPI
+    rank = comm.Get_rank()
+    descriptor = event_data_descriptor(event_data)
+    descriptors = set(filter(lambda d: d is not None, comm.allgather(descriptor)))
+    if len(descriptors) > 1 or 'pickle' in descriptors:
+        if allgather:
+            return merge_dicts(*comm.allgather(event_data))
+        gathered = comm.gather(event_data, root = 0)
+        if rank == 0:
+            return merge_dicts(*gathered)
+        return {}
+    if not descriptors:
+        return {}
+    dtype_str, value_shape = descriptors.pop()
+    # MPI has no portable boolean type, so booleans travel as bytes
+    transfer_dtype = 'u1' if np.dtype(dtype_str).kind == 'b' else dtype_str
+    value_size = int(np.prod(value_shape))
+    nevents = np.array(sorted(event_data.keys()), dtype = 'int64')
+    budget = getattr(event_data, 'budget', None)
+    if budget is None:
+        block_size = max(len(nevents), 1)
+    else:
+        value_nbytes = value_size * np.dtype(transfer_dtype).itemsize
+        block_size = max(budget // (value_nbytes * comm.Get_size()), 1)
+    nrounds = comm.allreduce(-(-len(nevents) // block_size), op = MPI.MAX)
+    receives = allgather or rank == 0
+    if receives and hasattr(event_data, 'empty_like'):
+        merged = event_data.empty_like()
+    else:
+        merged = {}
+    for i in range(nrounds):
+        block = nevents[i * block_size: (i + 1) * block_size]
+        values = np.empty((len(block),) + value_shape, dtype = transfer_dtype)
+        for row, nevent in enumerate(block):
+            values[row] = event_data[nevent]
+        counts = np.array(comm.allgather(len(block)))
+        if receives:
+            all_nevents = np.empty(np.sum(counts), dtype = 'int64')
+            all_values = np.empty((np.sum(counts),) + value_shape, dtype = transfer_dtype)
+            nevents_recv = [all_nevents, counts]
+            values_recv = [all_values, counts * value_size]
+        else:
+            nevents_recv = values_recv = None
+        if allgather:
+            comm.Allgatherv(block, nevents_recv)
+            comm.Allgatherv(values, values_recv)
+        else:
+            comm.Gatherv(block, nevents_recv, root = 0)
+            comm.Gatherv(values, values_recv, root = 0)
+        if receives:
+            all_values = all_values.astype(dtype_str)
+            if value_shape == ():
+                all_values = all_values.tolist()
+            merged.update(zip(all_nevents.tolist(), all_values))
+    return merged
+
+# Communicator returned by get_comm(); None means MPI.COMM_WORLD.
+comm_state = {'comm': None}
+
+def get_comm():
+    """
+    Return the MPI communicator over which data access should be
+    parallelized. This is COMM_WORLD unless a comm_context is active.
+    """
+    if comm_state['comm'] is not None:
+        return comm_state['comm']
+    from mpi4py import MPI
+    return MPI.COMM_WORLD
+
+@contextmanager
+def comm_context(comm):
+    """
+    Context manager that makes get_comm() (and isroot()) refer to comm
+    instead of COMM_WORLD.
+    """
+    previous = comm_state['comm']
+    comm_state['comm'] = comm
+    try:
+        yield comm
+    finally:
+        comm_state['comm'] = previous
+
 def isroot():
     """
     Return true if the MPI core rank is 0 and false otherwise.
+
+    Within a comm_context the rank is that of the active communicator.
     """
+    if comm_state['comm'] is not None:
+        return comm_state['comm'].Get_rank() == 0
     if 'OMPI' not in ' '.join(os.environ.keys()):
         return True
     else:
@@ -161,7 +337,7 @@ def flatten_dict(d):
     The dict must be "rectangular" (i.e. all leafs are at the same depth)
     """
     def walkdict(d, parents = []):
-        if not isinstance(d, dict):
+        if not isinstance(d, collections.Mapping):
             for p in parents:
                 yield p
             yield d
@@ -170,7 +346,7 @@ def flatten_dict(d):
                 for elt in walkdict(d[k], parents + [k]):
                     yield elt
     def dict_depth(d, depth=0):
-        if not isinstance(d, dict) or not d:
+        if not isinstance(d, collections.Mapping) or not d:
             return depth
         return max(dict_depth(v, depth+1) for k, v in d.iteritems())
     depth = dict_depth(d) + 1
@@ -181,15 +357,19 @@ def flatten_dict(d):
         raise ValueError("Dictionary of incorrect format given to flatten_dict: " + e)
 
 @ifroot
-def save_0d_event_data(save_path, event_data_dict, **kwargs):
+def save_0d_event_data(save_path, event_data, **kwargs):
     """
-    Save an event data dictionary to file in the following column format:
+    Save event data (an event data dictionary or an eventtable.EventTable)
+    to file in the following column format:
         run number, event number, value
     """
+    from dataccess.eventtable import EventTable
+    if not isinstance(event_data, EventTable):
+        event_data = EventTable.from_dict(event_data)
     dirname = os.path.dirname(save_path)
     if dirname and (not os.path.exists(dirname)):
         os.system('mkdir -p ' + os.path.dirname(save_path))
-    np.savetxt(save_path, flatten_dict(event_data_dict), **kwargs)
+    np.savetxt(save_path, event_data.sort().to_array(), **kwargs)
 
 
 def save_image_and_show(save_path, imarr, title = 'Image', rmin = None, rmax = None, show_plot = True):
@@ -237,6 +417,19 @@ def get_default_args(func):
     else:
         return {}
 
+def is_default_arg(defaults, name, value):
+    """
+    Return True if value is (or, for immutable values, equals) the default
+    value of argument name, given a dict returned by get_default_args.
+    """
+    if name not in defaults:
+        return False
+    default = defaults[name]
+    if value is default:
+        return True
+    return isinstance(value, IMMUTABLE_TYPES) and isinstance(default, IMMUTABLE_TYPES)\
+        and type(value) == type(default) and value == default
+
 def resource_f(fpath):
     from StringIO import StringIO
     return StringIO(pkg_resources.resource_string(PKG_NAME, fpath))
@@ -267,21 +460,99 @@ def extrap1d(interpolator):
 
     return ufunclike
 
+# Types whose instances can't change after creation; make_hashable memoizes
+# the hashes of such objects (and of tuples and frozensets of them, and of
+# read-only memory maps of files) by id.
+IMMUTABLE_TYPES = (str, unicode, int, long, float, bool, complex, type(None))
+
+# Maximum number of entries in hash_memo before it is cleared
+HASH_MEMO_SIZE = 4096
+
+# id(obj) -> (reference to obj, hash). Holding a reference to obj ensures
+# that its id isn't reused while the entry exists. ndarrays are referenced
+# weakly, so that the memo doesn't keep large arrays alive; a dead reference
+# likewise can't match a new object with the same id.
+hash_memo = {}
+
+def is_immutable(obj):
+    """
+    Return True if obj is an instance of IMMUTABLE_TYPES, an ndarray whose
+    data can't be changed (see is_readonly_file_map), or a tuple or
+    frozenset of immutable objects other than ndarrays.
+    """
+    if isinstance(obj, IMMUTABLE_TYPES):
+        return True
+    if isinstance(obj, np.ndarray):
+        return not obj.dtype.hasobject and is_readonly_file_map(obj)
+    if isinstance(obj, (tuple, frozenset)):
+        # Containers are memoized by strong reference, which mustn't pin
+        # arrays in memory
+        return all(is_immutable(x) and not isinstance(x, np.ndarray) for x in obj)
+    return False
+
+def is_readonly_file_map(arr):
+    """
+    Return True if arr is a memory map (np.memmap with mode 'r') of a file
+    opened read-only. Unlike other read-only arrays, whose owner can set
+    flags.writeable back to True, such an array's data can't be modified.
+    """
+    return isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap)\
+        and arr.mode == 'r'
+
+def hash_array(arr):
+    """
+    Return the sha1 hash of an ndarray's dtype, shape and contents. Arrays
+    of non-object dtype are hashed directly from their data buffer.
+    """
+    h = hashlib.sha1()
+    h.update(arr.dtype.str + str(arr.shape))
+    if arr.dtype.hasobject:
+        h.update(dill.dumps(arr))
+    else:
+        h.update(np.ascontiguousarray(arr).data)
+    if isinstance(arr, np.ma.MaskedArray):
+        h.update(hash_array(np.ma.getmaskarray(arr)))
+    return h.hexdigest()
+
 def make_hashable(obj):
     """
     return a hash of any python object
+
+    Objects whose class defines a __cache_key__ method are hashed by its
+    return value (used as is if it's a string). ndarrays are hashed by
+    hash_array. Hashes of immutable objects are memoized by identity.
     """
-    if isinstance(obj, str) or isinstance(obj, np.ndarray):
-        return hashlib.sha1(dill.dumps(obj)).hexdigest()
-    try:
-        # This is a workaround for a cryptic error that occrs in pickle when
-        # obj is an iterable type (specifically: 'I/O operation on closed file')
-        slist =\
-            [make_hashable(x)
-            for x in obj]
-        return hashlib.sha1(''.join(slist)).hexdigest()
-    except TypeError:
-        return hashlib.sha1(dill.dumps(obj)).hexdigest()
+    memo_entry = hash_memo.get(id(obj))
+    if memo_entry is not None and memo_entry[0]() is obj:
+        return memo_entry[1]
+    if hasattr(type(obj), '__cache_key__'):
+        key = obj.__cache_key__()
+        if isinstance(key, str):
+            return key
+        return make_hashable(key)
+    if isinstance(obj, np.ndarray):
+        result = hash_array(obj)
+    elif isinstance(obj, str):
+        result = hashlib.sha1(dill.dumps(obj)).hexdigest()
+    else:
+        try:
+            # This is a workaround for a cryptic error that occrs in pickle when
+            # obj is an iterable type (specifically: 'I/O operation on closed file')
+            slist =\
+                [make_hashable(x)
+                for x in obj]
+            result = hashlib.sha1(''.join(slist)).hexdigest()
+        except TypeError:
+            result = hashlib.sha1(dill.dumps(obj)).hexdigest()
+    if isinstance(obj, (basestring, tuple, frozenset, np.ndarray)) and is_immutable(obj):
+        if len(hash_memo) >= HASH_MEMO_SIZE:
+            hash_memo.clear()
+        if isinstance(obj, np.ndarray):
+            ref = weakref.ref(obj)
+        else:
+            ref = lambda: obj
+        hash_memo[id(obj)] = (ref, result)
+    return result
 
 def hashable_dict(d):
     """
@@ -349,56 +620,58 @@ def memoize(timeout = None):
         return new_func
     return decorator
 
+def migrate_persist_file(file_name, store):
+    """
+    If file_name is a cache file written by the old, single-pickle
+    persist_to_file, move it (and its sidecar arrays) to file_name + '.old'
+    and copy its entries into store, so that the store's directory can be
+    created at file_name.
+    """
+    if not os.path.isfile(file_name):
+        return
+    old_name = file_name + '.old'
+    try:
+        # Only one process gets to migrate a given file
+        os.rename(file_name, old_name)
+    except OSError:
+        return
+    if os.path.isdir(cachemanager.sidecar_dir(file_name)):
+        os.rename(cachemanager.sidecar_dir(file_name), cachemanager.sidecar_dir(old_name))
+    print "Migrating old-format cache file %s (moved to %s)" % (file_name, old_name)
+    try:
+        old_cache = cachemanager.load(old_name, pickler = dill)
+    except (EnvironmentError, EOFError, ValueError), e:
+        print "Could not read %s: %s" % (old_name, e)
+        return
+    for (args, kwarg_items, closure_items), value in old_cache.iteritems():
+        try:
+            key = make_hashable((dill.loads(args), sorted(kwarg_items), sorted(closure_items)))
+        except Exception, e:
+            print "Skipping unreadable entry of %s: %s" % (old_name, e)
+            continue
+        store[key] = value
+
 def persist_to_file(file_name):
     """
     Decorator for memoizing function calls to disk
 
     Inputs:
-        file_name: File name prefix for the cache file(s)
+        file_name: Directory of the segmentstore.SegmentStore holding the
+        cached values.
+
+    Each value is appended to the store when it's computed and read back
+    individually the first time it's requested in a process, so that the
+    cost of a call doesn't depend on the size of the cache, and concurrent
+    processes can share the store. Use SegmentStore.compact (or 'mecana
+    cache compact') to reclaim the space of overwritten values.
     """
-    # Optimization: initialize the cache dict but don't load data from disk
-    # until the memoized function is called.
+    store = segmentstore.SegmentStore(file_name, pickler = dill)
+    migrate_persist_file(file_name, store)
+    # Values read or computed in this process
     cache = {}
 
-    # These are the hoops we need to jump through because python doesn't allow
-    # assigning to variables in enclosing scope:
-    state = {'loaded': False, 'cache_changed': False}
-    def check_cache_loaded():
-        return state['loaded']
-    def flag_cache_loaded():
-        state['loaded'] = True
-    def check_cache_changed():
-        return state['cache_changed']
-    def flag_cache_changed():
-        return state['cache_changed']
-
-    def dump():
-        os.system('mkdir -p ' + os.path.dirname(file_name))
-        with open(file_name, 'w') as f:
-            dill.dump(cache, f)
-
     def decorator(func):
         #check if function is a closure and if so construct a dict of its bindings
-        def compute(key):
-            if not check_cache_loaded():
-                try:
-                    with open(file_name, 'r') as f:
-                        to_load = dill.load(f)
-                        for k, v in to_load.items():
-                            cache[k] = v
-                except (IOError, ValueError):
-                    #print "no cache file found"
-                    pass
-                flag_cache_loaded()
-            if not key in cache.keys():
-                cache[key] = func(*dill.loads(key[0]), **{k: v for k, v in key[1]})
-                if not check_cache_changed():
-                    # write cache to file at interpreter exit if it has been
-                    # altered
-                    import atexit
-                    atexit.register(dump)
-                    flag_cache_changed()
-
         if func.func_code.co_freevars:
             closure_dict = hashable_dict(dict(zip(func.func_code.co_freevars, (c.cell_contents for c in func.func_closure))))
         else:
@@ -407,19 +680,86 @@ def persist_to_file(file_name):
         def new_func(*args, **kwargs):
             # if the "flush" kwarg is passed, recompute regardless of whether
             # the result is cached
-            if "flush" in kwargs.keys():
-                kwargs.pop("flush", None)
-                key = (dill.dumps(args), frozenset(kwargs.items()), frozenset(closure_dict.items()))
-                compute(key)
-            key = (dill.dumps(args), frozenset(kwargs.items()), frozenset(closure_dict.items()))
-            if key not in cache:
-                compute(key)
+            flush = kwargs.pop("flush", False)
+            key = make_hashable((args, sorted(kwargs.items()), sorted(closure_dict.items())))
+            if not flush:
+                if key in cache:
+                    return cache[key]
+                if key in store:
+                    try:
+                        cache[key] = store[key]
+                        return cache[key]
+                    except (KeyError, EOFError, ValueError):
+                        pass
+            cache[key] = func(*args, **kwargs)
+            store[key] = cache[key]
             return cache[key]
         return new_func
 
     return decorator
 
-def eager_persist_to_file(file_name, excluded = None, rootonly = True):
+def canonical_config_value(obj):
+    """
+    Return a representation of a config value whose make_hashable hash
+    depends on all of its contents: dicts are replaced by sorted tuples of
+    their items, and strings naming existing files (e.g. mask paths) are
+    paired with the file's size and modification time.
+    """
+    if isinstance(obj, dict):
+        return tuple(sorted((k, canonical_config_value(v)) for k, v in obj.iteritems()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(canonical_config_value(x) for x in obj)
+    if isinstance(obj, basestring) and os.path.isfile(obj):
+        st = os.stat(obj)
+        return (obj, st.st_size, st.st_mtime)
+    return obj
+
+# tuple of config field names -> config_fingerprint value
+config_fingerprints = {}
+
+def config_fingerprint(config_fields):
+    """
+    Return a hash of the values of the named attributes of config. Computed
+    once per process for each list of fields, since config.py is only read
+    at startup.
+    """
+    fields = tuple(config_fields)
+    if fields not in config_fingerprints:
+        config_fingerprints[fields] =\
+            make_hashable(tuple((field, canonical_config_value(getattr(config, field, None)))
+            for field in fields))
+    return config_fingerprints[fields]
+
+def source_fingerprint(func, depends_on = None):
+    """
+    Return a hash of func's source code, or of its bytecode if the source
+    isn't available, and of the source code of the modules or functions in
+    depends_on.
+    """
+    def get_source(obj):
+        try:
+            return inspect.getsource(obj)
+        except (IOError, TypeError):
+            code = getattr(obj, 'func_code', None)
+            if code is None:
+                return repr(obj)
+            return code.co_code + repr(code.co_consts)
+    return hashlib.sha1(''.join(map(get_source, [func] + list(depends_on or [])))).hexdigest()
+
+def describe_call_argument(value):
+    """
+    Return a JSON-serializable summary of a function argument for cache
+    file metadata.
+    """
+    simple_types = (basestring, int, long, float, bool, type(None))
+    if isinstance(value, simple_types):
+        return value
+    if isinstance(value, (list, tuple)) and all(isinstance(x, simple_types) for x in value):
+        return list(value)
+    return repr(value)[:80]
+
+def eager_persist_to_file(file_name, excluded = None, rootonly = True, collective = False,
+        config_fields = None, extra_key = None, strip_event_data = None, depends_on = None):
     """
     Decorator for memoizing function calls to disk.
     Differs from persist_to_file in that the cache file is accessed and updated
@@ -430,10 +770,48 @@ def eager_persist_to_file(file_name, excluded = None, rootonly = True):
 
     Inputs:
         file_name: File name prefix for the cache file(s)
+        excluded : list of str
+                Names of keyword arguments that don't affect the decorated
+                function's return value and are left out of the cache key.
         rootonly : boolean
                 If true, caching is only applied for the MPI process of rank 0.
+        collective : boolean
+                Set for functions that are called by all ranks of get_comm()
+                together. Rank 0 then decides whether a call's value is
+                cached and broadcasts its decision, so that either all ranks
+                evaluate the function or none do. Cached values are read by
+                rank 0 and broadcast, except for those with memory-mapped
+                sidecar arrays, which every rank maps from disk (and which
+                are recomputed by all ranks if any rank fails to load them).
+        config_fields : list of str
+                Names of config attributes (e.g. 'detinfo_map') that the
+                decorated function's return value depends on.
+        extra_key : function
+                Called with the decorated function's arguments; its return
+                value is included in the cache key. For inputs the return
+                value depends on that aren't arguments (e.g. a label's runs).
+        strip_event_data : function
+                For collective functions whose event data is only returned
+                on rank 0: returns a value without its event data. Cached
+                values broadcast by rank 0 are passed through it, unless
+                the call passes event_data_allgather = True.
+        depends_on : list
+                Modules and (undecorated) functions that the decorated
+                function calls and whose source code is included in its
+                source hash.
+
+    Cache keys include a hash of the source code of the decorated function
+    (and of depends_on) and of the values of config_fields, so that editing
+    either invalidates previously cached values. A JSON metadata file
+    describing each call is written next to its cache file for use by
+    cachemanager.main.
+
+    Values are held in memory and on disk subject to the limits set in
+    cachemanager. The decorated function's cache statistics are available
+    as its cache_stats attribute.
     """
-    cache = {}
+    stats = cachemanager.get_stats(file_name)
+    cachemanager.disk.register(file_name)
 
     def decorator(func):
         #check if function is a closure and if so construct a dict of its bindings
@@ -441,6 +819,16 @@ def eager_persist_to_file(file_name, excluded = None, rootonly = True):
             closure_dict = hashable_dict(dict(zip(func.func_code.co_freevars, (c.cell_contents for c in func.func_closure))))
         else:
             closure_dict = {}
+        source_hash = source_fingerprint(func, depends_on)
+
+        def provenance():
+            """
+            Return the source and config hashes that current cache keys of
+            func depend on.
+            """
+            return {'source': source_hash,
+                'config': config_fingerprint(config_fields or [])}
+        cachemanager.register_function(file_name, func.func_name, provenance)
 
         def gen_key(*args, **kwargs):
             """
@@ -450,7 +838,8 @@ def eager_persist_to_file(file_name, excluded = None, rootonly = True):
             #return tuple(map(make_hashable, [args, kwargs.items()]))
             # union of default bindings in func and the kwarg bindings in new_func
             # TODO: merged_dict: why aren't changes in kwargs reflected in it?
-            merged_dict = get_default_args(func)
+            defaults = get_default_args(func)
+            merged_dict = dict(defaults)
             if not merged_dict:
                 merged_dict = kwargs
             else:
@@ -461,57 +850,170 @@ def eager_persist_to_file(file_name, excluded = None, rootonly = True):
                 for k in merged_dict.keys():
                     if k in excluded:
                         merged_dict.pop(k)
-            key = make_hashable(tuple(map(make_hashable, [args, merged_dict, closure_dict.items(), list(kwargs.iteritems())])))
+            # Keyword arguments explicitly passed with their default values
+            # are left out, so that such calls share a key with calls that
+            # omit them.
+            # Items are sorted so that the key doesn't depend on dict
+            # iteration order.
+            kwarg_items = sorted(
+                [(k, v)
+                for k, v in kwargs.iteritems()
+                if not (excluded and k in excluded) and not is_default_arg(defaults, k, v)])
+            key_items = [args, sorted(merged_dict.items()), sorted(closure_dict.items()),
+                kwarg_items, sorted(provenance().items())]
+            if extra_key is not None:
+                key_items.append(extra_key(*args, **kwargs))
+            key = make_hashable(tuple(map(make_hashable, key_items)))
             #print "key is", key
 #            for k, v in kwargs.iteritems():
 #                print k, v
             return key
 
         @ifroot# TODO: fix this
-        def dump_to_file(d, file_name):
+        def dump_to_file(d, file_name, args, kwargs):
             os.system('mkdir -p ' + os.path.dirname(file_name))
-            with open(file_name, 'w') as f:
-                cPickle.dump(d, f)
+            cachemanager.dump(d, file_name)
+            meta = provenance()
+            meta.update({'function': func.func_name, 'prefix': stats.name,
+                'time': time(),
+                'args': map(describe_call_argument, args),
+                'kwargs': {k: describe_call_argument(v) for k, v in kwargs.iteritems()}})
+            cachemanager.write_meta(file_name, meta)
+            stats.bytes_written += cachemanager.file_size(file_name)
+            cachemanager.disk.add(file_name)
             #print "Dumped cache to file"
+
+        def load(full_name):
+            """
+            Return the cached value stored under full_name, from memory or
+            disk. Raises KeyError if there is none.
+            """
+            if full_name in cachemanager.memory:
+                stats.memory_hits += 1
+                return cachemanager.memory[full_name]
+            try:
+                value = cachemanager.load(full_name)
+            except EOFError:
+                cachemanager.remove(full_name)
+                print "corrupt cache file deleted"
+                raise KeyError(full_name)
+            except (EnvironmentError, ValueError):
+                # EnvironmentError includes mmap.error
+                raise KeyError(full_name)
+            stats.disk_hits += 1
+            stats.bytes_read += os.path.getsize(full_name)
+            cachemanager.disk.touch(full_name)
+            cachemanager.memory.put(full_name, value, owner = stats.name)
+            return value
     
+        def coordinated_load(full_name, event_data_allgather = False):
+            """
+            Collective version of load. Raises KeyError on all ranks unless
+            rank 0 finds the value (and, for memory-mapped values, all other
+            ranks load it too).
+            """
+            comm = get_comm()
+            if comm.Get_size() == 1:
+                return load(full_name)
+            rank = comm.Get_rank()
+            mode = None
+            if rank == 0:
+                try:
+                    value = load(full_name)
+                    if os.path.isfile(full_name) and\
+                            os.path.isdir(cachemanager.sidecar_dir(full_name)):
+                        mode = 'mmap'
+                    else:
+                        mode = 'bcast'
+                except KeyError:
+                    pass
+            mode = comm.bcast(mode, root = 0)
+            if mode is None:
+                raise KeyError(full_name)
+            if mode == 'bcast':
+                if rank == 0 and strip_event_data is not None and not event_data_allgather:
+                    sent = strip_event_data(value)
+                elif rank == 0:
+                    sent = value
+                else:
+                    sent = None
+                sent = comm.bcast(sent, root = 0)
+                if rank != 0:
+                    value = sent
+                    cachemanager.memory.put(full_name, value, owner = stats.name)
+            else:
+                loaded = True
+                if rank != 0:
+                    try:
+                        value = load(full_name)
+                    except KeyError:
+                        loaded = False
+                # Either all ranks return the value or all of them compute it
+                if not all(comm.allgather(loaded)):
+                    raise KeyError(full_name)
+            return value
+
         def compute(*args, **kwargs):
             file_name = kwargs.pop('file_name', None)
-            key = gen_key(*args, **kwargs)
             value = func(*args, **kwargs)
-            cache[key] = value
+            cachemanager.memory.put(file_name, value, owner = stats.name)
             # Write to disk if the cache file doesn't already exist
             if not os.path.isfile(file_name):
-                dump_to_file(value, file_name)
+                dump_to_file(value, file_name, args, kwargs)
             return value
 
         def new_func(*args, **kwargs):
             # Because we're splitting into multiple files, we can't retrieve the
             # cache until here
             #print "entering ", func.func_name
-            key = gen_key(*args, **kwargs)
-            full_name = file_name + key
-            if key not in cache:
-                try:
-                    try:
-                        with open(full_name, 'r') as f:
-                            cache[key] = cPickle.load(f)
-                    except EOFError:
-                        os.remove(full_name)
-                        print "corrupt cache file deleted"
-                        raise ValueError("Corrupt file")
-                    #print "cache found"
-                except (IOError, ValueError):
-                    #print "no cache found; computing"
-                    compute(*args, file_name = full_name, **kwargs)
             # if the "flush" kwarg is passed, recompute regardless of whether
             # the result is cached
-            if "flush" in kwargs.keys():
-                kwargs.pop("flush", None)
-                # TODO: refactor
-                compute(*args, file_name = full_name, **kwargs)
-            #print "returning from ", func.func_name
-            return cache[key]
+            flush = kwargs.pop("flush", False)
+            key = gen_key(*args, **kwargs)
+            full_name = file_name + key
+            if flush:
+                stats.misses += 1
+                return compute(*args, file_name = full_name, **kwargs)
+            try:
+                if collective:
+                    return coordinated_load(full_name,
+                        kwargs.get('event_data_allgather', False))
+                else:
+                    return load(full_name)
+            except KeyError:
+                #print "no cache found; computing"
+                stats.misses += 1
+                return compute(*args, file_name = full_name, **kwargs)
+
+        def cached(*args, **kwargs):
+            """
+            Return the cached value for a call without evaluating it.
+
+            Raises KeyError if the call's value isn't cached.
+            """
+            full_name = file_name + gen_key(*args, **kwargs)
+            try:
+                if collective:
+                    return coordinated_load(full_name,
+                        kwargs.get('event_data_allgather', False))
+                else:
+                    return load(full_name)
+            except KeyError:
+                raise KeyError("%s: value not cached" % func.func_name)
+
+        def cache_put(value, *args, **kwargs):
+            """
+            Store value as the result of calling the decorated function with
+            args and kwargs.
+            """
+            full_name = file_name + gen_key(*args, **kwargs)
+            cachemanager.memory.put(full_name, value, owner = stats.name)
+            if not os.path.isfile(full_name):
+                dump_to_file(value, full_name, args, kwargs)
 
+        new_func.cached = cached
+        new_func.cache_put = cache_put
+        new_func.cache_stats = stats
         return new_func
 
     return decorator
@@ -0,0 +1,89 @@
+"""
+Asynchronous, batched writes to a storage backend.
+
+A WriteQueue's writer thread takes write operations from a bounded queue
+and passes them to the backend's write_batch method up to BATCH_SIZE at a
+time, so that the caller doesn't wait for round trips to the database
+server. put blocks while the queue is full.
+
+Each operation is a tuple (collection, doc, query): doc is inserted into
+the collection and, unless query is None, every other document matching
+query is removed (see database.mongo_replace).
+"""
+
+import sys
+import time
+import Queue
+import threading
+
+# Maximum number of queued operations
+QUEUE_SIZE = 256
+
+# Maximum number of operations written in one batch
+BATCH_SIZE = 64
+
+# Default time, in seconds, that flush waits for queued operations
+FLUSH_TIMEOUT = 30.
+
+
+class WriteQueue(object):
+    def __init__(self, get_backend, maxsize = QUEUE_SIZE, batch_size = BATCH_SIZE):
+        """
+        get_backend: function returning the backend to write to (called
+        from the writer thread).
+        """
+        self.get_backend = get_backend
+        self.batch_size = batch_size
+        self.queue = Queue.Queue(maxsize = maxsize)
+        # Number of operations put but not yet written, guarded by condition
+        self.pending = 0
+        self.condition = threading.Condition()
+        # exc_info of the first failed batch, re-raised by flush
+        self.error = None
+        self.thread = threading.Thread(target = self.writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, collection, doc, query = None):
+        with self.condition:
+            self.pending += 1
+        self.queue.put((collection, doc, query))
+
+    def writer(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self.get_backend().write_batch(batch)
+            except Exception:
+                if self.error is None:
+                    self.error = sys.exc_info()
+            with self.condition:
+                self.pending -= len(batch)
+                self.condition.notify_all()
+
+    def flush(self, timeout = FLUSH_TIMEOUT):
+        """
+        Wait up to timeout seconds for all queued operations to be written.
+        Returns False if some are still pending. Re-raises the exception of
+        a failed batch.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            pending = self.pending
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+        if pending:
+            print "WARNING: %d database writes still pending after %.1f s" % (pending, timeout)
+            return False
+        return True
@@ -15,6 +15,7 @@ import utils
 import data_access
 import logbook
 import playback
+import lineage
 
 import pdb
 import ipdb
@@ -90,9 +91,9 @@ def mean_from_label(detid, transpose = False):
     """
     def data_getter(label):
         arr = data.get_data_and_filter(label, detid)[0]
-        arr = arr.astype('float')
+        arr = lineage.derive(arr.astype('float'), arr, 'float')
         if transpose:
-            return arr.T
+            return lineage.derive(arr.T, arr, 'transpose')
         else:
             return arr
     return data_getter
@@ -101,7 +102,9 @@ def events_from_label(detid, nevents, transpose = False):
     def data_getter_events(label):
         def event_data_getter(x, **kwargs):
             return x
-        d = data.get_data_and_filter(label, detid, event_data_getter = event_data_getter)[1]
+        # The frames are needed by all MPI ranks
+        d = data.get_data_and_filter(label, detid, event_data_getter = event_data_getter,
+            event_data_allgather = True)[1]
         if len(d) > 1:
             raise ValueError("Invalid dataset label: %s. Label must refer to exactly one run." % label)
         try:
@@ -308,6 +311,26 @@ def get_spectrum(data, dark = None, cencol_calibration_data = None, cold_calibra
             and calib_load_path is also None, do not perform an energy
             calibration at all.
     Output: array, array -> energy or index, normalized intensity
+
+    Spectra are cached; arrays from mean_from_label are keyed by their
+    lineage tokens (see lineage.py) rather than their contents.
+    """
+    # A cached spectrum's calibration isn't saved again
+    flush = bool(calib_save_path) and not os.path.exists(calib_save_path)
+    return compute_spectrum(data, dark = dark,
+        cencol_calibration_data = cencol_calibration_data,
+        cold_calibration_data = cold_calibration_data, pxwidth = pxwidth,
+        bg_sub = bg_sub, calib_load_path = calib_load_path,
+        calib_save_path = calib_save_path,
+        energy_ref1_energy_ref2_calibration = energy_ref1_energy_ref2_calibration,
+        eltname = eltname, normalization = normalization, flush = flush)
+
+@utils.eager_persist_to_file("cache/xes_process.compute_spectrum/")
+def compute_spectrum(data, dark = None, cencol_calibration_data = None, cold_calibration_data = None,
+        pxwidth = 3, bg_sub = True, calib_load_path = None, calib_save_path = None,
+        energy_ref1_energy_ref2_calibration = True, eltname = '', normalization = True):
+    """
+    Implementation of get_spectrum.
     """
 #    if np.shape(data) != (391, 370):
 #        print "WARNING: array dimensions ", np.shape(data), " differ from recorded shape of CSPAD140k"
@@ -477,7 +500,8 @@ def main_variation(detid, data_identifiers, cold_calibration_label = None, pxwid
     for data,label in zip(data_arrays, labels):
         #get_label_data(label, detid, default_bg = None, override_bg = None,
         # separate = False, event_data_getter = None, event_mask = None, **kwargs):
-        a,b = data_access.get_label_data(label, detid, event_data_getter=evg)
+        a,b = data_access.get_label_data(label, detid, event_data_getter=evg,
+            event_data_allgather = True)
 
         print label
         ilabel = int(label)
@@ -1,6 +1,7 @@
 # Authors: A. Ditter, O. Hoidn, and R. Valenza
 
 import os
+import sys
 import numpy as np
 import numpy.ma as ma
 import matplotlib.pyplot as plt
@@ -20,6 +21,7 @@ import config
 import utils
 import logbook
 import playback
+import lineage
 
 
 #from mpi4py import MPI
@@ -38,6 +40,11 @@ verbose = True
 # all runs in a dataset.
 Dataset = recordclass('Dataset', ['dataref', 'ref_type', 'detid', 'compound_list', 'array'])
 
+# Modules whose source code the values of this module's cached functions
+# depend on: this module (helpers such as translate, get_detid_parameters
+# and the background subtraction routines).
+CACHE_DEPENDENCIES = [sys.modules[__name__]]
+
 def get_detid_parameters(detid):
     """
     Given a detector ID, extract its detector geometry parameters from
@@ -115,18 +122,19 @@ def data_extractor(dataset, apply_mask = True, event_data_getter = None,
     elif dataset.ref_type == 'label':
         imarray, event_data = data.get_data_and_filter(dataset.dataref, dataset.detid,
             event_data_getter = event_data_getter, event_filter = event_filter)
-        imarray = imarray.T
+        imarray = lineage.derive(imarray.T, imarray, 'transpose')
 
     else:
         raise ValueError("Invalid argument combination. Data source must be specified by detid and either path or label")
     if apply_mask:
         extra_masks = config.detinfo_map[dataset.detid].extra_masks
         combined_mask = utils.combine_masks(imarray, extra_masks, transpose = True)
-        imarray *= combined_mask
+        # Not in place, since imarray may be a cached value
+        imarray = lineage.derive(imarray * combined_mask, imarray, 'mask')
     min_val =  np.min(imarray)
     #print "PERCENTILES", np.percentile(imarray, 1), np.percentile(imarray, 2), np.percentile(imarray, 5), np.percentile(imarray, 10), np.percentile(imarray, 15)
     if min_val < 0:
-        return np.abs(min_val) + imarray, event_data
+        return lineage.derive(np.abs(min_val) + imarray, imarray, 'offset'), event_data
     else:
         return imarray, event_data
 
@@ -200,13 +208,17 @@ def binData(mi, ma, stepsize, valenza = True):
     return binangles
 
 
-#@utils.eager_persist_to_file("cache/xrd.process_imarray/")
+@utils.eager_persist_to_file("cache/xrd.process_imarray/", excluded = ['verbose'],
+    config_fields = ['detinfo_map'], depends_on = CACHE_DEPENDENCIES)
 def process_imarray(detid, imarray, nbins = 1000, verbose = True, fiducial_ellipses = None, bgsub = True, compound_list = []):
     """
     Given a detector ID and assembeled CSPAD image data array, compute the
     powder pattern.
 
     Outputs:  data in bins, intensity vs. theta. Saves data to file
+
+    Cached; arrays from data_extractor are keyed by their lineage tokens
+    (see lineage.py) rather than their contents.
     """
 
     # TODO: make this take dataset as an argument
@@ -400,6 +412,8 @@ def get_background_full_frame(imarray, detid, compound_list, smoothing = 10, wid
     bg_smooth[~pixel_mask] = 0.
     return bg_smooth
 
+@utils.eager_persist_to_file("cache/xrd.subtract_background_full_frame/",
+    config_fields = ['detinfo_map'], depends_on = CACHE_DEPENDENCIES)
 def subtract_background_full_frame(imarray, detid, compound_list, smoothing = 10, width = DEFAULT_PEAK_WIDTH):
     """
     Background-subtract imarray and return the result. 
@@ -543,6 +557,8 @@ def peak_sizes(x, y, peak_ranges):
         sizeList += [np.sum(y[peakIndices])]
     return np.array(sizeList)
 
+@utils.eager_persist_to_file("cache/xrd.get_peak_and_background_signal_from_imarray/",
+    config_fields = ['detinfo_map'])
 def get_peak_and_background_signal_from_imarray(imarray, detid, compound_list, smoothing = 10, width = DEFAULT_PEAK_WIDTH):
     # interpolated background
     # TODO: docstring
@@ -561,7 +577,7 @@ def get_peak_and_background_signal_from_imarray(imarray, detid, compound_list, s
     peaks_imarray_subtracted = (~powder_mask) * (peaks_imarray - bg)
     return np.sum(peaks_imarray_subtracted), np.sum(bg)
 
-@utils.eager_persist_to_file("cache/xrd.get_peak_and_background_signal/")
+@utils.eager_persist_to_file("cache/xrd.get_peak_and_background_signal/", config_fields = ['detinfo_map'])
 def get_peak_and_background_signal_from_dataref(dataset, smoothing = 10, width = DEFAULT_PEAK_WIDTH, event_data_getter = None):
     """
     Evaluates signal and background levels for an array, or for the mean
@@ -581,7 +597,7 @@ def get_peak_and_background_signal_from_dataref(dataset, smoothing = 10, width =
         smoothing = smoothing, width = width)
     return peaksum, bgsum
 
-@utils.eager_persist_to_file("cache/xrd.get_normalization/")
+@utils.eager_persist_to_file("cache/xrd.get_normalization/", config_fields = ['detinfo_map'])
 def get_normalization(datasets, peak_width = DEFAULT_PEAK_WIDTH, type = 'transmission'):
     if type == 'transmission':
         labels = np.array(map(lambda x: x.dataref, datasets))
@@ -8,6 +8,7 @@ from dataccess import database
 from dataccess import playback
 from dataccess import argument_parsers
 from dataccess import utils
+from dataccess import cachemanager
 import argparse
 import time
 
@@ -25,6 +26,7 @@ argument_parsers.addparser_xrd(subparsers)
 argument_parsers.addparser_histogram(subparsers)
 argument_parsers.addparser_datashow(subparsers)
 argument_parsers.addparser_eventframes(subparsers)
+argument_parsers.addparser_cache(subparsers)
 
 args = parser.parse_args()
 
@@ -34,6 +36,8 @@ def mongo_commit():
             database.mongo_commit(args.labels)
         elif cmd == 'eventframes':
             database.mongo_commit([args.label])
+        # Wait (briefly) for queued database writes before exiting
+        database.flush_writes()
 
 #if basicutils.isroot():
 #    print "args: ", args
@@ -41,6 +45,17 @@ config_source = utils.resource_path('data/config.py')
 config_dst = 'config.py'
 cmd = vars(args)['command']
 
+if cmd == 'cache':
+    # Import the modules defining cached functions so that stale cache files
+    # can be identified
+    from dataccess import data_access
+    from dataccess import xrd
+    from dataccess import xes_process
+    from dataccess import query
+    cachemanager.main(args.action, function = args.function, label = args.label,
+        run = args.run, stale = args.stale)
+    sys.exit(0)
+
 # try to execute from database
 key = '_'.join(sys.argv[1:])
 
@@ -184,6 +199,7 @@ if utils.isroot():
     print playback.db
     playback.execute()
     mongo_commit()
+    cachemanager.report()
 #comm = MPI.COMM_WORLD
 #comm.Barrier()
 #MPI.Finalize()
@@ -0,0 +1,32 @@
+import os
+import shutil
+import tempfile
+import cPickle
+import numpy as np
+from dataccess import storage
+from dataccess import blobstore
+
+def test_arrays_and_event_data():
+    dirname = tempfile.mkdtemp()
+    backend = storage.LocalBackend(dirname)
+    chunk_bytes = blobstore.CHUNK_BYTES
+    blobstore.CHUNK_BYTES = 800
+    try:
+        frame = np.random.random((100, 10))
+        manifest = blobstore.put_array(backend, frame)
+        assert len(manifest['chunks']) == 10
+        assert np.all(blobstore.get_array(backend, manifest) == frame)
+        assert np.all(blobstore.get_array(backend, manifest, 25, 47) == frame[25:47])
+        # Identical chunks are stored once
+        nblobs = len(os.listdir(backend.blob_dir()))
+        blobstore.put_array(backend, frame.copy())
+        assert len(os.listdir(backend.blob_dir())) == nblobs
+    finally:
+        blobstore.CHUNK_BYTES = chunk_bytes
+    event_data = {1: {0: 1.5, 2: 2.5}, 2: {5: np.ones(3)}, 3: {0: 'a', 1: None}}
+    lazy = blobstore.LazyEventData(backend, blobstore.put_event_data(backend, event_data))
+    assert sorted(lazy.keys()) == [1, 2, 3] and not lazy.loaded
+    assert lazy[1] == {0: 1.5, 2: 2.5} and lazy.loaded.keys() == [1]
+    assert np.all(lazy[2][5] == np.ones(3)) and lazy[3] == {0: 'a', 1: None}
+    assert cPickle.loads(cPickle.dumps(lazy))[1] == {0: 1.5, 2: 2.5}
+    shutil.rmtree(dirname)
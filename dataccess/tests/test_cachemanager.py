@@ -0,0 +1,103 @@
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from dataccess import cachemanager
+
+def test_memory_lru():
+    lru = cachemanager.MemoryLRU(budget = 2500)
+    for key in 'abc':
+        lru.put(key, np.zeros(100), owner = 'f')
+    assert 'a' in lru and 'c' in lru
+    lru['a']
+    lru.put('d', np.zeros(100), owner = 'g')
+    # least recently used entry is evicted first
+    assert 'b' not in lru and 'a' in lru
+    assert lru.nbytes <= 2500
+    assert lru.owner_bytes('g') == 800
+    lru.put('big', np.zeros(1000))
+    assert 'big' not in lru
+
+def test_disk_eviction():
+    dirname = tempfile.mkdtemp()
+    prefix = os.path.join(dirname, 'f')
+    disk = cachemanager.DiskTier()
+    disk.register(prefix)
+    now = time.time()
+    for i in range(4):
+        with open(prefix + str(i), 'w') as f:
+            f.write('x' * 100)
+        os.utime(prefix + str(i), (now - 100 * (4 - i), now - 100 * (4 - i)))
+    budget, max_age = cachemanager.DISK_BUDGET, cachemanager.DISK_MAX_AGE
+    try:
+        cachemanager.DISK_BUDGET, cachemanager.DISK_MAX_AGE = 250, 350
+        deleted = disk.evict()
+    finally:
+        cachemanager.DISK_BUDGET, cachemanager.DISK_MAX_AGE = budget, max_age
+    assert sorted(deleted) == [prefix + '0', prefix + '1']
+    assert sorted(os.listdir(dirname)) == ['f2', 'f3']
+    shutil.rmtree(dirname)
+
+def test_sidecar_roundtrip():
+    dirname = tempfile.mkdtemp()
+    path = os.path.join(dirname, 'value')
+    big = np.random.random((1000, 200))
+    value = (big, {1: {0: 1.5}}, np.arange(3), big)
+    cachemanager.dump(value, path)
+    assert len(os.listdir(cachemanager.sidecar_dir(path))) == 1
+    loaded = cachemanager.load(path)
+    assert isinstance(loaded[0], np.memmap)
+    assert np.all(loaded[0] == big) and loaded[3] is loaded[0]
+    assert loaded[1] == {1: {0: 1.5}} and np.all(loaded[2] == np.arange(3))
+    # Loaded arrays are copy-on-write
+    loaded[0][0, 0] = -1.
+    assert cachemanager.load(path)[0][0, 0] == big[0, 0]
+    assert cachemanager.file_size(path) > big.nbytes
+    cachemanager.remove(path)
+    assert not os.listdir(dirname)
+    shutil.rmtree(dirname)
+
+def test_many_sidecar_arrays():
+    dirname = tempfile.mkdtemp()
+    path = os.path.join(dirname, 'value')
+    min_bytes = cachemanager.SIDECAR_MIN_BYTES
+    try:
+        cachemanager.SIDECAR_MIN_BYTES = 1024
+        # More arrays than the usual limit of open file descriptors
+        value = {i: np.random.random(200) for i in range(2000)}
+        value['fortran'] = np.asfortranarray(np.random.random((30, 40)))
+        cachemanager.dump(value, path)
+    finally:
+        cachemanager.SIDECAR_MIN_BYTES = min_bytes
+    assert os.listdir(cachemanager.sidecar_dir(path)) == [cachemanager.SIDECAR_NAME]
+    loaded = cachemanager.load(path)
+    assert all(np.all(loaded[i] == value[i]) for i in range(2000))
+    assert np.all(loaded['fortran'] == value['fortran'])
+    assert isinstance(loaded[0], np.memmap)
+    shutil.rmtree(dirname)
+
+def test_find_and_select_entries():
+    dirname = tempfile.mkdtemp()
+    os.mkdir(os.path.join(dirname, 'f'))
+    for name, args in [('a', ['label1', 'quad1']), ('b', [[100, 101], 'quad1'])]:
+        path = os.path.join(dirname, 'f', name)
+        cachemanager.dump(np.zeros(3), path)
+        cachemanager.write_meta(path, {'function': 'f', 'prefix': dirname + '/f/',
+            'args': args, 'kwargs': {}, 'source': 's', 'config': 'c', 'time': 0.})
+    entries = cachemanager.find_entries(dirname)
+    assert [os.path.basename(path) for path, meta in entries] == ['a', 'b']
+    def select(**kwargs):
+        return [os.path.basename(path) for path, meta in entries
+            if cachemanager.entry_matches(path, meta, **kwargs)]
+    assert select(label = 'label1') == ['a']
+    assert select(run = 101) == ['b']
+    assert select(function = 'f') == ['a', 'b'] and select(function = 'g') == []
+    # Unregistered functions' staleness is unknown
+    assert cachemanager.is_stale(*entries[0]) is None
+    cachemanager.register_function(dirname + '/f/', 'f', lambda: {'source': 's', 'config': 'x'})
+    assert cachemanager.is_stale(*entries[0])
+    cachemanager.main('prune', label = 'label1', root = dirname)
+    assert [os.path.basename(path) for path, meta in cachemanager.find_entries(dirname)] == ['b']
+    cachemanager.functions.clear()
+    shutil.rmtree(dirname)
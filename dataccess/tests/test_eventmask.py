@@ -0,0 +1,33 @@
+import cPickle
+import numpy as np
+from dataccess.eventmask import RunMask, EventMask, restrict
+
+def test_lookup():
+    mask = RunMask.from_dict({0: True, 2: False, 5: True})
+    assert mask[0] and mask[5]
+    assert not mask[1] and not mask[2] and not mask[100]
+    assert 2 in mask and 1 not in mask
+    assert mask.count() == 2 and mask.nevents() == 3
+    assert mask.to_dict() == {0: True, 2: False, 5: True}
+
+def test_logic():
+    a = EventMask.from_dict({1: {0: True, 1: True, 2: False}})
+    b = EventMask.from_dict({1: {0: True, 1: False, 3: True}, 2: {0: True}})
+    assert (a & b).to_dict() == {1: {0: True, 1: False, 2: False, 3: False}, 2: {0: False}}
+    assert (a | b).count() == 4
+    assert (~a).to_dict() == {1: {0: False, 1: False, 2: True}}
+
+def test_pickle_and_key():
+    flags = np.random.random(1000) > 0.5
+    mask = EventMask({1: RunMask(np.ones(1000, dtype = bool), flags)})
+    loaded = cPickle.loads(cPickle.dumps(mask, 2))
+    assert np.all(loaded[1].accepted == flags)
+    assert loaded.__cache_key__() == mask.__cache_key__()
+    assert (~mask).__cache_key__() != mask.__cache_key__()
+
+def test_restrict():
+    a = EventMask.from_dict({1: {0: True}, 2: {0: False}})
+    b = EventMask.from_dict({1: {0: True}, 2: {0: True}})
+    assert restrict(a, 1).runs() == [1]
+    assert restrict(a, 1).__cache_key__() == restrict(b, 1).__cache_key__()
+    assert restrict(None, 1) is None
@@ -0,0 +1,40 @@
+import os
+import cPickle
+import shutil
+import tempfile
+import numpy as np
+from dataccess import eventstore
+
+def test_spill():
+    spill_dir = tempfile.mkdtemp()
+    frames = {i: np.random.random((4, 5)) for i in range(10)}
+    d = eventstore.RunEventData(1, budget = 3 * frames[0].nbytes,
+        spill_dir = spill_dir)
+    for i, frame in frames.iteritems():
+        d[i] = frame
+    d[10] = 1.5
+    assert len(d) == 11
+    assert d.index
+    assert d.nbytes <= d.budget
+    assert list(d) == range(11)
+    for i, frame in frames.iteritems():
+        assert np.all(d[i] == frame)
+    assert d[10] == 1.5
+    d[0] = np.zeros((4, 5))
+    assert np.all(d[0] == 0)
+    del d[1]
+    assert 1 not in d and len(d) == 10
+    shutil.rmtree(spill_dir)
+
+def test_pickle():
+    spill_dir = tempfile.mkdtemp()
+    d = eventstore.RunEventData(1, budget = 0, spill_dir = spill_dir)
+    for i in range(3):
+        d[i] = np.arange(3) * i
+    loaded = cPickle.loads(cPickle.dumps(d))
+    assert type(loaded) == dict
+    assert sorted(loaded.keys()) == range(3)
+    assert np.all(loaded[2] == np.arange(3) * 2)
+    d.close()
+    assert not os.listdir(spill_dir)
+    shutil.rmtree(spill_dir)
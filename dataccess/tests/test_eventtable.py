@@ -0,0 +1,33 @@
+import numpy as np
+from dataccess.eventtable import EventTable
+
+def test_dict_roundtrip():
+    d = {1: {0: 1., 2: 3.}, 5: {1: 2.}}
+    table = EventTable.from_dict(d)
+    assert len(table) == 3
+    assert table.to_dict() == d
+    assert table.counts_by_run() == {1: 2, 5: 1}
+    assert np.all(table.sort().to_array() ==
+        np.array([[1, 0, 1.], [1, 2, 3.], [5, 1, 2.]]))
+
+def test_merge():
+    a = EventTable.from_dict({1: {0: 1., 1: 2.}, 2: {0: 5.}})
+    b = EventTable.from_dict({2: {3: 7.}})
+    merged = EventTable.merge(a, b)
+    # same semantics as utils.merge_dicts
+    assert merged.to_dict() == {1: {0: 1., 1: 2.}, 2: {3: 7.}}
+    assert len(EventTable.merge()) == 0
+
+def test_filter_groupby():
+    table = EventTable.from_dict({1: {0: 1., 1: np.nan}, 2: {0: 5.}})
+    finite = table.filter(lambda v: ~np.isnan(v))
+    assert len(finite) == 2
+    groups = finite.groupby_run()
+    assert [r for r, t in groups] == [1, 2]
+    assert groups[1][1].value.tolist() == [5.]
+
+def test_array_values():
+    d = {3: {0: np.zeros(2), 1: np.ones(2)}}
+    table = EventTable.from_dict(d)
+    assert table.value.shape == (2, 2)
+    assert np.all(table.to_dict()[3][1] == 1)
@@ -0,0 +1,15 @@
+import cPickle
+import numpy as np
+from dataccess import lineage
+
+def test_tag_and_derive():
+    arr = lineage.tag(np.arange(6.).reshape(2, 3), ('label', 1))
+    assert arr.__cache_key__() == ('lineage', 'label', 1)
+    # Derived arrays are untagged unless tagged explicitly
+    assert type(arr + 1) is np.ndarray and arr.T.lineage is None
+    assert lineage.get_lineage(arr[0]) is None
+    transposed = lineage.derive(arr.T, arr, 'transpose')
+    assert transposed.lineage == ('label', 1, 'transpose')
+    assert lineage.derive(np.ones(3), np.ones(3), 'step').__class__ is np.ndarray
+    loaded = cPickle.loads(cPickle.dumps(transposed, cPickle.HIGHEST_PROTOCOL))
+    assert loaded.lineage == transposed.lineage and np.all(loaded == arr.T)
@@ -0,0 +1,25 @@
+from dataccess import logbookindex
+
+def test_lookups():
+    logbook_dict = {
+        'fe3o4': {'runs': (3, 1, 2), 'transmission': 0.1},
+        'fe3o4-a': {'runs': (1, 2), 'transmission': 0.5},
+        'mgo': {'runs': (5,), 'material': 'MgO'},
+        'notes': {'runs': (None,)}}
+    index = logbookindex.LogbookIndex(logbook_dict)
+    assert index.label_runs['fe3o4'] == (1, 2, 3)
+    assert index.labels(2) == set(['fe3o4', 'fe3o4-a']) and index.labels(4) == set()
+    assert index.attribute('mgo', 'material') == 'MgO'
+    assert index.runs_to_label([1]) == 'fe3o4-a'
+    assert index.runs_to_label([1, 3]) == 'fe3o4'
+    assert index.runs_to_label([3, 5]) is None
+    assert 'notes' in index and index.runs('notes') == (None,)
+    assert index.version == logbookindex.version_stamp(dict(logbook_dict))
+
+def test_version_stamp():
+    document = {'name': 'lb', '_id': 1,
+        'fe3o4': {'runs': [1, 2], 'transmission': 0.1}}
+    contents = logbookindex.logbook_contents(document)
+    assert contents == {'fe3o4': {'runs': (1, 2), 'transmission': 0.1}}
+    assert logbookindex.version_stamp(document) == logbookindex.version_stamp(contents)
+    assert document['fe3o4']['runs'] == [1, 2]
@@ -0,0 +1,37 @@
+import numpy as np
+from dataccess import pixelstats
+
+def make_stats(frames):
+    stats = pixelstats.PixelStats()
+    for frame in frames:
+        stats.add(frame)
+    return stats
+
+def test_streaming_matches_batch():
+    frames = np.random.normal(size = (50, 4, 5))
+    stats = make_stats(frames)
+    assert stats.n == 50
+    assert np.allclose(stats.mean, frames.mean(axis = 0))
+    assert np.allclose(stats.variance, frames.var(axis = 0))
+    assert np.allclose(stats.min, frames.min(axis = 0))
+    assert np.allclose(stats.max, frames.max(axis = 0))
+    totals = frames.sum(axis = (1, 2))
+    assert np.allclose(stats.totals.mean, totals.mean())
+    assert np.allclose(stats.totals.std, totals.std())
+
+def test_merge():
+    frames = np.random.normal(size = (30, 3, 3))
+    merged = make_stats(frames[:7]).merge(make_stats(frames[7:]))
+    assert merged.n == 30
+    assert np.allclose(merged.mean, frames.mean(axis = 0))
+    assert np.allclose(merged.variance, frames.var(axis = 0))
+    assert np.allclose(merged.max, frames.max(axis = 0))
+    assert merged.totals.n == 30
+    # merging an empty accumulator is a no-op
+    assert make_stats([]).merge(merged).n == 30
+
+def test_clip_bounds():
+    stats = make_stats([np.ones(4) * x for x in [1., 2., 3.]])
+    lower, upper = stats.clip_bounds(1.)
+    assert np.isclose(lower, 8. - np.std([4., 8., 12.]))
+    assert np.isclose(upper, 8. + np.std([4., 8., 12.]))
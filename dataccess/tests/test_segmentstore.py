@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from dataccess import segmentstore
+
+def test_append_and_read():
+    dirname = os.path.join(tempfile.mkdtemp(), 'store')
+    store = segmentstore.SegmentStore(dirname)
+    assert 'a' not in store and len(store) == 0
+    store['a'] = np.arange(5)
+    store['b'] = {'x': 1}
+    assert np.all(store['a'] == np.arange(5)) and store['b'] == {'x': 1}
+    # A second instance (e.g. another process) sees existing entries and
+    # appends to its own segment
+    other = segmentstore.SegmentStore(dirname)
+    assert other['b'] == {'x': 1}
+    other['a'] = 'overwritten'
+    assert len(store.segments()) == 2
+    store.refresh()
+    assert store['a'] == 'overwritten' and sorted(store.keys()) == ['a', 'b']
+    shutil.rmtree(os.path.dirname(dirname))
+
+def test_compact():
+    dirname = os.path.join(tempfile.mkdtemp(), 'store')
+    store = segmentstore.SegmentStore(dirname)
+    for i in range(10):
+        store['a'] = np.zeros(1000) + i
+    store['b'] = 'b'
+    segmentstore.SegmentStore(dirname)['c'] = 'c'
+    assert store.total_bytes() > store.live_bytes()
+    freed = store.compact()
+    assert freed > 0 and store.total_bytes() == store.live_bytes()
+    assert len(store.segments()) == 1
+    reopened = segmentstore.SegmentStore(dirname)
+    assert np.all(reopened['a'] == 9) and reopened['b'] == 'b' and reopened['c'] == 'c'
+    # Writes after compaction go to a new segment
+    store['d'] = 'd'
+    assert segmentstore.SegmentStore(dirname)['d'] == 'd'
+    shutil.rmtree(os.path.dirname(dirname))
@@ -0,0 +1,44 @@
+import shutil
+import tempfile
+from dataccess import storage
+
+def test_local_backend():
+    dirname = tempfile.mkdtemp()
+    backend = storage.LocalBackend(dirname)
+    first = backend.insert('c', {'label': 'fe3o4-1', 'detid': 'quad1', 'runs': (1, 2)})
+    backend.insert('c', {'label': 'fe3o4-2', 'detid': 'quad2'})
+    backend.insert('other', {'label': 'fe3o4-1'})
+    assert [d['runs'] for d in backend.find('c', {'label': 'fe3o4-1'})] == [(1, 2)]
+    assert len(backend.find('c', {'label': {'$regex': 'fe3o4'}})) == 2
+    assert [d['detid'] for d in backend.find('c', {'_id': {'$ne': first}})] == ['quad2']
+    assert backend.find('c', {'label': 'fe3o4-1'}, fields = ['runs']) == [{'_id': first, 'runs': (1, 2)}]
+    backend.remove('c', {'detid': 'quad2'})
+    assert len(backend.find('c', {})) == 1 and len(backend.find('other', {})) == 1
+    # Documents persist across connections
+    assert len(storage.LocalBackend(dirname).find('c', {})) == 1
+    blob_id = backend.put_blob('abc')
+    assert backend.put_blob('abc') == blob_id and backend.get_blob(blob_id) == 'abc'
+    try:
+        backend.get_blob('missing')
+        assert False
+    except KeyError:
+        pass
+    shutil.rmtree(dirname)
+
+def test_local_index_and_version():
+    dirname = tempfile.mkdtemp()
+    backend = storage.LocalBackend(dirname)
+    backend.insert('c', {'label': u'fe3o4-1', 'detid': 'quad1'})
+    backend.ensure_index('c', ['label', 'detid'])
+    backend.insert('c', {'label': 'fe3o4-1', 'detid': 'quad2'})
+    backend.insert('c', {'label': 'fe3o4-2', 'detid': 'quad1'})
+    assert len(backend.find('c', {'label': 'fe3o4-1'})) == 2
+    assert len(backend.find('c', {'label': {'$eq': 'fe3o4-1'}, 'detid': 'quad1'})) == 1
+    assert len(backend.find('c', {'label': {'$regex': '-1$'}})) == 2
+    backend.remove('c', {'detid': 'quad2'})
+    assert len(backend.find('c', {'label': 'fe3o4-1'})) == 1
+    assert backend.get_version('c') == 0
+    backend.bump_version('c')
+    backend.bump_version('c')
+    assert storage.LocalBackend(dirname).get_version('c') == 2
+    shutil.rmtree(dirname)
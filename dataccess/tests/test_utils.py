@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from dataccess import utils
+
+def test_hash_views_and_copies():
+    a = np.arange(100.).reshape(10, 10)
+    view = a[::2]
+    assert utils.make_hashable(view) == utils.make_hashable(view.copy())
+    assert utils.make_hashable(a.T) == utils.make_hashable(np.ascontiguousarray(a.T))
+    before = utils.make_hashable(view)
+    a[0, 0] = -1.
+    assert utils.make_hashable(view) != before
+    assert utils.make_hashable(np.zeros(4)) != utils.make_hashable(np.zeros((2, 2)))
+
+def test_hash_masked_arrays():
+    data = np.arange(5.)
+    masked1 = np.ma.masked_array(data, mask = [0, 1, 0, 0, 0])
+    masked2 = np.ma.masked_array(data, mask = [0, 0, 1, 0, 0])
+    assert utils.make_hashable(masked1) != utils.make_hashable(masked2)
+    assert utils.make_hashable(masked1) == utils.make_hashable(masked1.copy())
+
+def test_hash_writeable_flip():
+    b = np.zeros(10)
+    b.flags.writeable = False
+    before = utils.make_hashable(b)
+    b.flags.writeable = True
+    b[0] = 100
+    b.flags.writeable = False
+    assert utils.make_hashable(b) != before
+
+def test_hash_readonly_file_map():
+    dirname = tempfile.mkdtemp()
+    path = os.path.join(dirname, 'a.npy')
+    np.save(path, np.arange(10.))
+    arr = np.load(path, mmap_mode = 'r')
+    assert utils.is_immutable(arr) and not utils.is_immutable(np.load(path, mmap_mode = 'c'))
+    assert utils.make_hashable(arr) == utils.make_hashable(np.arange(10.))
+    assert id(arr) in utils.hash_memo
+    del arr
+    shutil.rmtree(dirname)
+
+def test_cache_key():
+    class Keyed(object):
+        def __init__(self, key):
+            self.key = key
+        def __cache_key__(self):
+            return self.key
+    assert utils.make_hashable(Keyed('abc')) == 'abc'
+    assert utils.make_hashable(Keyed((1, 2))) == utils.make_hashable((1, 2))
+    assert utils.make_hashable(Keyed((1, 2))) != utils.make_hashable(Keyed((1, 3)))
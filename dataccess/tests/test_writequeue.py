@@ -0,0 +1,26 @@
+import shutil
+import tempfile
+from dataccess import storage
+from dataccess import writequeue
+
+def test_replace_batches():
+    dirname = tempfile.mkdtemp()
+    backend = storage.LocalBackend(dirname)
+    queue = writequeue.WriteQueue(lambda: backend, batch_size = 4)
+    for i in range(10):
+        queue.put('c', {'name': 'logbook', 'i': i}, {'name': 'logbook'})
+        queue.put('c', {'name': 'other', 'i': i})
+    assert queue.flush(10.)
+    assert [d['i'] for d in backend.find('c', {'name': 'logbook'})] == [9]
+    assert len(backend.find('c', {'name': 'other'})) == 10
+    shutil.rmtree(dirname)
+
+def test_error_reraised():
+    queue = writequeue.WriteQueue(lambda: None)
+    queue.put('c', {})
+    try:
+        queue.flush(10.)
+        assert False
+    except AttributeError:
+        pass
+    assert queue.flush(1.)